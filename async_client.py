@@ -0,0 +1,224 @@
+'''
+This module defines the asyncio flavour of the Client, a library for bots
+and gateways that speak for many chat identities from one process. An
+AsyncClient parses and reassembles packets exactly like the Client, but its
+transfers are coroutines and nothing blocks or prints, so any number of
+them share one event loop:
+
+    client = AsyncClient("bot", "localhost", 15000)
+    await client.connect()
+    delivered = await client.send(["alice", "bob"], "Hello World")
+    usernames = await client.list()
+    async for sender, message in client:
+        ...
+    await client.close()
+'''
+import asyncio
+import time
+import util
+import window
+import wire
+import delack
+import logs
+from client import Client, KEEPALIVE_INTERVAL
+from impairment import AsyncImpairedTransport
+
+LOG = logs.get_logger("client")
+
+# Seconds list() waits for the server to answer
+REPLY_TIMEOUT = 10.0
+
+
+class ClientProtocol(asyncio.DatagramProtocol):
+    '''
+    Hands every datagram received on the client socket to its AsyncClient.
+    '''
+    def __init__(self, client):
+        self.client = client
+
+    def connection_made(self, transport):
+        self.client.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.client.handle_packet(data)
+
+    def error_received(self, exc):
+        LOG.warning("Socket error: %s", exc)
+
+    def connection_lost(self, exc):
+        self.client.incoming.put_nowait(None)
+
+
+class AsyncClient(Client):
+    '''
+    Client session driven by coroutines. Every identity has a socket of its
+    own, the server tells its users apart by their address. Transfers to
+    the server are sent one after the other in the order they were asked
+    for, like the commands typed into a Client.
+    '''
+    def __init__(self, username, dest, port, window_size=3, binary=True, impairment=None,
+                 ack_delay=delack.ACK_DELAY, mtu=wire.PATH_MTU, compression=True):
+        # The transport is wrapped once the event loop is running
+        super().__init__(username, dest, port, window_size, binary, True, None, ack_delay, mtu, compression)
+        self.impairment = impairment
+        self.loop = None
+        self.transport = None
+        self.incoming = None
+        self.list_waiters = []
+        self.keepalive = None
+
+    async def connect(self):
+        '''
+        Joins the server as username, raises ConnectionError if the server
+        does not answer or refuses the username
+        '''
+        self.loop = asyncio.get_running_loop()
+        self.ack_queue = asyncio.Queue()
+        self.incoming = asyncio.Queue()
+        self.send_lock = asyncio.Lock()
+        self.delayed_acks = delack.AsyncDelayedAcks(self.transmit_ack, self.loop, self.delayed_acks.delay)
+        await self.loop.create_datagram_endpoint(lambda: ClientProtocol(self), sock=self.sock)
+        if self.impairment:
+            self.transport = AsyncImpairedTransport(self.transport, self.impairment, self.loop)
+        self.join_error = None
+        self.transfer_id = None
+        join_message = util.make_message("join", 1, self.name)
+        if not await self.send_transfer([join_message], join_message):
+            self.transport.close()
+            raise ConnectionError(f"No answer from {self.server_addr}:{self.server_port}")
+        if self.join_error:
+            self.transport.close()
+            raise ConnectionError(f"Join refused: {self.join_error}")
+        self.keepalive = self.loop.create_task(self.keepalive_handler())
+
+    async def close(self):
+        '''
+        Leaves the server and ends the iteration over incoming messages
+        '''
+        if self.keepalive:
+            self.keepalive.cancel()
+        disconnect_message = util.make_message("disconnect", 1, self.name)
+        await self.send_transfer([disconnect_message], disconnect_message)
+        self.stop_event.set()
+        self.transport.close()
+
+    def send(self, recipients, message):
+        '''
+        Sends message to the usernames in recipients, or to the members of
+        a room when recipients is a room name like "#team". Returns a task
+        that resolves to True once the server acknowledged the whole
+        message. Rooms are entered with await join_room(room).
+        '''
+        return self.loop.create_task(self.send_transfer(*self.make_message_transfer(recipients, message)))
+
+    async def list(self, timeout=REPLY_TIMEOUT):
+        '''
+        Returns the sorted usernames of the users on the server
+        '''
+        waiter = self.loop.create_future()
+        self.list_waiters.append(waiter)
+        list_packet = util.make_message("request_users_list", 1, str(self.roster_version))
+        try:
+            if not await self.send_transfer([list_packet], list_packet):
+                raise ConnectionError("List request was not acknowledged")
+            return await asyncio.wait_for(waiter, timeout)
+        finally:
+            if waiter in self.list_waiters:
+                self.list_waiters.remove(waiter)
+
+    async def subscribe(self):
+        '''
+        Has the server push joins and leaves, see handle_users_list()
+        '''
+        subscribe_packet = util.make_message("subscribe_presence", 1, str(self.roster_version))
+        return await self.send_transfer([subscribe_packet], subscribe_packet)
+
+    async def messages(self):
+        '''
+        Yields (sender, message) for every message forwarded to this user
+        until the client is closed
+        '''
+        while True:
+            item = await self.incoming.get()
+            if item is None:
+                return
+            yield item
+
+    def __aiter__(self):
+        return self.messages()
+
+    def handle_message(self, sender, message):
+        self.incoming.put_nowait((sender, message))
+
+    def handle_users_list(self, usernames):
+        # Presence pushes bring the roster up to date just as well
+        for waiter in self.list_waiters:
+            if not waiter.done():
+                waiter.set_result(usernames)
+        self.list_waiters.clear()
+
+    def handle_stats(self, stats):
+        LOG.info("Stats: %s", stats)
+
+    def handle_error(self, error, args):
+        # A refused join is raised by connect()
+        if error not in ("ERR_SERVER_FULL", "ERR_USERNAME_UNAVAILABLE"):
+            LOG.warning("%s: %s", error, ' '.join(args))
+
+    async def send_transfer(self, data_messages, end_message=None):
+        '''
+        Same contract as Client.send_transfer()
+        '''
+        async with self.send_lock:
+            self.last_send = time.monotonic()
+            if not self.session:
+                seq_num = await self.open_transfer()
+                if self.session_accepted:
+                    self.transfer_id = None
+                self.session = self.session_accepted
+            else:
+                seq_num = self.next_seq_num
+
+            packets = []
+            for msg in data_messages:
+                packets.append((seq_num, self.make_packet("data", seq_num, msg)))
+                seq_num += 1
+            if self.session:
+                if end_message is not None:
+                    packets.append((seq_num, self.make_packet("end", seq_num, end_message)))
+                    seq_num += 1
+                self.next_seq_num = seq_num
+                if not await self.send_reliable(packets, self.window_size):
+                    # The server did not follow, resynchronise with a new start
+                    self.session = False
+                    self.session_accepted = False
+                    return False
+                return True
+
+            delivered = await self.send_reliable(packets, self.window_size)
+            if end_message is not None:
+                end_packet = self.make_packet("end", seq_num, end_message)
+                await self.send_reliable([(seq_num, end_packet)], max_retries=None)
+            return delivered
+
+    async def open_transfer(self):
+        start_seq_num, start_packet = self.make_start_packet()
+        await self.send_reliable([(start_seq_num, start_packet)], max_retries=None)
+        return start_seq_num + 1
+
+    async def send_reliable(self, packets, window_size=1, max_retries=window.MAX_RETRIES):
+        sender = window.AsyncWindowSender(self.transport, (self.server_addr, self.server_port), self.ack_queue,
+                                          window_size, self.rtt, max_retries)
+        delivered = await sender.send(packets)
+        self.retransmissions += sender.retransmissions
+        return delivered
+
+    async def keepalive_handler(self):
+        while True:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            if time.monotonic() - self.last_send >= KEEPALIVE_INTERVAL:
+                await self.send_transfer([util.make_message("keepalive", 2)])
+
+    def transmit_ack(self, address, seqno):
+        if not self.transport.is_closing():
+            self.transport.sendto(self.make_packet("ack", seqno, ""), address)
@@ -0,0 +1,153 @@
+'''
+This module defines the asyncio engine of the Server. Packets are dispatched
+by the same Server.handle_packet(), but every reliable transfer runs as a
+coroutine on one event loop instead of a thread of its own.
+'''
+import asyncio
+import window
+import wire
+import logs
+import delack
+import presence
+import reaper
+import capture
+from server import Server
+from impairment import AsyncImpairedTransport
+
+LOG = logs.get_logger("server")
+
+# Upper bound on transfers in flight, further transfers wait for a free slot
+MAX_TRANSFERS = 4096
+
+
+class ServerProtocol(asyncio.DatagramProtocol):
+    '''
+    Hands every datagram received on the server socket to the AsyncServer.
+    '''
+    def __init__(self, server):
+        self.server = server
+
+    def connection_made(self, transport):
+        self.server.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.server.handle_packet(data, addr)
+
+    def error_received(self, exc):
+        LOG.warning("Socket error: %s", exc)
+
+
+class AsyncServer(Server):
+    '''
+    Single-threaded Server. The outbox of every client is drained by a
+    coroutine of its own, every transfer waits for its ACKs on an
+    asyncio.Queue and retransmissions are driven by event loop timers
+    instead of the FanoutSender thread.
+    '''
+    def __init__(self, dest, port, window, max_transfers=MAX_TRANSFERS):
+        super().__init__(dest, port, window)
+        self.transport = None
+        self.loop = None
+        self.max_transfers = max_transfers
+        self.transfer_slots = None
+        self.transfers = set()
+        self.stopped = None
+
+    def start(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.transfer_slots = asyncio.Semaphore(self.max_transfers)
+        self.stopped = self.loop.create_future()
+        self.delayed_acks = delack.AsyncDelayedAcks(self.send_ack, self.loop, self.ack_delay)
+        self.presence = presence.AsyncPresence(self.roster, self.push_presence, self.loop)
+        self.start_reaper()
+        await self.loop.create_datagram_endpoint(lambda: ServerProtocol(self), sock=self.sock)
+        if self.impairment:
+            self.transport = AsyncImpairedTransport(self.transport, self.impairment, self.loop)
+        if self.trace:
+            self.transport = capture.TracingSocket(self.transport, self.trace)
+        try:
+            await self.stopped
+        finally:
+            for task in list(self.transfers):
+                task.cancel()
+            self.transport.close()
+            if self.trace:
+                self.trace.close()
+
+    def start_reaper(self):
+        # Sessions are reaped on the event loop, with every other change to them
+        self.sessions = reaper.TimerWheel(self.session_timeout)
+        self.loop.call_later(self.sessions.tick, self.run_reaper)
+
+    def run_reaper(self):
+        self.reap()
+        if not self.stop_event.is_set():
+            self.loop.call_later(self.sessions.tick, self.run_reaper)
+
+    def stop(self):
+        # May be called from any thread
+        self.stop_event.set()
+        self.loop.call_soon_threadsafe(self.mark_stopped)
+        if self.trace:
+            self.trace.close()
+
+    def mark_stopped(self):
+        if not self.stopped.done():
+            self.stopped.set_result(None)
+
+    def impair(self, impairment):
+        # The transport is wrapped once the event loop is running
+        self.impairment = impairment
+
+    def record_trace(self, path):
+        # Like the impairment, the transport is wrapped once the loop runs
+        self.trace = capture.TraceWriter(path)
+
+    def send(self, packet, address):
+        self.metrics.count("out." + wire.packet_type(packet))
+        self.transport.sendto(packet, address)
+
+    def deliver(self, client_outbox):
+        # One coroutine per client with queued transfers
+        self.run_transfer(self.deliver_outbox(client_outbox))
+
+    def run_transfer(self, coroutine):
+        # Transfers are coroutines, keep a reference so they are not collected
+        task = self.loop.create_task(self.limit_transfer(coroutine))
+        self.transfers.add(task)
+        task.add_done_callback(self.transfers.discard)
+
+    async def limit_transfer(self, coroutine):
+        async with self.transfer_slots:
+            await coroutine
+
+    async def deliver_outbox(self, client_outbox):
+        transfer = client_outbox.get()
+        while transfer is not None:
+            phases, origin = transfer
+            client_outbox.done(await self.send_transfer(client_outbox.address, phases))
+            transfer = client_outbox.get()
+
+    async def send_transfer(self, address, phases):
+        # The transfer gets a queue of its own, fed only with its ACKs
+        ack_queue = asyncio.Queue()
+        acks = self.ack_dispatcher(address)
+        waiter = acks.register([seq for packets, window_size in phases for seq, packet in packets],
+                               ack_queue.put_nowait)
+        try:
+            for packets, window_size in phases:
+                if not packets:
+                    continue
+                sender = window.AsyncWindowSender(self.transport, address, ack_queue,
+                                                  window_size, self.estimator(address))
+                delivered = await sender.send(packets)
+                self.retransmissions += sender.retransmissions
+                self.metrics.count("out.retransmitted", sender.retransmissions)
+                if not delivered:
+                    return False
+            return True
+        finally:
+            acks.unregister(waiter)
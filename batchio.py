@@ -0,0 +1,177 @@
+'''
+This module moves datagrams in batches to cut the number of system calls.
+On Linux recvmmsg() and sendmmsg() are called through ctypes, elsewhere a
+batch is drained with non-blocking recvfrom_into() calls after the first
+blocking one, and sent with one sendto() per datagram.
+'''
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import struct
+import wire
+
+# Datagrams received per wakeup at most
+BATCH_SIZE = 64
+# Room for a struct sockaddr_in6, more than the sockaddr_in we use
+SOCKADDR_SIZE = 28
+MSG_WAITFORONE = 0x10000
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(iovec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+
+def load_libc():
+    # None when the platform has no recvmmsg()/sendmmsg()
+    if os.name != "posix":
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+LIBC = load_libc()
+
+
+def pack_address(address):
+    # struct sockaddr_in for an (ip, port) tuple, None for anything else
+    try:
+        ip = socket.inet_aton(address[0])
+    except (OSError, TypeError):
+        return None
+    return struct.pack("=H", socket.AF_INET) + struct.pack("!H", address[1]) + ip + bytes(8)
+
+
+def unpack_address(raw):
+    return socket.inet_ntoa(raw[4:8]), struct.unpack("!H", raw[2:4])[0]
+
+
+class BatchReceiver:
+    '''
+    Receives up to batch_size datagrams per call into preallocated buffers.
+    receive() blocks until at least one datagram arrived and returns a list
+    of (memoryview, address); the views are only valid until the next call.
+    sock must be in blocking mode, without a timeout, as the server's is.
+    '''
+    def __init__(self, sock, batch_size=BATCH_SIZE, buffer_size=wire.BUFFER_SIZE):
+        self.sock = sock
+        self.batch_size = batch_size
+        self.buffer = bytearray(batch_size * buffer_size)
+        self.views = [memoryview(self.buffer)[index * buffer_size:(index + 1) * buffer_size]
+                      for index in range(batch_size)]
+        self.stats = {"wakeups": 0, "datagrams": 0}
+        # Impairment only applies to sending, so wrapped sockets qualify too
+        self.use_mmsg = LIBC is not None
+        if self.use_mmsg:
+            self.setup_mmsg(buffer_size)
+
+    def setup_mmsg(self, buffer_size):
+        self.c_buffer = (ctypes.c_char * len(self.buffer)).from_buffer(self.buffer)
+        base = ctypes.addressof(self.c_buffer)
+        self.names = ctypes.create_string_buffer(self.batch_size * SOCKADDR_SIZE)
+        self.iovecs = (iovec * self.batch_size)()
+        self.messages = (mmsghdr * self.batch_size)()
+        for index in range(self.batch_size):
+            self.iovecs[index].iov_base = base + index * buffer_size
+            self.iovecs[index].iov_len = buffer_size
+            header = self.messages[index].msg_hdr
+            header.msg_name = ctypes.addressof(self.names) + index * SOCKADDR_SIZE
+            header.msg_iov = ctypes.pointer(self.iovecs[index])
+            header.msg_iovlen = 1
+
+    def receive(self):
+        if self.use_mmsg:
+            batch = self.receive_mmsg()
+        else:
+            batch = self.receive_drain()
+        self.stats["wakeups"] += 1
+        self.stats["datagrams"] += len(batch)
+        return batch
+
+    def receive_mmsg(self):
+        for index in range(self.batch_size):
+            self.messages[index].msg_hdr.msg_namelen = SOCKADDR_SIZE
+        while True:
+            # Blocks for the first datagram only, then takes what is queued
+            count = LIBC.recvmmsg(self.sock.fileno(), self.messages, self.batch_size, MSG_WAITFORONE, None)
+            if count >= 0:
+                break
+            error = ctypes.get_errno()
+            if error != errno.EINTR:
+                raise OSError(error, os.strerror(error))
+        names = self.names.raw
+        return [(self.views[index][:self.messages[index].msg_len],
+                 unpack_address(names[index * SOCKADDR_SIZE:(index + 1) * SOCKADDR_SIZE]))
+                for index in range(count)]
+
+    def receive_drain(self):
+        nbytes, address = self.sock.recvfrom_into(self.views[0])
+        batch = [(self.views[0][:nbytes], address)]
+        flags = getattr(socket, "MSG_DONTWAIT", None)
+        if flags is None:
+            return batch
+        while len(batch) < self.batch_size:
+            view = self.views[len(batch)]
+            try:
+                nbytes, address = self.sock.recvfrom_into(view, 0, flags)
+            except (BlockingIOError, InterruptedError):
+                break
+            batch.append((view[:nbytes], address))
+        return batch
+
+
+def send_batch(sock, packets):
+    '''
+    Sends every (data, address) of packets, with one sendmmsg() call where
+    possible. Sockets wrapped by an ImpairedSocket or a TracingSocket and
+    unresolved addresses take the sendto() path so they keep their semantics.
+    '''
+    if len(packets) > 1 and LIBC is not None and isinstance(sock, socket.socket):
+        names = [pack_address(address) for data, address in packets]
+        if None not in names:
+            send_mmsg(sock, packets, names)
+            return
+    for data, address in packets:
+        sock.sendto(data, address)
+
+
+def send_mmsg(sock, packets, names):
+    count = len(packets)
+    buffers = [ctypes.create_string_buffer(bytes(data), len(data)) for data, address in packets]
+    name_buffers = [ctypes.create_string_buffer(name, len(name)) for name in names]
+    iovecs = (iovec * count)()
+    messages = (mmsghdr * count)()
+    for index in range(count):
+        iovecs[index].iov_base = ctypes.addressof(buffers[index])
+        iovecs[index].iov_len = len(packets[index][0])
+        header = messages[index].msg_hdr
+        header.msg_name = ctypes.addressof(name_buffers[index])
+        header.msg_namelen = len(names[index])
+        header.msg_iov = ctypes.pointer(iovecs[index])
+        header.msg_iovlen = 1
+    sent = 0
+    while sent < count:
+        result = LIBC.sendmmsg(sock.fileno(), ctypes.byref(messages[sent]), count - sent, 0)
+        if result < 0:
+            error = ctypes.get_errno()
+            if error == errno.EINTR:
+                continue
+            raise OSError(error, os.strerror(error))
+        sent += result
@@ -0,0 +1,324 @@
+'''
+This module is a headless load generator for the chat system. It starts a
+Server on localhost, drives simulated Client sessions through their
+programmatic API and prints throughput, latency and retransmission figures
+as JSON so results can be compared between versions.
+'''
+import getopt
+import json
+import math
+import sys
+import threading
+import time
+from server import Server
+from client import Client
+from impairment import Impairment
+
+WORKLOADS = ("chat", "broadcast", "large", "churn", "list")
+
+
+def percentile(values, pct):
+    '''
+    Nearest-rank percentile of values, None when there are no values
+    '''
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+class BenchClient(Client):
+    '''
+    Client reporting what it receives to the Benchmark instead of printing it
+    '''
+    def __init__(self, bench, username, impairment=None):
+        super().__init__(username, "localhost", bench.port, bench.window, impairment=impairment,
+                         compression=bench.compression)
+        self.bench = bench
+        self.list_sent_at = []
+
+    def handle_message(self, sender, message):
+        self.bench.record_delivery(message)
+
+    def handle_users_list(self, usernames):
+        if self.list_sent_at:
+            self.bench.record_latency(time.monotonic() - self.list_sent_at.pop(0))
+
+    def list_users(self):
+        self.list_sent_at.append(time.monotonic())
+        super().list_users()
+
+
+class Benchmark:
+    '''
+    Runs one workload against an in-process Server:
+
+    chat       every client sends `count` messages to the next client
+    broadcast  every client sends `count` messages to the next `recipients` clients
+    large      like chat with `size` byte messages spanning many chunks
+    churn      `clients` workers join and quit `count` times each
+    list       every client requests the user list `count` times
+    '''
+    def __init__(self, workload, clients=10, count=100, recipients=5, size=64,
+                 port=15100, window=3, mode="thread", drain_timeout=10, impairment=None, workers=None,
+                 compression=True, trace_file=None):
+        self.workload = workload
+        self.num_clients = clients
+        self.count = count
+        self.recipients = min(recipients, clients - 1)
+        self.size = size
+        self.port = port
+        self.window = window
+        self.mode = mode
+        self.workers = workers
+        # The filler text compresses extremely well, turn it off for raw figures
+        self.compression = compression
+        # Record the datagrams of the server for replay.py
+        self.trace_file = trace_file
+        self.drain_timeout = drain_timeout
+        # Applied to the server and, with a seed of their own, to every client
+        self.impairment = impairment
+        self.connections = 0
+
+        self.server = None
+        self.clients = []
+        self.lock = threading.Lock()
+        self.sent_at = {}
+        self.latencies = []
+        self.expected = 0
+        self.completed = 0
+        self.done = threading.Event()
+
+    def start_server(self):
+        if self.mode == "async":
+            from async_server import AsyncServer
+            self.server = AsyncServer("localhost", self.port, self.window)
+        elif self.mode == "workers":
+            from workers import WorkerPool
+            self.server = WorkerPool("localhost", self.port, self.window, self.workers)
+        else:
+            self.server = Server("localhost", self.port, self.window)
+        # Room for every simulated client and churn worker
+        self.server.max_clients = 2 * self.num_clients
+        if self.impairment:
+            self.server.impair(self.impairment)
+        if self.trace_file:
+            self.server.record_trace(self.trace_file)
+        server_thread = threading.Thread(target=self.server.start)
+        server_thread.daemon = True
+        server_thread.start()
+
+    def connect(self, username):
+        impairment = None
+        if self.impairment:
+            self.connections += 1
+            seed = None if self.impairment.seed is None else self.impairment.seed + self.connections
+            impairment = self.impairment.with_seed(seed)
+        client = BenchClient(self, username, impairment)
+        receive_thread = threading.Thread(target=client.receive_handler)
+        receive_thread.daemon = True
+        receive_thread.start()
+        client.join()
+        return client
+
+    def record_latency(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.completed += 1
+            if self.completed >= self.expected:
+                self.done.set()
+
+    def record_delivery(self, message):
+        # Messages start with b<id>, the id maps to the time it was sent
+        try:
+            msg_id = int(message.split(" ", 1)[0][1:])
+        except ValueError:
+            return
+        sent_at = self.sent_at.get(msg_id)
+        if sent_at is not None:
+            self.record_latency(time.monotonic() - sent_at)
+
+    def send(self, client, recipients, msg_id):
+        text = f"b{msg_id} " + "x" * self.size
+        self.sent_at[msg_id] = time.monotonic()
+        client.send_message(f"msg {len(recipients)} {' '.join(recipients)} {text}")
+
+    def message_worker(self, index):
+        client = self.clients[index]
+        fanout = self.recipients if self.workload == "broadcast" else 1
+        recipients = [self.clients[(index + offset) % self.num_clients].name for offset in range(1, fanout + 1)]
+        for number in range(self.count):
+            self.send(client, recipients, index * self.count + number)
+
+    def list_worker(self, index):
+        for number in range(self.count):
+            self.clients[index].list_users()
+
+    def churn_worker(self, index):
+        for number in range(self.count):
+            started_at = time.monotonic()
+            client = self.connect(f"churn{index}_{number}")
+            client.quit()
+            self.record_latency(time.monotonic() - started_at)
+
+    def run(self):
+        '''
+        Runs the workload and returns the results as a dict
+        '''
+        self.start_server()
+        if self.workload != "churn":
+            for index in range(self.num_clients):
+                self.clients.append(self.connect(f"user{index}"))
+
+        if self.workload in ("chat", "large"):
+            worker, self.expected = self.message_worker, self.num_clients * self.count
+        elif self.workload == "broadcast":
+            worker, self.expected = self.message_worker, self.num_clients * self.count * self.recipients
+        elif self.workload == "list":
+            worker, self.expected = self.list_worker, self.num_clients * self.count
+        else:
+            worker, self.expected = self.churn_worker, self.num_clients * self.count
+
+        started_at = time.monotonic()
+        workers = [threading.Thread(target=worker, args=(index,)) for index in range(self.num_clients)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        # Give in-flight forwards a chance to land
+        self.done.wait(self.drain_timeout)
+        duration = time.monotonic() - started_at
+
+        for client in self.clients:
+            client.quit()
+        self.server.stop()
+
+        latencies_ms = [latency * 1000 for latency in self.latencies]
+        return {
+            "workload": self.workload,
+            "mode": self.mode,
+            "clients": self.num_clients,
+            "count": self.count,
+            "recipients": self.recipients if self.workload == "broadcast" else 1,
+            "size": self.size,
+            "window": self.window,
+            "compression": self.compression,
+            "expected": self.expected,
+            "completed": self.completed,
+            "lost": self.expected - self.completed,
+            "duration_s": duration,
+            "ops_per_sec": self.completed / duration if duration else None,
+            "latency_ms": {
+                "p50": percentile(latencies_ms, 50),
+                "p95": percentile(latencies_ms, 95),
+                "p99": percentile(latencies_ms, 99),
+                "max": max(latencies_ms) if latencies_ms else None,
+            },
+            "retransmissions": {
+                "clients": sum(client.retransmissions for client in self.clients),
+                "server": getattr(self.server, "retransmissions", None),
+            },
+            # Worker processes keep their counters to themselves
+            "acks": self.server.ack_stats() if self.mode != "workers" else None,
+            "outbox": self.server.outbox_stats() if self.mode != "workers" else None,
+            "delayed_acks": {
+                "clients": self.sum_stats([client.delayed_acks.stats for client in self.clients]),
+                "server": dict(self.server.delayed_acks.stats) if self.mode != "workers" else None,
+            },
+            # Datagrams received per wakeup of the batched receive loop
+            "io": dict(self.server.receiver.stats) if getattr(self.server, "receiver", None) else None,
+            "impairment": self.impairment_stats(),
+            # Per-stage latency of the server's packet handling and ACK RTTs
+            "histograms": self.server.metrics.snapshot()["histograms"] if self.mode != "workers" else None,
+        }
+
+    def sum_stats(self, stats):
+        totals = {}
+        for counters in stats:
+            for name, value in counters.items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def impairment_stats(self):
+        if not self.impairment:
+            return None
+        sockets = [client.sock for client in self.clients]
+        if self.mode == "async":
+            sockets.append(self.server.transport)
+        elif self.mode != "workers":
+            sockets.append(self.server.sock)
+        return self.sum_stats([getattr(sock, "stats", {}) for sock in sockets])
+
+
+if __name__ == "__main__":
+    def helper():
+        print("Benchmark")
+        print("-s WORKLOAD | --workload=WORKLOAD One of " + ", ".join(WORKLOADS) + ", defaults to chat")
+        print("-n CLIENTS | --clients=CLIENTS Number of simulated clients, defaults to 10")
+        print("-c COUNT | --count=COUNT Operations per client, defaults to 100")
+        print("-k RECIPIENTS | --recipients=RECIPIENTS Recipients per broadcast, defaults to 5")
+        print("-b BYTES | --size=BYTES Message size, defaults to 64 (20000 for large)")
+        print("-p PORT | --port=PORT The server port, defaults to 15100")
+        print("-w WINDOW | --window=WINDOW The window size, defaults to 3")
+        print("-m MODE | --mode=MODE thread, async or workers, defaults to thread")
+        print("-W WORKERS | --workers=WORKERS Server processes in workers mode, defaults to the number of cores")
+        print("-i SPEC | --impair=SPEC Simulate an impaired network, e.g. loss=0.05,delay=0.02,seed=1")
+        print("-Z | --no-compression Clients do not offer compression")
+        print("-T FILE | --trace=FILE Record the datagrams of the server to FILE, see replay.py")
+        print("-o FILE | --output=FILE Also write the JSON results to FILE")
+        print("-h | --help Print this help")
+
+    try:
+        OPTS, ARGS = getopt.getopt(sys.argv[1:], "s:n:c:k:b:p:w:m:W:i:ZT:o:h",
+                                   ["workload=", "clients=", "count=", "recipients=", "size=",
+                                    "port=", "window=", "mode=", "workers=", "impair=", "no-compression", "trace=", "output=",
+                                    "help"])
+    except getopt.GetoptError:
+        helper()
+        exit(1)
+
+    WORKLOAD = "chat"
+    OPTIONS = {}
+    OUTPUT = None
+    for o, a in OPTS:
+        if o in ("-s", "--workload"):
+            WORKLOAD = a
+        elif o in ("-n", "--clients"):
+            OPTIONS["clients"] = int(a)
+        elif o in ("-c", "--count"):
+            OPTIONS["count"] = int(a)
+        elif o in ("-k", "--recipients"):
+            OPTIONS["recipients"] = int(a)
+        elif o in ("-b", "--size"):
+            OPTIONS["size"] = int(a)
+        elif o in ("-p", "--port"):
+            OPTIONS["port"] = int(a)
+        elif o in ("-w", "--window"):
+            OPTIONS["window"] = int(a)
+        elif o in ("-m", "--mode"):
+            OPTIONS["mode"] = a
+        elif o in ("-W", "--workers"):
+            OPTIONS["workers"] = int(a)
+        elif o in ("-i", "--impair"):
+            OPTIONS["impairment"] = Impairment.parse(a)
+        elif o in ("-Z", "--no-compression"):
+            OPTIONS["compression"] = False
+        elif o in ("-T", "--trace"):
+            OPTIONS["trace_file"] = a
+        elif o in ("-o", "--output"):
+            OUTPUT = a
+        elif o in ("-h", "--help"):
+            helper()
+            exit()
+
+    if WORKLOAD not in WORKLOADS:
+        helper()
+        exit(1)
+    if WORKLOAD == "large":
+        OPTIONS.setdefault("size", 20000)
+
+    RESULTS = Benchmark(WORKLOAD, **OPTIONS).run()
+    print(json.dumps(RESULTS, indent=2))
+    if OUTPUT:
+        with open(OUTPUT, "w") as f:
+            json.dump(RESULTS, f, indent=2)
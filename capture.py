@@ -0,0 +1,111 @@
+'''
+This module records the datagrams a Server receives and sends to a trace
+file, for replay.py to play them back against another Server later.
+
+A trace starts with MAGIC and the wall clock time it was started at, as a
+double. Every datagram follows as a record header
+
+    microseconds since the start (8 bytes), direction (1 byte),
+    IP version of the peer (1 byte), address of the peer (16 bytes),
+    port of the peer (2 bytes), length (2 bytes)
+
+and the raw bytes of the datagram. IPv4 addresses take the first 4 bytes of
+the address field. The flow info and scope ID of IPv6 peers are not kept,
+nor the zone of a link-local address, so they read back as (host, port).
+'''
+import socket
+import struct
+import threading
+import time
+
+MAGIC = b"CHATTRC2"
+START = struct.Struct("!d")
+RECORD = struct.Struct("!QBB16sHH")
+# Directions, as seen from the Server
+RECEIVED = 0
+SENT = 1
+FAMILIES = {4: socket.AF_INET, 6: socket.AF_INET6}
+
+
+def pack_host(host):
+    '''
+    Returns the IP version and the packed form of host, an IPv4 or IPv6 address
+    '''
+    host = host.split("%")[0]
+    if ":" in host:
+        return 6, socket.inet_pton(socket.AF_INET6, host)
+    return 4, socket.inet_pton(socket.AF_INET, host)
+
+
+def unpack_host(version, packed):
+    size = 4 if version == 4 else 16
+    return socket.inet_ntop(FAMILIES[version], packed[:size])
+
+
+class TraceWriter:
+    '''
+    Appends records to the trace file at path. Safe to use from any thread.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "wb")
+        self.started = time.monotonic()
+        self.file.write(MAGIC + START.pack(time.time()))
+        self.stats = {"received": 0, "sent": 0, "bytes": 0}
+
+    def record(self, direction, address, data):
+        version, host = pack_host(address[0])
+        with self.lock:
+            if self.file.closed:
+                return
+            offset = int((time.monotonic() - self.started) * 1e6)
+            self.file.write(RECORD.pack(offset, direction, version, host, address[1], len(data)))
+            self.file.write(data)
+            self.stats["sent" if direction == SENT else "received"] += 1
+            self.stats["bytes"] += RECORD.size + len(data)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class TracingSocket:
+    '''
+    Wraps anything with a sendto(data, address) method, a socket or a
+    datagram transport, and records every datagram sent through it.
+    Everything but sendto() is delegated to the wrapped socket.
+    '''
+    def __init__(self, sock, writer):
+        self.sock = sock
+        self.writer = writer
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def sendto(self, data, address):
+        self.writer.record(SENT, address, data)
+        return self.sock.sendto(data, address)
+
+
+def read_trace(path):
+    '''
+    Returns (started, records) of the trace at path, records being
+    (seconds since the start, direction, (host, port), data) tuples. A
+    record cut short at the end of the file is left out.
+    '''
+    with open(path, "rb") as trace_file:
+        content = trace_file.read()
+    if not content.startswith(MAGIC):
+        raise ValueError(f"{path} is not a trace")
+    (started,) = START.unpack_from(content, len(MAGIC))
+    records = []
+    offset = len(MAGIC) + START.size
+    while offset + RECORD.size <= len(content):
+        microseconds, direction, version, host, port, length = RECORD.unpack_from(content, offset)
+        offset += RECORD.size
+        if offset + length > len(content):
+            break
+        records.append((microseconds / 1e6, direction, (unpack_host(version, host), port), content[offset:offset + length]))
+        offset += length
+    return started, records
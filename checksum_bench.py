@@ -0,0 +1,79 @@
+'''
+This module is a micro-benchmark of packet checksumming. For payloads of
+typical chunk sizes it times building and validating a packet the way
+util.py does it, on decoded strings, against wire.py, which checksums the
+raw bytes, and framing one forwarded payload for many recipients with a
+fresh checksum each time against a shared wire.Payload. Results are
+printed as JSON, in microseconds per packet.
+'''
+import getopt
+import json
+import sys
+import timeit
+import util
+import wire
+
+# A short chat line, a typical chunk and a chunk filling the path MTU
+SIZES = (64, 512, wire.payload_size(wire.PATH_MTU, True))
+RECIPIENTS = 200
+
+
+def util_validate(packet):
+    # What parse_packet() did before: decode, then checksum the string again
+    return util.validate_checksum(str(packet, "utf-8", "replace"))
+
+
+def time_per_call(statement, number):
+    # Best of three, in microseconds per call
+    return min(timeit.repeat(statement, number=number, repeat=3)) / number * 1e6
+
+
+def run(sizes=SIZES, recipients=RECIPIENTS, number=20000):
+    results = {}
+    for size in sizes:
+        msg = util.make_message("forward_message", 4, "sender " + "x" * size)
+        text_packet = util.make_packet("data", 1, msg).encode()
+        binary_packet = wire.make_packet("data", 1, msg, True)
+        payload = wire.Payload(msg)
+        results[size] = {
+            "text_validate_util_us": time_per_call(lambda: util_validate(text_packet), number),
+            "text_validate_bytes_us": time_per_call(lambda: wire.validate_text_checksum(text_packet), number),
+            "binary_parse_us": time_per_call(lambda: wire.parse_packet(binary_packet), number),
+            "binary_make_us": time_per_call(lambda: wire.make_packet("data", 1, msg, True), number),
+            "binary_make_shared_payload_us": time_per_call(lambda: wire.make_packet("data", 1, payload, True), number),
+            f"fanout_{recipients}_us": time_per_call(
+                lambda: [wire.make_packet("data", seq, msg, True) for seq in range(recipients)], number // recipients),
+            f"fanout_{recipients}_shared_payload_us": time_per_call(
+                lambda: [wire.make_packet("data", seq, wire.Payload(msg) if seq == 0 else payload, True)
+                         for seq in range(recipients)], number // recipients),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    def helper():
+        print("Checksum benchmark")
+        print("-b SIZES | --sizes=SIZES Comma separated payload sizes, defaults to " + ",".join(map(str, SIZES)))
+        print("-k RECIPIENTS | --recipients=RECIPIENTS Recipients of the fan-out case, defaults to " + str(RECIPIENTS))
+        print("-n NUMBER | --number=NUMBER Calls timed per case, defaults to 20000")
+        print("-h | --help Print this help")
+
+    try:
+        OPTS, ARGS = getopt.getopt(sys.argv[1:], "b:k:n:h", ["sizes=", "recipients=", "number=", "help"])
+    except getopt.GetoptError:
+        helper()
+        exit(1)
+
+    OPTIONS = {}
+    for o, a in OPTS:
+        if o in ("-b", "--sizes"):
+            OPTIONS["sizes"] = [int(size) for size in a.split(",")]
+        elif o in ("-k", "--recipients"):
+            OPTIONS["recipients"] = int(a)
+        elif o in ("-n", "--number"):
+            OPTIONS["number"] = int(a)
+        elif o in ("-h", "--help"):
+            helper()
+            exit()
+
+    print(json.dumps(run(**OPTIONS), indent=2))
@@ -1,18 +1,29 @@
 '''
 This module defines the behaviour of a client in your Chat Application
 '''
+import json
 import queue
-import signal
 import sys
 import getopt
 import socket
 import random
 from threading import Thread
-import os
 import threading
 import time
 import util
-
+import window
+import wire
+import rtt
+import delack
+import codec
+import reorder
+import rooms
+from impairment import Impairment, ImpairedSocket
+
+# Seconds of silence after which the client keeps its session alive
+KEEPALIVE_INTERVAL = 15
+# Errors the server reports after the fact, with what they refer to
+ERRORS = ("ERR_RECIPIENT_BUSY", "ERR_MESSAGE_TOO_LARGE", "ERR_NO_SUCH_ROOM", "ERR_ROOM_EXISTS", "ERR_NOT_IN_ROOM")
 
 '''
 Write your code inside this class. 
@@ -25,16 +36,51 @@ class Client:
     '''
     This is the main Client Class. 
     '''
-    def __init__(self, username, dest, port, window_size):
+    def __init__(self, username, dest, port, window_size, binary=True, session=True, impairment=None,
+                 ack_delay=delack.ACK_DELAY, mtu=wire.PATH_MTU, compression=True):
         self.server_addr = dest
         self.server_port = port
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.settimeout(None)
-        self.sock.bind(('', random.randint(10000, 40000)))
+        # Let the OS pick a free port, many clients may share one host
+        self.sock.bind(('', 0))
+        if impairment:
+            # Route every outgoing packet through the network impairment simulator
+            self.sock = ImpairedSocket(self.sock, impairment)
         self.name = username
+        self.window_size = int(window_size)
+        self.mtu = mtu
         self.stop_event = threading.Event()
         self.ack_queue = queue.Queue()
-        self.message_chunks = {}
+        # The server sends its transfers one after the other, each is
+        # reassembled under its ID, the sequence number of its start packet
+        self.receiver = reorder.ReorderBuffer()
+        self.transfer_id = None
+        self.transfer = None
+        # The server's roster as of roster_version, list requests only ask
+        # for the joins and leaves since then
+        self.roster = set()
+        self.roster_version = 0
+        # binary is only switched on once the server accepted the offer
+        self.offer_binary = binary
+        self.binary = False
+        # Adaptive retransmission timeout towards the server
+        self.rtt = rtt.RttEstimator()
+        # Persistent session: one start handshake, then a continuing sequence space
+        self.offer_session = session
+        self.session_accepted = False
+        self.session = False
+        self.next_seq_num = 0
+        # Compressed messages, only switched on once the server accepted
+        self.offer_compression = compression
+        self.compression = False
+        self.send_lock = threading.Lock()
+        self.last_send = time.monotonic()
+        # Set when the server refused the join
+        self.join_error = None
+        self.retransmissions = 0
+        # Forwarded chunks are acknowledged in pairs
+        self.delayed_acks = delack.DelayedAcks(self.transmit_ack, ack_delay)
 
     
     
@@ -45,52 +91,13 @@ class Client:
         Use make_message() and make_util() functions from util.py to make your first join packet
         Waits for userinput and then process it
         '''
-        start_seq_num = random.randint(1, 1000)
-        start_packet = util.make_packet("start", start_seq_num, "")
-        self.sock.sendto(start_packet.encode(), (self.server_addr, self.server_port))
-
-        ack_received = False
-        while not ack_received:
-            try:
-                ack = self.ack_queue.get(timeout=util.TIME_OUT)  # Convert to seconds
-                if ack == start_seq_num:
-                    ack_received = True
-            except queue.Empty:
-                # Handle timeout by retransmitting the START packet
-                self.sock.sendto(start_packet.encode(), (self.server_addr, self.server_port))
-
+        if not self.join():
+            # Refused or unanswered, the user has to pick another username
+            # or try again later
+            self.stop_event.set()
+            self.sock.close()
+            return
 
-        seq_num = start_seq_num + 1
-        join_message = util.make_message("join", 1, self.name)
-        packet = util.make_packet("data",seq_num,join_message)
-        ack_received = False
-        retries = 0
-        while not ack_received and retries < 3:  # Retry up to 3 times
-            try:
-                ack = self.ack_queue.get(timeout=util.TIME_OUT)
-                if ack == seq_num:
-                    ack_received = True
-            except queue.Empty:
-                # Handle timeout by retransmitting the packet
-                self.sock.sendto(packet.encode(), (self.server_addr, self.server_port))
-                retries += 1
-        if not ack_received:
-            print(f"Failed to receive ACK for packet {seq_num}. Retries exhausted.")
-
-        # Send end packet
-        end_packet = util.make_packet("end", seq_num + 1, join_message)
-        self.sock.sendto(end_packet.encode(), (self.server_addr, self.server_port))
-
-        ack_received = False
-        while not ack_received:
-            try:
-                ack = self.ack_queue.get(timeout=util.TIME_OUT)  # Convert to seconds
-                if ack == seq_num+1:
-                    ack_received = True
-            except queue.Empty:
-                self.sock.sendto(end_packet.encode(), (self.server_addr, self.server_port))
-        # Send the join message to the server
-        
         try:
           while True:
                 user_input = input("")
@@ -101,62 +108,22 @@ class Client:
                 elif user_input.lower() == "list":
                     self.list_users()
 
+                elif user_input.lower() == "subscribe":
+                    self.subscribe_presence()
+
+                elif user_input.lower().startswith(("create ", "join ", "leave ")):
+                    command, room = user_input.split(None, 1)
+                    getattr(self, command.lower() + "_room")(room.strip())
+
+                elif user_input.lower() == "stats":
+                    self.request_stats()
+
                 elif user_input.lower() == "help":
                     self.print_help()
 
                 elif user_input.lower() == "quit":
-                    disconnect_message = util.make_message("disconnect", 1, self.name)
-                    start_seq_num = random.randint(1, 1000)  # Generate a random sequence number
-                    start_packet = util.make_packet("start", start_seq_num, "")
-                    self.sock.sendto(start_packet.encode(), (self.server_addr, self.server_port))
-
-                    ack_received = False
-                    while not ack_received:
-                        try:
-                            ack = self.ack_queue.get(timeout=util.TIME_OUT)  # Convert to seconds
-                            if ack == start_seq_num:
-                                ack_received = True
-                        except queue.Empty:
-                            # Handle timeout by retransmitting the START packet
-                            self.sock.sendto(start_packet.encode(), (self.server_addr, self.server_port))
-
-                    # Send disconnect message packet
-                    seq_num = start_seq_num + 1
-                    packet = util.make_packet("data", seq_num, disconnect_message)
-                    self.sock.sendto(packet.encode(), (self.server_addr, self.server_port))
-
-                    # Wait for ACK or handle retransmission
-                    ack_received = False
-                    retries = 0
-                    while not ack_received and retries < 3:  # Retry up to 3 times
-                        try:
-                            # Get the ACK from the queue with a timeout
-                            ack = self.ack_queue.get(timeout=util.TIME_OUT)
-                            if ack == seq_num:
-                                ack_received = True
-                        except queue.Empty:
-                            # Handle timeout by retransmitting the packet
-                            self.sock.sendto(packet.encode(), (self.server_addr, self.server_port))
-                            retries += 1
-                    if not ack_received:
-                        print(f"Failed to receive ACK for packet {seq_num}. Retries exhausted.")
-
-                    # Send end packet
-                    end_packet = util.make_packet("end", seq_num + 1, packet)
-                    self.sock.sendto(end_packet.encode(), (self.server_addr, self.server_port))
-
-                    ack_received = False
-                    while not ack_received:
-                        try:
-                            ack = self.ack_queue.get(timeout=util.TIME_OUT)  # Convert to seconds
-                            if ack == seq_num+1:
-                                ack_received = True
-                        except queue.Empty:
-                            self.sock.sendto(end_packet.encode(), (self.server_addr, self.server_port))
-
+                    self.quit()
                     print("quitting")
-                    self.stop_event.set()  # Set the stop event before closing the socket
-                    self.sock.close()
                     break
                 else:
                     print("incorrect userinput format")
@@ -168,61 +135,212 @@ class Client:
         finally:
             self.sock.close()
 
+    def join(self):
+        '''
+        Sends the join message to the server and, once the server accepted
+        the username, starts the keepalive thread. Returns whether it did.
+        '''
+        self.join_error = None
+        # Transfer IDs of an earlier server must not hide those of this one
+        self.transfer_id = None
+        join_message = util.make_message("join", 1, self.name)
+        if not self.send_transfer([join_message], join_message) or self.join_error:
+            return False
+
+        # Keep the session open while the user is idle
+        keepalive_thread = Thread(target=self.keepalive_handler)
+        keepalive_thread.daemon = True
+        keepalive_thread.start()
+        return True
+
+    def quit(self):
+        '''
+        Sends the disconnect message to the server and closes the socket
+        '''
+        disconnect_message = util.make_message("disconnect", 1, self.name)
+        self.send_transfer([disconnect_message], disconnect_message)
+        self.stop_event.set()  # Set the stop event before closing the socket
+        self.sock.close()
+
+    def handle_message(self, sender, message):
+        '''
+        Called with every complete message forwarded by the server
+        '''
+        print(f"msg: {sender}: {message}")
+
+    def handle_users_list(self, usernames):
+        '''
+        Called with the usernames of every list response and presence push
+        '''
+        print("list:", ' '.join(usernames))
+
+    def apply_users_list(self, changes, header):
+        # Called at the end of a list response with its [version, kind]
+        if len(header) < 2 or not header[0].isdigit():
+            return
+        if header[1] == "full":
+            self.roster = set(changes)
+        else:
+            for change in changes:
+                if change[:1] == "+":
+                    self.roster.add(change[1:])
+                else:
+                    self.roster.discard(change[1:])
+        self.roster_version = int(header[0])
+        self.handle_users_list(sorted(self.roster))
+
+    def handle_stats(self, stats):
+        '''
+        Called with the metrics snapshot the server sent for request_stats()
+        '''
+        print(json.dumps(stats, indent=2))
+
+    def handle_error(self, error, args):
+        '''
+        Called with the errors the server reports after the fact
+        '''
+        if error == "ERR_RECIPIENT_BUSY":
+            print(f"Message to {' '.join(args)} was not delivered: recipient is busy")
+        elif error == "ERR_MESSAGE_TOO_LARGE":
+            print(f"Message was not delivered: longer than {' '.join(args)} bytes")
+        elif error == "ERR_NO_SUCH_ROOM":
+            print(f"There is no room {' '.join(args)}")
+        elif error == "ERR_ROOM_EXISTS":
+            print(f"Room {' '.join(args)} exists already, join it instead")
+        elif error == "ERR_NOT_IN_ROOM":
+            print(f"You are not in room {' '.join(args)}")
+        elif error == "ERR_SERVER_FULL":
+            print("Server is full, please try again later.")
+        elif error == "ERR_USERNAME_UNAVAILABLE":
+            print("Username is not available, please choose a different one.")
+
+    def open_transfer(self):
+        '''
+        Runs the start handshake and returns the first sequence number of
+        the transfer
+        '''
+        start_seq_num, start_packet = self.make_start_packet()
+        # Keep retrying until the server answers
+        self.send_reliable([(start_seq_num, start_packet)], max_retries=None)
+        return start_seq_num + 1
+
+    def make_start_packet(self):
+        '''
+        Returns (seqno, packet) of a start packet. The binary format, a
+        persistent session and compression are offered, the server accepts
+        by echoing the offers in its ACK.
+        '''
+        offers = []
+        if self.offer_binary:
+            offers.append(wire.BINARY_OFFER)
+        if self.offer_session:
+            offers.append(wire.SESSION_OFFER)
+        if self.offer_compression:
+            offers.append(wire.ZLIB_OFFER)
+        start_seq_num = random.randint(1, 1000)  # Generate a random sequence number
+        return start_seq_num, self.make_packet("start", start_seq_num, ' '.join(offers))
+
+    def send_transfer(self, data_messages, end_message=None):
+        '''
+        Sends the data messages of one command followed by its end packet.
+        Inside a session they continue the sequence space of the previous
+        command and go out in a single window without any handshake, the
+        id of a message is the sequence number of its first packet.
+        Otherwise every command opens its own start/data/end exchange.
+        '''
+        with self.send_lock:
+            self.last_send = time.monotonic()
+            if not self.session:
+                seq_num = self.open_transfer()
+                if self.session_accepted:
+                    # A new session, the server may have restarted and
+                    # number its transfers afresh
+                    self.transfer_id = None
+                self.session = self.session_accepted
+            else:
+                seq_num = self.next_seq_num
+
+            packets = []
+            for msg in data_messages:
+                packets.append((seq_num, self.make_packet("data", seq_num, msg)))
+                seq_num += 1
+            if self.session:
+                if end_message is not None:
+                    packets.append((seq_num, self.make_packet("end", seq_num, end_message)))
+                    seq_num += 1
+                self.next_seq_num = seq_num
+                if not self.send_reliable(packets, self.window_size):
+                    # The server did not follow, resynchronise with a new start
+                    self.session = False
+                    self.session_accepted = False
+                    return False
+                return True
+
+            delivered = self.send_reliable(packets, self.window_size)
+            if end_message is not None:
+                end_packet = self.make_packet("end", seq_num, end_message)
+                self.send_reliable([(seq_num, end_packet)], max_retries=None)
+            return delivered
+
+    def keepalive_handler(self):
+        '''
+        Sends a keepalive whenever the client was idle for KEEPALIVE_INTERVAL,
+        the server reaps the sessions of clients it no longer hears from
+        '''
+        while not self.stop_event.wait(KEEPALIVE_INTERVAL):
+            if time.monotonic() - self.last_send < KEEPALIVE_INTERVAL:
+                continue
+            try:
+                self.send_transfer([util.make_message("keepalive", 2)])
+            except OSError:
+                break
+
+    def send_reliable(self, packets, window_size=1, max_retries=window.MAX_RETRIES):
+        '''
+        Sends packets to the server through the sliding window, timed by the
+        RTT estimate of the server
+        '''
+        sender = window.WindowSender(self.sock, (self.server_addr, self.server_port), self.ack_queue,
+                                     window_size, self.rtt, max_retries)
+        delivered = sender.send(packets)
+        self.retransmissions += sender.retransmissions
+        return delivered
+
+    def make_packet(self, msg_type, seqno, msg):
+        '''
+        Returns the encoded packet in the format negotiated with the server
+        '''
+        return wire.make_packet(msg_type, seqno, msg, self.binary)
+
+    def send_ack(self, seqno):
+        '''
+        Acknowledges seqno right away, which covers any ACK held back
+        '''
+        server_address = (self.server_addr, self.server_port)
+        self.delayed_acks.cancel(server_address)
+        self.transmit_ack(server_address, seqno)
+
+    def transmit_ack(self, address, seqno):
+        try:
+            self.sock.sendto(self.make_packet("ack", seqno, ""), address)
+        except OSError:
+            # The delayed ACK timer fired after quit() closed the socket
+            pass
+
     def receive_handler(self):
         '''
         Waits for a message from server and process it accordingly
         '''
+        # Receive into one preallocated buffer, packets are parsed in place
+        buffer = bytearray(wire.BUFFER_SIZE)
+        view = memoryview(buffer)
         while not self.stop_event.is_set():
             try:
                 # Receive messages from the server
-                data, server_address = self.sock.recvfrom(2048)
-                if not data:
+                nbytes, server_address = self.sock.recvfrom_into(buffer)
+                if not nbytes:
                     break
-                #print(f"Received data from {server_address}: {data.decode()}")
-                decoded_data = data.decode()
-                typeofP, seqno, data, checksum = util.parse_packet(decoded_data)
-                if typeofP == "ack":
-                    # Put the received ACK into the queue
-                    self.ack_queue.put(int(seqno))
-                elif typeofP == "start":
-                    ack_packet = util.make_packet("ack", int(seqno), "")
-                    self.sock.sendto(ack_packet.encode(), (self.server_addr, self.server_port))
-                elif typeofP == "end":
-                    if(parts[0]== "forward_message"):
-                        for sender, chunks in self.message_chunks.items():
-                            concatenated_message = ''.join(chunks)
-                            print(f"msg: {sender}: {concatenated_message}")
-                    self.message_chunks.clear()
-                    ack_packet = util.make_packet("ack", int(seqno), "")
-                    self.sock.sendto(ack_packet.encode(), (self.server_addr, self.server_port))
-                elif typeofP == "data":
-                    parts = data.split()
-                    if len(parts) >= 2:
-                        msg_type = parts[0]
-                        msg_len = int(parts[1])
-
-                        if msg_type == "response_users_list":
-                            ack_packet = util.make_packet("ack", int(seqno), "")
-                            self.sock.sendto(ack_packet.encode(), (self.server_addr, self.server_port))
-                            usernames = ' '.join(parts[4:])
-                            print("list:", usernames)
-                        elif msg_type == "forward_message":
-                            sender_username = parts[2]
-                            message_chunk = ' '.join(parts[3:])
-
-                            # Add the message chunk to the dictionary
-                            if sender_username in self.message_chunks:
-                                self.message_chunks[sender_username].append(message_chunk)
-                            else:
-                                self.message_chunks[sender_username] = [message_chunk]
-
-                            # print(f"Received chunk from {sender_username}: {message_chunk}")
-                            ack_packet = util.make_packet("ack", int(seqno), "")
-                            self.sock.sendto(ack_packet.encode(), (self.server_addr, self.server_port))
-                        elif msg_type == "ERR_SERVER_FULL":
-                            print("Server is full, please try again later.")
-                        elif msg_type == "ERR_USERNAME_UNAVAILABLE":
-                            print("Username is not available, please choose a different one.")
+                self.handle_packet(view[:nbytes])
             except socket.timeout:
                 # Handle timeout (if needed)
                 pass
@@ -231,130 +349,184 @@ class Client:
                     break
 
 
+    def handle_packet(self, packet):
+        '''
+        Processes one datagram received from the server
+        '''
+        typeofP, seqno, data, valid = wire.parse_packet(packet)
+        if not valid:
+            # Corrupted packets are dropped, the server will retransmit
+            return
+        if typeofP == "ack":
+            if data:
+                # The server echoes the offers of our start packet it
+                # accepted, a refused join is answered with the error
+                accepted = data.split()
+                if accepted and accepted[0] in ("ERR_SERVER_FULL", "ERR_USERNAME_UNAVAILABLE"):
+                    self.join_error = accepted[0]
+                    self.handle_error(accepted[0], accepted[2:])
+                if wire.BINARY_OFFER in accepted and self.offer_binary:
+                    self.binary = True
+                if wire.SESSION_OFFER in accepted and self.offer_session:
+                    self.session_accepted = True
+                if wire.ZLIB_OFFER in accepted and self.offer_compression:
+                    self.compression = True
+            # Put the received ACK into the queue
+            self.ack_queue.put_nowait(int(seqno))
+        elif typeofP == "start":
+            # The server numbers its transfers in increasing order. A
+            # retransmitted start, or a late one of a transfer that is
+            # over, only needs its ACK again
+            if self.transfer_id is None or reorder.is_after(int(seqno), self.transfer_id):
+                self.transfer_id = int(seqno)
+                self.transfer = {"sender": None, "chunks": []}
+                self.receiver.reset(int(seqno) + 1)
+            self.send_ack(int(seqno))
+        elif typeofP in ("data", "end"):
+            # The server sends with a window, packets ahead of a gap
+            # are held until it is filled and duplicates are dropped
+            outcome, released = self.receiver.accept(int(seqno), (typeofP, data))
+            if outcome == reorder.DUPLICATE:
+                # Our ACK was lost: re-ACK the last in-order packet
+                self.send_ack(self.receiver.last_in_order)
+            for seq_num, (packet_type, payload) in released:
+                self.handle_transfer_packet(packet_type, seq_num, payload)
+
+    def handle_transfer_packet(self, typeofP, seqno, data):
+        '''
+        Handles the data and end packets of the current transfer in order
+        '''
+        transfer = self.transfer
+        parts = data.split()
+        if typeofP == "end":
+            self.transfer = None
+            self.send_ack(seqno)
+            if transfer is None:
+                return
+            if parts[:1] == ["response_users_list"]:
+                self.apply_users_list(transfer["chunks"], parts[2:4])
+            elif parts[:1] == ["response_stats"]:
+                try:
+                    self.handle_stats(json.loads(''.join(transfer["chunks"])))
+                except ValueError:
+                    print("Stats response is incomplete")
+            elif parts[:1] == ["forward_message"] and transfer["sender"] is not None:
+                message = ''.join(transfer["chunks"])
+                if parts[3:4] == [wire.ZLIB_OFFER]:
+                    try:
+                        message = codec.decompress(message)
+                    except ValueError as e:
+                        print(f"Message from {transfer['sender']} dropped: {e}")
+                        return
+                self.handle_message(transfer["sender"], message)
+            return
+
+        # Chunks are acknowledged in pairs, the end packet confirms the rest
+        self.delayed_acks.ack((self.server_addr, self.server_port), seqno)
+        msg_type = parts[0] if parts else None
+        if msg_type in ERRORS:
+            self.handle_error(msg_type, parts[2:])
+        elif msg_type in ("ERR_SERVER_FULL", "ERR_USERNAME_UNAVAILABLE"):
+            self.join_error = msg_type
+            self.handle_error(msg_type, parts[2:])
+        elif transfer is None:
+            return
+        elif msg_type == "response_users_list":
+            # <version> <full|delta> and a chunk of names or changes
+            transfer["chunks"].extend(parts[4:])
+        elif msg_type == "response_stats":
+            # A chunk of the JSON snapshot, kept as it is
+            fields = data.split(" ", 2)
+            transfer["chunks"].append(fields[2] if len(fields) > 2 else "")
+        elif msg_type == "forward_message":
+            # The chunk is raw text, keep its whitespace
+            fields = data.split(" ", 3)
+            transfer["sender"] = fields[2] if len(fields) > 2 else None
+            transfer["chunks"].append(fields[3] if len(fields) > 3 else "")
+
     def send_message(self, message):
         parts = message.split()
+        if rooms.is_room(parts[1]):
+            # msg #room <message>
+            parts = message.split(None, 2)
+            self.send_transfer(*self.make_message_transfer(parts[1], parts[2] if len(parts) > 2 else ""))
+            return
         recipients_count = int(parts[1])
+        # Split again to keep the whitespace of the text as typed
+        parts = message.split(None, 2 + recipients_count)
         recipients = parts[2:2 + recipients_count]
-        message_content = ' '.join(parts[2 + recipients_count:])
-        message_chunks = [message_content[i:i+util.CHUNK_SIZE]
-                      for i in range(0, len(message_content), util.CHUNK_SIZE)]
-
-        start_seq_num = random.randint(1, 1000)  # Generate a random sequence number
-        start_packet = util.make_packet("start", start_seq_num, "")
-        self.sock.sendto(start_packet.encode(), (self.server_addr, self.server_port))
-
-        ack_received = False
-        while not ack_received:
-            try:
-                ack = self.ack_queue.get(timeout=util.TIME_OUT)  # Convert to seconds
-                if ack == start_seq_num:
-                    ack_received = True
-            except queue.Empty:
-                # Handle timeout by retransmitting the START packet
-                self.sock.sendto(start_packet.encode(), (self.server_addr, self.server_port))
-
-        # Send message chunks
-        seq_num = start_seq_num + 1
-        for chunk in message_chunks:
-
-            chunk_with_recipients_info = f"msg {recipients_count} {' '.join(recipients)} " + chunk
-            # Create the message
-            msg = util.make_message("send_message", 4, chunk_with_recipients_info)
-            packet = util.make_packet("data", seq_num, msg)
-            self.sock.sendto(packet.encode(), (self.server_addr, self.server_port))
-
-            # Increment sequence number
-            seq_num += 1
-
-            # Wait for ACK or handle retransmission
-            ack_received = False
-            retries = 0
-            while not ack_received and retries < 3:  # Retry up to 3 times
-                try:
-                    # Get the ACK from the queue with a timeout
-                    ack = self.ack_queue.get(timeout=util.TIME_OUT) 
-                    if ack == seq_num-1:
-                        ack_received = True
-                except queue.Empty:
-                    # Handle timeout by retransmitting the packet
-                    self.sock.sendto(packet.encode(), (self.server_addr, self.server_port))
-                    retries += 1
-            if not ack_received:
-                print(f"Failed to receive ACK for packet {seq_num - 1}. Retries exhausted.")
-                break
-
-            
-        end_packet = util.make_packet("end", seq_num, msg)
-        self.sock.sendto(end_packet.encode(), (self.server_addr, self.server_port))
-
-        ack_received = False
-        while not ack_received:
-            try:
-                ack = self.ack_queue.get(timeout=util.TIME_OUT)  # Convert to seconds
-                if ack == seq_num:
-                    ack_received = True
-            except queue.Empty:
-                self.sock.sendto(end_packet.encode(), (self.server_addr, self.server_port))
-            
+        message_content = parts[2 + recipients_count] if len(parts) > 2 + recipients_count else ""
+        self.send_transfer(*self.make_message_transfer(recipients, message_content))
 
+    def make_message_transfer(self, recipients, message_content):
+        '''
+        Returns the data messages and the end message that send
+        message_content to recipients, a list of usernames or a room
+        '''
+        compressed = False
+        if self.compression and codec.should_compress(message_content):
+            payload = codec.compress(message_content)
+            if len(payload.encode("utf-8", codec.ENCODING_ERRORS)) < len(message_content.encode()):
+                message_content, compressed = payload, True
+
+        # The recipients only go out with the first chunk, every chunk is
+        # sized in bytes so that its packet fits the path MTU
+        if isinstance(recipients, str):
+            header = f"msg {recipients} "
+        else:
+            header = f"msg {len(recipients)} {' '.join(recipients)} "
+        size = wire.payload_size(self.mtu, self.binary)
+        message_chunks = wire.split_utf8(message_content, wire.message_room(size, "send_message", header),
+                                         wire.message_room(size, "message_part"))
+
+        # Send message chunks through the sliding window
+        messages = [util.make_message("send_message", 4, header + message_chunks[0])]
+        for chunk in message_chunks[1:]:
+            messages.append(util.make_message("message_part", 4, chunk))
+
+        # The end packet tells whether the chunks are compressed
+        return messages, util.make_message("send_message", 4, wire.ZLIB_OFFER if compressed else "")
 
     def print_help(self):
         print("API Functions:")
         print("1) Message: msg <number_of_users> <username1> <username2> … <message>")
-        print("2) Available Users: list")
-        print("3) Help: help")
-        print("4) Quit: quit")
+        print("2) Room message: msg #room <message>")
+        print("3) Rooms: create #room, join #room, leave #room")
+        print("4) Available Users: list")
+        print("5) Presence: subscribe")
+        print("6) Server stats, from the server's host only: stats")
+        print("7) Help: help")
+        print("8) Quit: quit")
 
     def list_users(self):
-        # Send start packet
-        start_seq_num = random.randint(1, 1000)  # Generate a random sequence number
-        start_packet = util.make_packet("start", start_seq_num, "")
-        self.sock.sendto(start_packet.encode(), (self.server_addr, self.server_port))
+        # Send list request packet
+        # The server answers with what changed since the roster we know
+        list_packet = util.make_message("request_users_list", 1, str(self.roster_version))
+        self.send_transfer([list_packet], list_packet)
 
-        ack_received = False
-        while not ack_received:
-            try:
-                ack = self.ack_queue.get(timeout=util.TIME_OUT)  # Convert to seconds
-                if ack == start_seq_num:
-                    ack_received = True
-            except queue.Empty:
-                # Handle timeout by retransmitting the START packet
-                self.sock.sendto(start_packet.encode(), (self.server_addr, self.server_port))
+    def request_stats(self):
+        # Only answered for clients on the server's host
+        stats_packet = util.make_message("request_stats", 2)
+        self.send_transfer([stats_packet], stats_packet)
 
-        # Send list request packet
-        seq_num = start_seq_num + 1
-        list_packet = util.make_message("request_users_list", 2)
-        packet = util.make_packet("data", seq_num, list_packet)
-        self.sock.sendto(packet.encode(), (self.server_addr, self.server_port))
-
-        # Wait for ACK or handle retransmission
-        ack_received = False
-        retries = 0
-        while not ack_received and retries < 3:  # Retry up to 3 times
-            try:
-                # Get the ACK from the queue with a timeout
-                ack = self.ack_queue.get(timeout=util.TIME_OUT)
-                if ack == seq_num:
-                    ack_received = True
-            except queue.Empty:
-                # Handle timeout by retransmitting the packet
-                self.sock.sendto(packet.encode(), (self.server_addr, self.server_port))
-                retries += 1
-        if not ack_received:
-            print(f"Failed to receive ACK for packet {seq_num}. Retries exhausted.")
-
-        # Send end packet
-        end_packet = util.make_packet("end", seq_num + 1,list_packet)
-        self.sock.sendto(end_packet.encode(), (self.server_addr, self.server_port))
-
-        ack_received = False
-        while not ack_received:
-            try:
-                ack = self.ack_queue.get(timeout=util.TIME_OUT)  # Convert to seconds
-                if ack == seq_num + 1:
-                    ack_received = True
-            except queue.Empty:
-                self.sock.sendto(end_packet.encode(), (self.server_addr, self.server_port))
+    def create_room(self, room):
+        # The creator is the first member of the room
+        return self.send_room_command("create_room", room)
+
+    def join_room(self, room):
+        return self.send_room_command("join_room", room)
+
+    def leave_room(self, room):
+        return self.send_room_command("leave_room", room)
+
+    def send_room_command(self, msg_type, room):
+        room_packet = util.make_message(msg_type, 1, room)
+        return self.send_transfer([room_packet], room_packet)
+
+    def subscribe_presence(self):
+        # From now on the server pushes joins and leaves as list responses
+        subscribe_packet = util.make_message("subscribe_presence", 1, str(self.roster_version))
+        self.send_transfer([subscribe_packet], subscribe_packet)
 
 
 # Do not change below part of code
@@ -368,10 +540,11 @@ if __name__ == "__main__":
         print("-p PORT | --port=PORT The server port, defaults to 15000")
         print("-a ADDRESS | --address=ADDRESS The server ip or hostname, defaults to localhost")
         print("-w WINDOW_SIZE | --window=WINDOW_SIZE The window_size, defaults to 3")
+        print("-i SPEC | --impair=SPEC Simulate an impaired network, e.g. loss=0.05,delay=0.02,seed=1")
         print("-h | --help Print this help")
     try:
         OPTS, ARGS = getopt.getopt(sys.argv[1:],
-                                   "u:p:a:w", ["user=", "port=", "address=","window="])
+                                   "u:p:a:w:i:", ["user=", "port=", "address=","window=","impair="])
     except getopt.error:
         helper()
         exit(1)
@@ -379,6 +552,7 @@ if __name__ == "__main__":
     DEST = "localhost"
     USER_NAME = None
     WINDOW_SIZE = 3
+    IMPAIRMENT = None
     for o, a in OPTS:
         if o in ("-u", "--user="):
             USER_NAME = a
@@ -386,15 +560,17 @@ if __name__ == "__main__":
             PORT = int(a)
         elif o in ("-a", "--address="):
             DEST = a
-        elif o in ("-w", "--window="):
-            WINDOW_SIZE = a
+        elif o in ("-w", "--window"):
+            WINDOW_SIZE = int(a)
+        elif o in ("-i", "--impair"):
+            IMPAIRMENT = Impairment.parse(a)
 
     if USER_NAME is None:
         print("Missing Username.")
         helper()
         exit(1)
 
-    S = Client(USER_NAME, DEST, PORT, WINDOW_SIZE)
+    S = Client(USER_NAME, DEST, PORT, WINDOW_SIZE, impairment=IMPAIRMENT)
     try:
         # Start receiving Messages
         T = Thread(target=S.receive_handler)
@@ -0,0 +1,60 @@
+'''
+This module compresses message text. Clients and the Server that agreed on
+the "zlib" offer send messages of COMPRESSION_THRESHOLD bytes or more as a
+zlib stream primed with PRESET_DICTIONARY, which lets even short chat lines
+shrink. The Server forwards such a message as is to recipients that speak
+zlib too and only decompresses it for the others.
+
+Compressed bytes travel inside the str payloads of the binary format, whose
+payloads are decoded with the surrogateescape error handler so that any
+byte sequence survives the round trip.
+'''
+import zlib
+
+# Shorter messages are sent as they are
+COMPRESSION_THRESHOLD = 64
+# Upper bound on the size of a decompressed message
+MAX_DECOMPRESSED_SIZE = 1024 * 1024
+ENCODING_ERRORS = "surrogateescape"
+
+# Most frequent tokens last, zlib reaches them with the shortest distances
+PRESET_DICTIONARY = (
+    b"forward_message send_message message_part response_users_list msg "
+    b"http https www .com :) :( :D lol haha ok okay sure sorry please thanks thank you "
+    b"hey hi hello bye see you later tomorrow today tonight morning night "
+    b"what when where why how who which would could should will can cannot don't "
+    b"I'm it's that's there their they them then than this these those "
+    b"about after again also because been before being but by from have has had "
+    b"just know like more not now only other our out over some time very want well "
+    b"with your you and the to of is in it for on at be as are was we me my so do "
+    b"if or an a. I ? ! , "
+)
+
+
+def compress(text):
+    '''
+    Compresses text and returns the compressed bytes as a str, see the
+    module docstring
+    '''
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=PRESET_DICTIONARY)
+    data = compressor.compress(text.encode()) + compressor.flush()
+    return data.decode("utf-8", ENCODING_ERRORS)
+
+
+def decompress(payload, limit=MAX_DECOMPRESSED_SIZE):
+    '''
+    Reverses compress(). Raises ValueError for corrupt data and for
+    messages growing beyond limit bytes.
+    '''
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=PRESET_DICTIONARY)
+    try:
+        data = decompressor.decompress(payload.encode("utf-8", ENCODING_ERRORS), limit)
+    except zlib.error as e:
+        raise ValueError(f"Corrupt compressed message: {e}")
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"Compressed message exceeds {limit} bytes")
+    return data.decode("utf-8", "replace")
+
+
+def should_compress(text):
+    return len(text.encode()) >= COMPRESSION_THRESHOLD
@@ -0,0 +1,112 @@
+'''
+This module implements delayed ACKs. ACKs are cumulative, so instead of
+answering every data packet the receiver acknowledges every `every`-th
+in-order packet at once and lets a timer acknowledge whatever is left after
+`delay` seconds. A burst of data then costs about half as many ACKs.
+'''
+import heapq
+import threading
+import time
+
+# Seconds an ACK may be held back, well below the minimum RTO of rtt.py
+ACK_DELAY = 0.01
+# Packets acknowledged by one ACK at most
+ACK_EVERY = 2
+
+
+class DelayedAcks:
+    '''
+    Holds back ACKs per peer address. send_ack(address, seq) sends one ACK
+    and is called either from ack() or from the timer thread. A delay of 0
+    turns delaying off.
+    '''
+    def __init__(self, send_ack, delay=ACK_DELAY, every=ACK_EVERY):
+        self.send_ack = send_ack
+        self.delay = delay
+        self.every = every
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        # address -> [highest seq, packets covered, deadline]
+        self.pending = {}
+        self.deadlines = []
+        self.timer_thread = None
+        self.stats = {"sent": 0, "saved": 0}
+
+    def ack(self, address, seq):
+        '''
+        Acknowledges seq, now or once the peer sent enough or the delay ran out
+        '''
+        if self.delay <= 0:
+            self.send(address, seq)
+            return
+        with self.lock:
+            entry = self.pending.get(address)
+            if entry is None:
+                entry = self.pending[address] = [seq, 0, time.monotonic() + self.delay]
+                self.schedule(entry[2], address)
+            entry[0] = seq
+            entry[1] += 1
+            if entry[1] < self.every:
+                return
+            del self.pending[address]
+            self.stats["saved"] += entry[1] - 1
+        self.send(address, seq)
+
+    def cancel(self, address):
+        '''
+        Forgets the held ACK of address, called when a later ACK goes out anyway
+        '''
+        with self.lock:
+            entry = self.pending.pop(address, None)
+            if entry:
+                self.stats["saved"] += entry[1]
+
+    def send(self, address, seq):
+        self.stats["sent"] += 1
+        self.send_ack(address, seq)
+
+    def expire(self):
+        # Sends every held ACK whose deadline passed
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, address = heapq.heappop(self.deadlines)
+                entry = self.pending.get(address)
+                if entry and entry[2] == deadline:
+                    del self.pending[address]
+                    self.stats["saved"] += entry[1] - 1
+                    due.append((address, entry[0]))
+        for address, seq in due:
+            self.send(address, seq)
+
+    def schedule(self, deadline, address):
+        # Called with the lock held
+        heapq.heappush(self.deadlines, (deadline, address))
+        if self.timer_thread is None:
+            self.timer_thread = threading.Thread(target=self.timer)
+            self.timer_thread.daemon = True
+            self.timer_thread.start()
+        self.wakeup.notify()
+
+    def timer(self):
+        while True:
+            with self.lock:
+                while not self.deadlines or self.deadlines[0][0] > time.monotonic():
+                    timeout = self.deadlines[0][0] - time.monotonic() if self.deadlines else None
+                    self.wakeup.wait(timeout)
+            self.expire()
+
+
+class AsyncDelayedAcks(DelayedAcks):
+    '''
+    DelayedAcks for the asyncio server, the timer runs on the event loop so
+    every ACK is sent from the loop thread.
+    '''
+    def __init__(self, send_ack, loop, delay=ACK_DELAY, every=ACK_EVERY):
+        super().__init__(send_ack, delay, every)
+        self.loop = loop
+
+    def schedule(self, deadline, address):
+        heapq.heappush(self.deadlines, (deadline, address))
+        self.loop.call_later(max(0.0, deadline - time.monotonic()), self.expire)
@@ -0,0 +1,89 @@
+'''
+This module routes the ACKs a peer sends back to the transfer waiting for
+them. Every transfer registers the sequence numbers it has outstanding, so
+an ACK is handed to its sender with a single dict lookup and stale or
+duplicate ACKs never reach it.
+
+The dispatcher does not make overlapping transfers towards one client safe:
+the client reassembles one transfer at a time, in a single receive
+sequence. The Server sends them one after the other, and a transfer
+registered while another one still is, is counted as overlapping.
+'''
+import threading
+
+
+class AckWaiter:
+    '''
+    One registered transfer. deliver(seq) is called for every ACK that moves
+    the transfer forward, highest is the highest sequence number delivered.
+    '''
+    def __init__(self, seqs, deliver):
+        self.seqs = seqs
+        self.deliver = deliver
+        self.highest = None
+
+
+class AckDispatcher:
+    '''
+    Maps the outstanding sequence numbers of one connection to their
+    AckWaiter. ACKs are cumulative, so an ACK at or below the highest one
+    already delivered to its waiter is a duplicate and is dropped. ACKs for
+    sequence numbers nobody waits for are stale. Both are counted, and so
+    are transfers registered on top of one that is still running.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = {}
+        self.closed = False
+        self.stats = {"delivered": 0, "stale": 0, "duplicate": 0, "overlapping": 0}
+
+    def register(self, seqs, deliver):
+        '''
+        Starts routing ACKs for seqs to deliver and returns the AckWaiter to
+        pass to unregister() once the transfer is over
+        '''
+        waiter = AckWaiter(list(seqs), deliver)
+        with self.lock:
+            if self.waiters:
+                self.stats["overlapping"] += 1
+            for seq in waiter.seqs:
+                self.waiters[seq] = waiter
+            closed = self.closed
+        if closed:
+            deliver(None)
+        return waiter
+
+    def unregister(self, waiter):
+        with self.lock:
+            for seq in waiter.seqs:
+                if self.waiters.get(seq) is waiter:
+                    del self.waiters[seq]
+
+    def close(self):
+        '''
+        Cancels every transfer of the connection, their waiters are handed
+        None instead of an ACK and so are the waiters registered later
+        '''
+        with self.lock:
+            self.closed = True
+            waiters = set(self.waiters.values())
+            self.waiters.clear()
+        for waiter in waiters:
+            waiter.deliver(None)
+
+    def dispatch(self, seq):
+        '''
+        Hands the ACK to its waiter, returns False if it was stale or a duplicate
+        '''
+        with self.lock:
+            waiter = self.waiters.get(seq)
+            if waiter is None:
+                self.stats["stale"] += 1
+                return False
+            if waiter.highest is not None and seq <= waiter.highest:
+                self.stats["duplicate"] += 1
+                return False
+            waiter.highest = seq
+            self.stats["delivered"] += 1
+        waiter.deliver(seq)
+        return True
@@ -0,0 +1,246 @@
+'''
+This module implements the fan-out sender the Server uses to deliver its
+transfers, a forwarded message to many recipients in particular.
+'''
+import collections
+import functools
+import heapq
+import itertools
+import queue
+import threading
+import time
+import batchio
+import logs
+import rtt
+import window
+
+LOG = logs.get_logger("fanout")
+
+
+class RecipientState:
+    '''
+    Go-Back-N window of one recipient inside a FanoutSender, with the
+    outboxes its transfers come from. There is one, unless the client
+    started a new connection while the old one was still being drained.
+    '''
+    def __init__(self, address, estimator, client_outbox):
+        self.address = address
+        self.estimator = estimator
+        self.outboxes = collections.deque([client_outbox])
+        self.phases = None
+        self.sent_at = {}
+        self.retransmitted = set()
+        self.phase = 0
+        self.base = 0
+        self.next_index = 0
+        self.retries = 0
+        self.deadline = None
+        # AckWaiter of the transfer in flight, see demux.py
+        self.waiter = None
+
+
+class FanoutSender:
+    '''
+    Drives the windows of every recipient from a single thread. The
+    transfers of a recipient are taken from its Outbox (outbox.py), one
+    after another, as the client reassembles one at a time and its ACKs are
+    cumulative. A transfer is a list of phases, each a (packets, window)
+    tuple where packets is a list of (seq_num, bytes). A recipient only
+    moves on to the next phase once the current one is fully acknowledged.
+
+    Every recipient of a message uses the same sequence numbers, so the
+    encoded packets are byte for byte identical and are built once per
+    message. The packets a round of events produces, for all recipients,
+    go out together with one batchio.send_batch(). Nothing waits on a recipient: one that stops answering holds a
+    timer until its retries run out, the others go on meanwhile.
+
+    estimator(address) returns the RttEstimator of a recipient, the
+    retransmission timers of its windows come from it. on_retransmit(address,
+    count) is called for every window sent again. dispatcher(address)
+    returns the AckDispatcher of a recipient: every transfer registers its
+    sequence numbers there while it is in flight, and only the ACKs routed
+    to it reach ack(). Without one, ack() is fed directly. A closed
+    dispatcher hands None instead, and the transfer is dropped.
+    '''
+    def __init__(self, sock, estimator=None, on_retransmit=None, dispatcher=None):
+        self.sock = sock
+        self.estimator = estimator
+        self.on_retransmit = on_retransmit
+        self.dispatcher = dispatcher
+        # deliver(), ack() and stop() hand their work to the thread here
+        self.events = queue.Queue()
+        self.states = {}
+        # (deadline, order, state), stale entries are skipped when popped
+        self.timers = []
+        self.order = itertools.count()
+        self.thread = None
+        self.retransmissions = 0
+        # (packet, address) sent at the end of the current round
+        self.pending = []
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def deliver(self, client_outbox):
+        '''
+        Delivers the transfers queued in client_outbox until it is empty.
+        Called whenever Outbox.put() asks for delivery to start, from any
+        thread.
+        '''
+        self.events.put(("deliver", client_outbox))
+
+    def ack(self, address, seq_num):
+        self.events.put(("ack", address, seq_num))
+
+    def stop(self):
+        # Waits for the thread, whatever it is sending goes out before the
+        # socket is closed
+        self.events.put(None)
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        while True:
+            try:
+                event = self.events.get(timeout=self.next_timeout())
+            except queue.Empty:
+                event = ()
+            if event is None:
+                return
+            if event and event[0] == "deliver":
+                self.add_outbox(event[1])
+            elif event:
+                state = self.states.get(event[1])
+                if state:
+                    self.handle_ack(state, event[2])
+            self.handle_timeouts()
+            if self.pending:
+                packets, self.pending = self.pending, []
+                batchio.send_batch(self.sock, packets)
+
+    def next_timeout(self):
+        while self.timers:
+            deadline, order, state = self.timers[0]
+            if state.deadline == deadline:
+                return max(0, deadline - time.monotonic())
+            heapq.heappop(self.timers)
+        return None
+
+    def set_deadline(self, state, deadline):
+        state.deadline = deadline
+        if deadline is not None:
+            heapq.heappush(self.timers, (deadline, next(self.order), state))
+
+    def add_outbox(self, client_outbox):
+        address = client_outbox.address
+        state = self.states.get(address)
+        if state:
+            state.outboxes.append(client_outbox)
+            return
+        estimator = self.estimator(address) if self.estimator else rtt.RttEstimator()
+        state = self.states[address] = RecipientState(address, estimator, client_outbox)
+        self.next_transfer(state)
+
+    def finish_transfer(self, state, delivered):
+        state.outboxes[0].done(delivered)
+        self.next_transfer(state)
+
+    def next_transfer(self, state):
+        if state.waiter:
+            self.dispatcher(state.address).unregister(state.waiter)
+            state.waiter = None
+        while state.outboxes:
+            transfer = state.outboxes[0].get()
+            if transfer is None:
+                state.outboxes.popleft()
+                continue
+            # Empty phases would never be acknowledged
+            phases = [phase for phase in transfer[0] if phase[0]]
+            if phases:
+                break
+            state.outboxes[0].done(True)
+        else:
+            # Idle recipients are forgotten
+            del self.states[state.address]
+            return
+        state.phases = phases
+        state.phase = 0
+        state.base = 0
+        state.next_index = 0
+        state.retries = 0
+        self.set_deadline(state, None)
+        if self.dispatcher:
+            seqs = [seq for packets, window_size in state.phases for seq, packet in packets]
+            state.waiter = self.dispatcher(state.address).register(seqs, functools.partial(self.ack, state.address))
+        self.start_phase(state)
+
+    def start_phase(self, state):
+        state.sent_at.clear()
+        state.retransmitted.clear()
+        self.fill(state)
+
+    def fill(self, state):
+        packets, window_size = state.phases[state.phase]
+        while state.next_index < len(packets) and state.next_index < state.base + window_size:
+            self.pending.append((packets[state.next_index][1], state.address))
+            state.sent_at[state.next_index] = time.monotonic()
+            if state.deadline is None:
+                self.set_deadline(state, state.sent_at[state.next_index] + state.estimator.rto)
+            state.next_index += 1
+
+    def handle_ack(self, state, ack):
+        if ack is None:
+            # The client is gone, see AckDispatcher.close(). A transfer
+            # from the outbox of a new connection carries on
+            if state.outboxes[0].closed:
+                self.set_deadline(state, None)
+                self.finish_transfer(state, False)
+            return
+        packets = state.phases[state.phase][0]
+        acked_index = ack - packets[0][0]
+        # Stale or duplicate ACKs fall outside the window and are ignored
+        if not state.base <= acked_index < state.next_index:
+            return
+        now = time.monotonic()
+        # Karn's algorithm: retransmitted packets give ambiguous samples
+        if acked_index not in state.retransmitted:
+            state.estimator.sample(now - state.sent_at[acked_index])
+        state.base = acked_index + 1
+        state.retries = 0
+        if state.base < len(packets):
+            self.set_deadline(state, now + state.estimator.rto if state.base < state.next_index else None)
+            self.fill(state)
+            return
+        # Phase complete, move the recipient on to the next one
+        state.phase += 1
+        state.base = 0
+        state.next_index = 0
+        self.set_deadline(state, None)
+        if state.phase == len(state.phases):
+            self.finish_transfer(state, True)
+        else:
+            self.start_phase(state)
+
+    def handle_timeouts(self):
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            deadline, order, state = heapq.heappop(self.timers)
+            if state.deadline != deadline:
+                continue
+            state.retries += 1
+            packets = state.phases[state.phase][0]
+            if state.retries > window.MAX_RETRIES:
+                LOG.warning("Failed to receive ACK for packet %d from %s. Retries exhausted.", packets[state.base][0], state.address)
+                # The rest of the transfer is dropped, the next one goes on
+                self.finish_transfer(state, False)
+                continue
+            state.estimator.backoff()
+            for index in range(state.base, state.next_index):
+                self.pending.append((packets[index][1], state.address))
+                state.retransmitted.add(index)
+            self.retransmissions += state.next_index - state.base
+            if self.on_retransmit:
+                self.on_retransmit(state.address, state.next_index - state.base)
+            self.set_deadline(state, now + state.estimator.rto)
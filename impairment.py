@@ -0,0 +1,174 @@
+'''
+This module simulates an impaired network path. ImpairedSocket wraps the UDP
+socket of a Client or a Server and applies seeded packet loss, latency,
+jitter, reordering, duplication, corruption, truncation and a bandwidth cap
+to every datagram it sends. Wrapping both ends impairs both directions.
+'''
+import heapq
+import random
+import threading
+import time
+
+
+class Impairment:
+    '''
+    Parameters of an impaired path. Probabilities are per packet, times are
+    in seconds and rate is in bytes per second (0 means unlimited).
+    Reordered packets are held back by an extra reorder_delay so that later
+    packets overtake them. A corrupted packet has one bit flipped, a
+    truncated one loses a random tail.
+    '''
+    FIELDS = {"loss": float, "delay": float, "jitter": float, "reorder": float,
+              "reorder_delay": float, "duplicate": float, "corrupt": float,
+              "truncate": float, "rate": float, "seed": int}
+
+    def __init__(self, loss=0.0, delay=0.0, jitter=0.0, reorder=0.0, reorder_delay=0.02,
+                 duplicate=0.0, corrupt=0.0, truncate=0.0, rate=0, seed=None):
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.duplicate = duplicate
+        self.corrupt = corrupt
+        self.truncate = truncate
+        self.rate = rate
+        self.seed = seed
+
+    @classmethod
+    def parse(cls, spec):
+        '''
+        Builds an Impairment from a spec like "loss=0.05,delay=0.02,seed=1"
+        '''
+        options = {}
+        for item in spec.split(","):
+            if not item.strip():
+                continue
+            name, _, value = item.partition("=")
+            name = name.strip()
+            if name not in cls.FIELDS:
+                raise ValueError(f"Unknown impairment {name}")
+            options[name] = cls.FIELDS[name](value)
+        return cls(**options)
+
+    def with_seed(self, seed):
+        '''
+        Returns a copy using another seed, for independent but reproducible peers
+        '''
+        copy = Impairment(**{name: getattr(self, name) for name in self.FIELDS})
+        copy.seed = seed
+        return copy
+
+
+class ImpairedSocket:
+    '''
+    Wraps anything with a sendto(data, address) method. Everything but
+    sendto() is delegated to the wrapped socket. Delayed packets are sent by
+    a scheduler thread.
+    '''
+    def __init__(self, sock, impairment):
+        self.sock = sock
+        self.impairment = impairment
+        self.random = random.Random(impairment.seed)
+        self.lock = threading.Lock()
+        # Time at which the simulated link finishes sending its backlog
+        self.link_free_at = 0.0
+        self.stats = {"sent": 0, "dropped": 0, "duplicated": 0, "corrupted": 0,
+                      "truncated": 0, "reordered": 0}
+
+        self.pending = []
+        self.pending_count = 0
+        self.wakeup = threading.Condition(self.lock)
+        self.closed = False
+        self.scheduler_thread = None
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def sendto(self, data, address):
+        with self.lock:
+            impairment = self.impairment
+            if self.random.random() < impairment.loss:
+                self.stats["dropped"] += 1
+                return len(data)
+            copies = 1
+            if self.random.random() < impairment.duplicate:
+                self.stats["duplicated"] += 1
+                copies = 2
+            deliveries = []
+            for _ in range(copies):
+                packet = data
+                if packet and self.random.random() < impairment.corrupt:
+                    packet = bytearray(data)
+                    packet[self.random.randrange(len(packet))] ^= 1 << self.random.randrange(8)
+                    packet = bytes(packet)
+                    self.stats["corrupted"] += 1
+                if len(packet) > 1 and self.random.random() < impairment.truncate:
+                    # At least one byte is left, an empty datagram would be a loss
+                    packet = packet[:self.random.randrange(1, len(packet))]
+                    self.stats["truncated"] += 1
+                delay = max(0.0, impairment.delay + self.random.uniform(-impairment.jitter, impairment.jitter))
+                if self.random.random() < impairment.reorder:
+                    delay += impairment.reorder_delay
+                    self.stats["reordered"] += 1
+                if impairment.rate:
+                    # Packets queue behind each other on the simulated link
+                    now = time.monotonic()
+                    self.link_free_at = max(now, self.link_free_at) + len(packet) / impairment.rate
+                    delay += self.link_free_at - now
+                deliveries.append((delay, packet))
+                self.stats["sent"] += 1
+
+        for delay, packet in deliveries:
+            if delay > 0:
+                self.send_later(delay, packet, address)
+            else:
+                self.sock.sendto(packet, address)
+        return len(data)
+
+    def send_later(self, delay, packet, address):
+        with self.lock:
+            if self.scheduler_thread is None:
+                self.scheduler_thread = threading.Thread(target=self.scheduler)
+                self.scheduler_thread.daemon = True
+                self.scheduler_thread.start()
+            # The counter keeps packets due at the same time in order
+            heapq.heappush(self.pending, (time.monotonic() + delay, self.pending_count, packet, address))
+            self.pending_count += 1
+            self.wakeup.notify()
+
+    def scheduler(self):
+        while True:
+            with self.lock:
+                while not self.closed and (not self.pending or self.pending[0][0] > time.monotonic()):
+                    timeout = self.pending[0][0] - time.monotonic() if self.pending else None
+                    self.wakeup.wait(timeout)
+                if self.closed:
+                    return
+                due_at, count, packet, address = heapq.heappop(self.pending)
+            try:
+                self.sock.sendto(packet, address)
+            except OSError:
+                return
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        self.sock.close()
+
+
+class AsyncImpairedTransport(ImpairedSocket):
+    '''
+    ImpairedSocket for an asyncio DatagramTransport. Delayed packets are
+    scheduled on the event loop, so every send stays on the loop thread.
+    '''
+    def __init__(self, transport, impairment, loop):
+        super().__init__(transport, impairment)
+        self.loop = loop
+
+    def send_later(self, delay, packet, address):
+        self.loop.call_later(delay, self.sock.sendto, packet, address)
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,63 @@
+'''
+This module sets up the logging of the Server. Every module logs to a child
+of the "chat" logger. Records are rate limited per message template, a
+template logged more than RATE times a second is suppressed for the rest of
+the second and the next record that gets through tells how many were lost.
+configure("off") silences the Server entirely.
+'''
+import logging
+import sys
+import threading
+import time
+
+# Records per second and template
+RATE = 20
+LEVELS = {"debug": logging.DEBUG, "info": logging.INFO, "warning": logging.WARNING,
+          "error": logging.ERROR, "off": logging.CRITICAL + 1}
+
+
+def get_logger(name):
+    return logging.getLogger("chat." + name)
+
+
+class RateLimit(logging.Filter):
+    def __init__(self, rate=RATE):
+        super().__init__()
+        self.rate = rate
+        self.lock = threading.Lock()
+        # template -> [second, records in it, records suppressed]
+        self.windows = {}
+        self.suppressed = 0
+
+    def filter(self, record):
+        second = int(time.monotonic())
+        with self.lock:
+            window = self.windows.get(record.msg)
+            if window is None or window[0] != second:
+                lost = window[2] if window else 0
+                window = self.windows[record.msg] = [second, 0, 0]
+                if lost:
+                    record.msg = f"{record.msg} ({lost} similar records suppressed)"
+            window[1] += 1
+            if window[1] > self.rate:
+                window[2] += 1
+                self.suppressed += 1
+                return False
+        return True
+
+
+def configure(level="info", rate=RATE):
+    '''
+    Sends the records of level and above to stdout, formatted like the
+    print() output they replace
+    '''
+    logger = logging.getLogger("chat")
+    logger.setLevel(LEVELS[level])
+    logger.propagate = False
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    handler.addFilter(RateLimit(rate))
+    logger.addHandler(handler)
+    return logger
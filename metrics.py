@@ -0,0 +1,99 @@
+'''
+This module collects the counters and latency histograms of the Server.
+Counting is a dict update and a histogram sample a bit_length(), cheap
+enough for every packet. Counters are updated without a lock, so threads
+racing on one counter may lose an increment now and then; that is the price
+of keeping locks off the hot path.
+
+The Server answers a `request_stats` packet from a local client with
+snapshot() as JSON and can dump it to a file every DUMP_INTERVAL seconds.
+'''
+import json
+import os
+import time
+
+# Histogram buckets, bucket n holds samples below 2**n microseconds
+BUCKETS = 32
+DUMP_INTERVAL = 10.0
+
+
+class Histogram:
+    '''
+    Latency histogram with power of two buckets, values in seconds
+    '''
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[min(int(seconds * 1e6).bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        # Upper bound of the bucket holding the percentile, in milliseconds
+        rank = self.count * percent / 100
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(2 ** bucket / 1000, self.max * 1000)
+        return self.max * 1000
+
+    def snapshot(self):
+        return {"count": self.count,
+                "mean_ms": self.total / self.count * 1000 if self.count else None,
+                "p50_ms": self.percentile(50) if self.count else None,
+                "p99_ms": self.percentile(99) if self.count else None,
+                "max_ms": self.max * 1000}
+
+
+class Metrics:
+    '''
+    Named counters and histograms. A disabled Metrics ignores every update.
+    '''
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.monotonic()
+        self.last_dump = time.monotonic()
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def histogram(self, name):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        return self.histograms[name]
+
+    def observe(self, name, seconds):
+        if self.enabled:
+            self.histogram(name).observe(seconds)
+
+    def snapshot(self, gauges=None):
+        # Taken from other threads while the counters keep changing, so
+        # the dicts are copied before they are walked
+        counters = dict(self.counters)
+        histograms = dict(self.histograms)
+        return {"uptime_s": time.monotonic() - self.started,
+                "counters": dict(sorted(counters.items())),
+                "histograms": {name: histogram.snapshot() for name, histogram in sorted(histograms.items())},
+                "gauges": gauges or {}}
+
+    def dump(self, path, snapshot):
+        # Readers never see a half written file
+        # A failed dump is retried at the next interval, not at every tick
+        self.last_dump = time.monotonic()
+        temporary = path + ".tmp"
+        with open(temporary, "w") as dump_file:
+            json.dump(snapshot, dump_file, indent=2)
+        os.replace(temporary, path)
+
+    def dump_due(self, interval=DUMP_INTERVAL):
+        return time.monotonic() - self.last_dump >= interval
@@ -0,0 +1,287 @@
+'''
+This module stores messages for users that are not connected, so that the
+Server can hand them over when the user joins next.
+
+Messages are appended to a log of segment files of SEGMENT_SIZE bytes. A
+segment is allocated up front and memory mapped, appending a message is a
+copy into the mapping and the operating system writes it back in its own
+time. Each record starts with a header
+
+    body length (4 bytes), CRC-32 of the body (4 bytes), timestamp (8 bytes),
+    kind (1 byte), flags (1 byte)
+
+followed by the body "<recipient> <sender> <message>". A zero length marks
+the end of the records of a segment. Handing a message over rewrites its
+kind in place, so the log never has to be rewritten to forget a message.
+
+The offsets of the pending messages of every user are kept in memory and
+rebuilt on start by reading the record headers of every segment. Records
+older than the retention period expire, segments without pending messages
+are deleted and segments with few of them are compacted by copying the
+pending ones to the end of the log.
+'''
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+SEGMENT_SIZE = 4 * 1024 * 1024
+# Seconds a message waits for its recipient
+RETENTION = 7 * 24 * 3600.0
+# Seconds between two compactions
+COMPACT_INTERVAL = 60.0
+# Segments with a smaller share of pending records are compacted
+COMPACT_RATIO = 0.25
+
+HEADER = struct.Struct("!IIdBB")
+# Kinds of records
+PENDING = 1
+DELIVERED = 2
+EXPIRED = 3
+ARCHIVED = 4
+# Flags of a record
+COMPRESSED = 1
+
+
+class Segment:
+    '''
+    One memory mapped segment file. offset is the end of its records,
+    records and pending count its records and the pending ones among them,
+    archived_until is the timestamp of its newest archived record.
+    '''
+    def __init__(self, path, segment_id, size):
+        self.path = path
+        self.segment_id = segment_id
+        exists = os.path.exists(path)
+        self.file = open(path, "r+b" if exists else "w+b")
+        if not exists or os.path.getsize(path) == 0:
+            # An empty file cannot be mapped, it was created but never
+            # sized before a crash and holds no records
+            self.file.truncate(size)
+        self.size = os.path.getsize(path)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.offset = 0
+        self.records = 0
+        self.pending = 0
+        self.archived_until = 0.0
+
+    def scan(self):
+        '''
+        Yields (offset, timestamp, kind, recipient) for every intact record
+        and leaves offset at the end of the last one, a torn record at the
+        end is overwritten by the next append
+        '''
+        offset = 0
+        while offset + HEADER.size <= self.size:
+            length, checksum, timestamp, kind, flags = HEADER.unpack_from(self.map, offset)
+            body_start = offset + HEADER.size
+            if length == 0 or body_start + length > self.size:
+                break
+            body = self.map[body_start:body_start + length]
+            if zlib.crc32(body) != checksum:
+                break
+            yield offset, timestamp, kind, body.split(b" ", 1)[0].decode()
+            offset = body_start + length
+        self.offset = offset
+
+    def fits(self, size):
+        return self.offset + size <= self.size
+
+    def append(self, body, timestamp, kind, flags):
+        offset = self.offset
+        # The body goes first, a record only counts once its header is written
+        self.map[offset + HEADER.size:offset + HEADER.size + len(body)] = body
+        HEADER.pack_into(self.map, offset, len(body), zlib.crc32(body), timestamp, kind, flags)
+        self.offset += HEADER.size + len(body)
+        self.records += 1
+        return offset
+
+    def read(self, offset):
+        # Returns (timestamp, flags, recipient, sender, message bytes)
+        length, checksum, timestamp, kind, flags = HEADER.unpack_from(self.map, offset)
+        body = self.map[offset + HEADER.size:offset + HEADER.size + length]
+        recipient, sender, message = body.split(b" ", 2)
+        return timestamp, flags, recipient.decode(), sender.decode(), message
+
+    def mark(self, offset, kind):
+        # The kind is the byte after length, checksum and timestamp
+        self.map[offset + 16] = kind
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+class OfflineStore:
+    '''
+    Log of the messages waiting for users, kept in directory. With
+    store_all every forwarded message is written to the log, messages for
+    connected users as archived records that are kept for the retention
+    period.
+    '''
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, retention=RETENTION, store_all=False):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.retention = retention
+        self.store_all = store_all
+        self.lock = threading.Lock()
+        self.segments = {}
+        # recipient -> [(segment_id, offset, timestamp)] of its pending messages
+        self.index = {}
+        self.last_compaction = time.monotonic()
+        self.stats = {"stored": 0, "archived": 0, "delivered": 0, "expired": 0,
+                      "compacted": 0, "segments": 0, "recovered": 0}
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+
+    def recover(self):
+        # Segments are read in log order, their names are zero padded ids
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".log"))
+        for name in names:
+            segment = Segment(os.path.join(self.directory, name), int(name[:-4]), self.segment_size)
+            self.segments[segment.segment_id] = segment
+            for offset, timestamp, kind, recipient in segment.scan():
+                segment.records += 1
+                if kind == PENDING:
+                    segment.pending += 1
+                    self.index.setdefault(recipient, []).append((segment.segment_id, offset, timestamp))
+                    self.stats["recovered"] += 1
+                elif kind == ARCHIVED:
+                    segment.archived_until = max(segment.archived_until, timestamp)
+        # Compaction moves records behind newer ones, take() hands them over oldest first
+        for entries in self.index.values():
+            entries.sort(key=lambda entry: entry[2])
+        if self.segments:
+            self.active = self.segments[max(self.segments)]
+        else:
+            self.active = self.new_segment(0, self.segment_size)
+        self.stats["segments"] = len(self.segments)
+
+    def new_segment(self, segment_id, size):
+        segment = Segment(os.path.join(self.directory, f"{segment_id:08d}.log"), segment_id, size)
+        self.segments[segment_id] = segment
+        self.stats["segments"] = len(self.segments)
+        return segment
+
+    def write(self, body, kind, flags, timestamp):
+        # Called with the lock held, returns (segment_id, offset)
+        size = HEADER.size + len(body)
+        if not self.active.fits(size):
+            self.active.map.flush()
+            self.active = self.new_segment(self.active.segment_id + 1, max(self.segment_size, size + HEADER.size))
+        return self.active.segment_id, self.active.append(body, timestamp, kind, flags)
+
+    def append(self, recipient, sender, message, compressed=False):
+        '''
+        Stores message for recipient until take(recipient). message is the
+        text as forwarded, compressed tells whether it is compressed.
+        '''
+        body = recipient.encode() + b" " + sender.encode() + b" " + message.encode("utf-8", "surrogateescape")
+        timestamp = time.time()
+        with self.lock:
+            segment_id, offset = self.write(body, PENDING, COMPRESSED if compressed else 0, timestamp)
+            self.segments[segment_id].pending += 1
+            self.index.setdefault(recipient, []).append((segment_id, offset, timestamp))
+            self.stats["stored"] += 1
+
+    def archive(self, recipients, sender, message, compressed=False):
+        # A message that reached its recipients, kept for the record only
+        body = ",".join(recipients).encode() + b" " + sender.encode() + b" " + message.encode("utf-8", "surrogateescape")
+        timestamp = time.time()
+        with self.lock:
+            segment_id, offset = self.write(body, ARCHIVED, COMPRESSED if compressed else 0, timestamp)
+            self.segments[segment_id].archived_until = timestamp
+            self.stats["archived"] += 1
+
+    def take(self, recipient):
+        '''
+        Returns the pending messages of recipient, oldest first, as
+        (sender, message, compressed) tuples and forgets them
+        '''
+        messages = []
+        with self.lock:
+            entries = self.index.pop(recipient, [])
+            oldest = time.time() - self.retention
+            for segment_id, offset, timestamp in entries:
+                segment = self.segments[segment_id]
+                segment.pending -= 1
+                if timestamp < oldest:
+                    segment.mark(offset, EXPIRED)
+                    self.stats["expired"] += 1
+                    continue
+                timestamp, flags, name, sender, message = segment.read(offset)
+                segment.mark(offset, DELIVERED)
+                messages.append((sender, message.decode("utf-8", "surrogateescape"), bool(flags & COMPRESSED)))
+            self.stats["delivered"] += len(messages)
+        return messages
+
+    def pending(self, recipient):
+        with self.lock:
+            return len(self.index.get(recipient, []))
+
+    def maintain(self, force=False):
+        '''
+        Expires old messages and compacts the log, at most once per
+        COMPACT_INTERVAL unless forced
+        '''
+        if not force and time.monotonic() - self.last_compaction < COMPACT_INTERVAL:
+            return
+        self.last_compaction = time.monotonic()
+        with self.lock:
+            self.expire()
+            self.compact()
+            self.active.map.flush()
+
+    def expire(self):
+        oldest = time.time() - self.retention
+        for recipient in list(self.index):
+            entries = self.index[recipient]
+            keep = []
+            for segment_id, offset, timestamp in entries:
+                if timestamp < oldest:
+                    self.segments[segment_id].mark(offset, EXPIRED)
+                    self.segments[segment_id].pending -= 1
+                    self.stats["expired"] += 1
+                else:
+                    keep.append((segment_id, offset, timestamp))
+            if keep:
+                self.index[recipient] = keep
+            else:
+                del self.index[recipient]
+
+    def compact(self):
+        # Segments holding archived records within the retention period stay
+        oldest = time.time() - self.retention
+        sealed = [segment for segment in self.segments.values()
+                  if segment is not self.active and segment.archived_until < oldest]
+        moving = {segment.segment_id for segment in sealed
+                  if segment.pending and segment.pending < segment.records * COMPACT_RATIO}
+        if moving:
+            # Copy the pending records of sparse segments to the end of the log
+            for recipient, entries in self.index.items():
+                for index, (segment_id, offset, timestamp) in enumerate(entries):
+                    if segment_id not in moving:
+                        continue
+                    segment = self.segments[segment_id]
+                    length, checksum, timestamp, kind, flags = HEADER.unpack_from(segment.map, offset)
+                    body = segment.map[offset + HEADER.size:offset + HEADER.size + length]
+                    new_id, new_offset = self.write(body, PENDING, flags, timestamp)
+                    self.segments[new_id].pending += 1
+                    segment.pending -= 1
+                    entries[index] = (new_id, new_offset, timestamp)
+                    self.stats["compacted"] += 1
+        for segment in sealed:
+            if segment.pending == 0:
+                segment.close()
+                os.remove(segment.path)
+                del self.segments[segment.segment_id]
+        self.stats["segments"] = len(self.segments)
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments.values():
+                segment.close()
+            self.segments.clear()
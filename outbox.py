@@ -0,0 +1,112 @@
+'''
+This module implements the bounded outbound queue the Server keeps for every
+client. Everything sent to a client (forwarded messages, user lists, errors)
+goes through its Outbox and is delivered one transfer at a time, so a slow
+or dead client can only hold up its own queue.
+'''
+import collections
+import threading
+
+HIGH_WATERMARK = 64
+# The policies applied to a full queue
+REJECT = "reject"
+DROP = "drop"
+POLICIES = (REJECT, DROP)
+
+
+class Outbox:
+    '''
+    Queue of transfers waiting for one client. A transfer is a
+    (phases, origin) tuple, phases as built by Server.make_forward_phases()
+    and origin the address of the client that caused it, if any.
+
+    Once high_watermark transfers are queued the outbox is full and stays
+    full until it was drained down to low_watermark. A full outbox either
+    rejects new transfers or drops its oldest queued one, depending on
+    policy.
+    '''
+    def __init__(self, address, high_watermark=HIGH_WATERMARK, low_watermark=None, policy=REJECT):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy}")
+        self.address = address
+        self.high_watermark = max(1, high_watermark)
+        if low_watermark is None:
+            low_watermark = self.high_watermark // 2
+        self.low_watermark = min(low_watermark, self.high_watermark - 1)
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.transfers = collections.deque()
+        self.full = False
+        self.busy = False
+        # A transfer was taken by get() and is not done() yet
+        self.in_flight = False
+        self.closed = False
+        self.stats = {"depth": 0, "max_depth": 0, "queued": 0, "delivered": 0, "failed": 0,
+                      "rejected": 0, "dropped": 0, "full": 0, "cancelled": 0}
+
+    def put(self, transfer):
+        '''
+        Queues transfer. Returns (start, refused): start is True when
+        nothing is being delivered from this outbox and its delivery has to
+        be started, refused is the transfer that was rejected or dropped to
+        make room, or None.
+        '''
+        with self.lock:
+            if self.closed:
+                self.stats["cancelled"] += 1
+                return False, None
+            refused = None
+            if self.full:
+                if self.policy == REJECT:
+                    self.stats["rejected"] += 1
+                    return False, transfer
+                refused = self.transfers.popleft()
+                self.stats["dropped"] += 1
+            self.transfers.append(transfer)
+            self.stats["queued"] += 1
+            self.update_depth()
+            if len(self.transfers) >= self.high_watermark and not self.full:
+                self.full = True
+                self.stats["full"] += 1
+            start = not self.busy
+            self.busy = True
+            return start, refused
+
+    def get(self):
+        '''
+        Next transfer to deliver. None when the queue is empty, delivery
+        then stops until put() starts it again.
+        '''
+        with self.lock:
+            if not self.transfers:
+                self.busy = False
+                return None
+            transfer = self.transfers.popleft()
+            self.in_flight = True
+            self.update_depth()
+            if self.full and len(self.transfers) <= self.low_watermark:
+                self.full = False
+            return transfer
+
+    def close(self):
+        '''
+        Cancels every queued transfer and refuses new ones, the client is
+        gone. The transfer in flight is counted as cancelled too, whatever
+        done() later says about it.
+        '''
+        with self.lock:
+            self.closed = True
+            self.stats["cancelled"] += len(self.transfers) + self.in_flight
+            self.in_flight = False
+            self.transfers.clear()
+            self.update_depth()
+
+    def done(self, delivered):
+        with self.lock:
+            if self.in_flight:
+                self.in_flight = False
+                self.stats["delivered" if delivered else "failed"] += 1
+
+    def update_depth(self):
+        self.stats["depth"] = len(self.transfers)
+        self.stats["max_depth"] = max(self.stats["max_depth"], len(self.transfers))
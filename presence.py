@@ -0,0 +1,77 @@
+'''
+This module pushes presence events. Clients that subscribed get the joins
+and leaves of the roster without asking for them: changes are collected for
+PRESENCE_INTERVAL seconds and every subscriber then receives one delta list
+response covering all of them, so a burst of joins costs one transfer per
+subscriber instead of one per join.
+'''
+import threading
+
+# Seconds presence changes are collected before they are pushed
+PRESENCE_INTERVAL = 0.05
+
+
+class Presence:
+    '''
+    Subscribers of the roster by address, each with the roster version it
+    knows. push(address, since) queues a list response with the changes
+    after since towards address.
+    '''
+    def __init__(self, roster, push, interval=PRESENCE_INTERVAL):
+        self.roster = roster
+        self.push = push
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.scheduled = False
+        self.stats = {"pushes": 0, "flushes": 0}
+
+    def subscribe(self, address, version):
+        with self.lock:
+            self.subscribers[address] = version
+        self.changed()
+
+    def unsubscribe(self, address):
+        with self.lock:
+            self.subscribers.pop(address, None)
+
+    def changed(self):
+        '''
+        Called on every roster change, the push follows within the interval
+        '''
+        with self.lock:
+            if self.scheduled or not self.subscribers:
+                return
+            self.scheduled = True
+        self.schedule()
+
+    def schedule(self):
+        timer = threading.Timer(self.interval, self.flush)
+        timer.daemon = True
+        timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.scheduled = False
+            version = self.roster.version
+            behind = [(address, since) for address, since in self.subscribers.items() if since != version]
+            for address, since in behind:
+                self.subscribers[address] = version
+            self.stats["flushes"] += 1
+            self.stats["pushes"] += len(behind)
+        # A change racing the push is sent again with the next one, replaying
+        # joins and leaves in order leaves the client's roster the same
+        for address, since in behind:
+            self.push(address, since)
+
+
+class AsyncPresence(Presence):
+    '''
+    Presence for the asyncio server, pushes are queued from the event loop
+    '''
+    def __init__(self, roster, push, loop, interval=PRESENCE_INTERVAL):
+        super().__init__(roster, push, interval)
+        self.loop = loop
+
+    def schedule(self):
+        self.loop.call_later(self.interval, self.flush)
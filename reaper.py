@@ -0,0 +1,77 @@
+'''
+This module finds the sessions of clients that went away without a
+disconnect. Every packet of a client pushes its idle deadline
+SESSION_TIMEOUT seconds ahead, clients that have nothing to say send a
+keepalive every client.KEEPALIVE_INTERVAL seconds, so a client silent for
+several intervals is dead and the Server reaps its session.
+
+The deadlines live in a hashed timing wheel: one slot of keys per TICK
+seconds, SESSION_TIMEOUT seconds around. Touching a key moves it between two
+slots and reaping only visits the slots the clock moved past, so the cost
+follows the number of expired sessions rather than the number of sessions.
+'''
+import math
+import threading
+
+# Four missed keepalives
+SESSION_TIMEOUT = 60.0
+# Resolution of the deadlines, sessions are reaped at most one tick late
+TICK = 1.0
+
+
+class TimerWheel:
+    '''
+    Idle deadlines of keys. touch(key, now) sets the deadline of key to
+    now + timeout, expire(now) removes and returns the keys whose deadline
+    passed.
+    '''
+    def __init__(self, timeout=SESSION_TIMEOUT, tick=TICK):
+        self.timeout = timeout
+        self.tick = tick
+        self.lock = threading.Lock()
+        self.slots = [set() for _ in range(int(math.ceil(timeout / tick)) + 1)]
+        # key -> tick its deadline falls in
+        self.ticks = {}
+        # Next tick to be reaped
+        self.cursor = None
+        self.stats = {"sessions": 0, "expired": 0}
+
+    def touch(self, key, now):
+        deadline_tick = int((now + self.timeout) // self.tick)
+        with self.lock:
+            old_tick = self.ticks.get(key)
+            if old_tick == deadline_tick:
+                return
+            if old_tick is not None:
+                self.slots[old_tick % len(self.slots)].discard(key)
+            elif self.cursor is None:
+                self.cursor = int(now // self.tick)
+            self.slots[deadline_tick % len(self.slots)].add(key)
+            self.ticks[key] = deadline_tick
+            self.stats["sessions"] = len(self.ticks)
+
+    def remove(self, key):
+        with self.lock:
+            old_tick = self.ticks.pop(key, None)
+            if old_tick is not None:
+                self.slots[old_tick % len(self.slots)].discard(key)
+                self.stats["sessions"] = len(self.ticks)
+
+    def expire(self, now):
+        current = int(now // self.tick)
+        expired = []
+        with self.lock:
+            if self.cursor is None:
+                return expired
+            # After a long pause every slot is visited once
+            self.cursor = max(self.cursor, current - len(self.slots))
+            while self.cursor < current:
+                slot = self.slots[self.cursor % len(self.slots)]
+                for key in [key for key in slot if self.ticks[key] < current]:
+                    slot.discard(key)
+                    del self.ticks[key]
+                    expired.append(key)
+                self.cursor += 1
+            self.stats["sessions"] = len(self.ticks)
+            self.stats["expired"] += len(expired)
+        return expired
@@ -0,0 +1,78 @@
+'''
+This module implements the receiving side of a sequence space. Packets that
+arrive ahead of a gap are held instead of dropped, so once the missing
+packet is retransmitted everything behind it is released at once and a
+single cumulative ACK confirms the whole window.
+
+Which of the next WINDOW sequence numbers are held is tracked in a bitmap
+that slides along with the next expected sequence number, packets below it
+or already held are duplicates and are suppressed.
+'''
+
+# Packets held ahead of a gap at most
+WINDOW = 64
+IN_ORDER = "in_order"
+BUFFERED = "buffered"
+DUPLICATE = "duplicate"
+BEYOND = "beyond"
+# Sequence numbers are 32 bits and wrap around
+SEQ_SPACE = 2**32
+
+
+def is_after(seq, other):
+    # Serial number comparison, seq is later than other across a wrap around
+    return 0 < (seq - other) % SEQ_SPACE < SEQ_SPACE // 2
+
+
+class ReorderBuffer:
+    '''
+    Releases the items of a sequence space in order. accept() returns
+    (outcome, items): items are the (seq, item) tuples that became
+    deliverable, in order, and outcome one of IN_ORDER, BUFFERED, DUPLICATE
+    or BEYOND for packets too far ahead to be held.
+    '''
+    def __init__(self, expected=0, window=WINDOW):
+        self.window = window
+        self.expected = expected
+        # Bit n is set when expected + 1 + n is held
+        self.bitmap = 0
+        self.held = {}
+        self.stats = {IN_ORDER: 0, BUFFERED: 0, DUPLICATE: 0, BEYOND: 0, "released": 0}
+
+    def reset(self, expected):
+        self.expected = expected
+        self.bitmap = 0
+        self.held.clear()
+
+    @property
+    def last_in_order(self):
+        return self.expected - 1
+
+    def accept(self, seq, item):
+        offset = seq - self.expected
+        if offset < 0:
+            self.stats[DUPLICATE] += 1
+            return DUPLICATE, []
+        if offset > self.window:
+            self.stats[BEYOND] += 1
+            return BEYOND, []
+        if offset > 0:
+            bit = 1 << (offset - 1)
+            if self.bitmap & bit:
+                self.stats[DUPLICATE] += 1
+                return DUPLICATE, []
+            self.bitmap |= bit
+            self.held[seq] = item
+            self.stats[BUFFERED] += 1
+            return BUFFERED, []
+        # Fills the gap, release whatever was held right behind it
+        released = [(seq, item)]
+        self.expected += 1
+        while self.bitmap & 1:
+            self.bitmap >>= 1
+            released.append((self.expected, self.held.pop(self.expected)))
+            self.expected += 1
+        self.bitmap >>= 1
+        self.stats[IN_ORDER] += 1
+        self.stats["released"] += len(released) - 1
+        return IN_ORDER, released
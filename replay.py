@@ -0,0 +1,327 @@
+'''
+This module replays a trace recorded with `server.py -T FILE` against a
+fresh Server on localhost, to compare Server versions on real traffic. The
+traces of the workers of `-m workers` are replayed together, merged by the
+wall clock time they were started at.
+
+Every client of the trace is stood in for by a socket of its own. The
+datagrams the clients sent are sent again at their recorded times, sped up
+by a factor, with two exceptions. Their ACKs are not replayed: the new
+Server numbers its transfers differently, so its packets are acknowledged
+as they arrive, like a Client would. And the disconnects that end a client's
+part of the trace wait until the Server delivered what it owes the client,
+otherwise a sped up replay would cut deliveries short. The messages the
+Server delivers are counted per client and checked against the trace.
+Throughput and latency are printed as JSON.
+'''
+import getopt
+import json
+import random
+import selectors
+import socket
+import sys
+import threading
+import time
+import capture
+import logs
+import metrics
+import reorder
+import util
+import wire
+from server import Server
+
+# Seconds to wait for the last deliveries once every datagram was sent
+DRAIN_TIMEOUT = 5.0
+# The Server picks its first sequence number at random, the same seed
+# makes every replay of a trace number its transfers alike. Workers pick
+# theirs in their own processes and are left to it.
+SEED = 0
+
+
+def is_delivery(typeofP, info):
+    # The end packet of a message forwarded to a client
+    return typeofP == "end" and info.startswith("forward_message")
+
+
+def is_teardown(typeofP, info, data):
+    # The packets of a disconnect, or the empty datagram of an interrupted client
+    return not len(data) or (typeofP in ("data", "end") and info.startswith("disconnect"))
+
+
+def read_traces(paths):
+    '''
+    Returns the records of every trace in paths, merged into one timeline
+    '''
+    traces = [capture.read_trace(path) for path in paths]
+    first = min(started for started, records in traces)
+    merged = []
+    for started, records in traces:
+        merged.extend((offset + started - first, direction, address, data)
+                      for offset, direction, address, data in records)
+    merged.sort(key=lambda record: record[0])
+    return merged
+
+
+def expected_deliveries(records):
+    '''
+    Returns the number of messages the Server of the trace delivered to
+    every client address, retransmissions counted once
+    '''
+    seen = set()
+    counts = {}
+    for offset, direction, address, data in records:
+        if direction != capture.SENT:
+            continue
+        typeofP, seqno, info, valid = wire.parse_packet(data)
+        if valid and is_delivery(typeofP, info) and (address, seqno) not in seen:
+            seen.add((address, seqno))
+            counts[address] = counts.get(address, 0) + 1
+    return counts
+
+
+class ReplayPeer:
+    '''
+    Stands in for the client of the trace at address. pending holds the
+    send times of the end packets waiting for their ACK, teardown the
+    packets held back until the deliveries are in.
+    '''
+    def __init__(self, address):
+        self.address = address
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.setblocking(False)
+        self.receiver = reorder.ReorderBuffer()
+        self.transfer_id = None
+        self.transfer_started = None
+        self.delivered = 0
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.teardown = []
+
+
+class Replay:
+    '''
+    Replays the traces in paths. speed 1 keeps the recorded timing, 10 sends
+    ten times as fast and 0 as fast as possible. mode is thread, async or
+    workers like for the Server.
+    '''
+    def __init__(self, paths, speed=1.0, mode="thread", port=15200, window=3, workers=None,
+                 drain_timeout=DRAIN_TIMEOUT):
+        self.paths = paths
+        self.speed = speed
+        self.mode = mode
+        self.port = port
+        self.window = window
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self.server = None
+        self.peers = {}
+        self.expected = 0
+        self.delivered = 0
+        self.last_delivery = None
+        self.done = threading.Event()
+        self.stop_event = threading.Event()
+        self.ack_latency = metrics.Histogram()
+        self.delivery_latency = metrics.Histogram()
+
+    def start_server(self):
+        rng = random.Random(SEED)
+        if self.mode == "async":
+            from async_server import AsyncServer
+            self.server = AsyncServer("localhost", self.port, self.window)
+        elif self.mode == "workers":
+            from workers import WorkerPool
+            self.server = WorkerPool("localhost", self.port, self.window, self.workers)
+        else:
+            self.server = Server("localhost", self.port, self.window)
+        if self.mode != "workers":
+            self.server.next_seq_num = rng.randint(1, 1000)
+        self.server.max_clients = max(util.MAX_NUM_CLIENTS, len(self.peers))
+        server_thread = threading.Thread(target=self.server.start)
+        server_thread.daemon = True
+        server_thread.start()
+        if self.mode != "workers":
+            # Port 0 picks a free port
+            self.port = self.server.bound_address[1]
+        # Workers take a moment to bind their sockets
+        time.sleep(0.5 if self.mode == "workers" else 0.1)
+
+    def run(self):
+        '''
+        Replays the trace and returns the results as a dict
+        '''
+        records = read_traces(self.paths)
+        outgoing = []
+        for offset, direction, address, data in records:
+            if direction != capture.RECEIVED:
+                continue
+            typeofP, seqno, info, valid = wire.parse_packet(data)
+            if typeofP == "ack":
+                continue
+            if address not in self.peers:
+                self.peers[address] = ReplayPeer(address)
+            peer = self.peers[address]
+            if is_teardown(typeofP, info, data):
+                peer.teardown.append((offset, peer, data, False, seqno))
+                continue
+            # A disconnect followed by more packets of the client is replayed in place
+            outgoing.extend(peer.teardown)
+            peer.teardown = []
+            outgoing.append((offset, peer, data, typeofP == "end", seqno))
+        outgoing.sort(key=lambda packet: packet[0])
+        expected = expected_deliveries(records)
+        self.expected = sum(expected.values())
+
+        self.start_server()
+        receive_thread = threading.Thread(target=self.receive_handler)
+        receive_thread.daemon = True
+        receive_thread.start()
+
+        server_address = ("127.0.0.1", self.port)
+        started_at = time.monotonic()
+        for offset, peer, data, is_end, seqno in outgoing:
+            if self.speed:
+                delay = started_at + offset / self.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            if is_end:
+                with peer.lock:
+                    peer.pending.setdefault(seqno, time.monotonic())
+            peer.sock.sendto(data, server_address)
+        sent_at = time.monotonic()
+        if self.delivered < self.expected:
+            self.done.wait(self.drain_timeout)
+        finished = max(sent_at, self.last_delivery or sent_at)
+        duration = finished - started_at
+        for peer in self.peers.values():
+            for packet in peer.teardown:
+                peer.sock.sendto(packet[2], server_address)
+
+        self.stop_event.set()
+        receive_thread.join()
+        self.server.stop()
+        for peer in self.peers.values():
+            peer.sock.close()
+
+        mismatched = {f"{address[0]}:{address[1]}": {"expected": expected.get(address, 0), "delivered": peer.delivered}
+                      for address, peer in self.peers.items() if peer.delivered != expected.get(address, 0)}
+        return {
+            "traces": self.paths,
+            "mode": self.mode,
+            "speed": self.speed,
+            "clients": len(self.peers),
+            "records": len(records),
+            "replayed": len(outgoing) + sum(len(peer.teardown) for peer in self.peers.values()),
+            "trace_duration_s": records[-1][0] - records[0][0] if records else 0.0,
+            "duration_s": duration,
+            "datagrams_per_sec": len(outgoing) / duration if duration > 0 else None,
+            "messages_per_sec": self.delivered / duration if duration > 0 else None,
+            "expected": self.expected,
+            "delivered": self.delivered,
+            "mismatched": mismatched,
+            "ack_latency": self.ack_latency.snapshot(),
+            "delivery_latency": self.delivery_latency.snapshot(),
+            "server_retransmissions": getattr(self.server, "retransmissions", None),
+        }
+
+    def receive_handler(self):
+        selector = selectors.DefaultSelector()
+        for peer in self.peers.values():
+            selector.register(peer.sock, selectors.EVENT_READ, peer)
+        buffer = bytearray(wire.BUFFER_SIZE)
+        view = memoryview(buffer)
+        while not self.stop_event.is_set():
+            for key, events in selector.select(0.1):
+                peer = key.data
+                while True:
+                    try:
+                        nbytes, address = peer.sock.recvfrom_into(buffer)
+                    except (BlockingIOError, OSError):
+                        break
+                    self.handle_packet(peer, view[:nbytes], address)
+        selector.close()
+
+    def handle_packet(self, peer, packet, server_address):
+        typeofP, seqno, info, valid = wire.parse_packet(packet)
+        if not valid:
+            return
+        now = time.monotonic()
+        binary = wire.is_binary(packet)
+        if typeofP == "ack":
+            with peer.lock:
+                acked = [seq for seq in peer.pending if seq <= seqno]
+                for seq in acked:
+                    self.ack_latency.observe(now - peer.pending.pop(seq))
+            return
+        if typeofP == "start":
+            if seqno != peer.transfer_id:
+                peer.transfer_id = seqno
+                peer.transfer_started = now
+                peer.receiver.reset(seqno + 1)
+            peer.sock.sendto(wire.make_packet("ack", seqno, "", binary), server_address)
+            return
+        outcome, released = peer.receiver.accept(seqno, (typeofP, info))
+        for seq_num, (packet_type, payload) in released:
+            if is_delivery(packet_type, payload):
+                peer.delivered += 1
+                self.delivered += 1
+                self.last_delivery = now
+                self.delivery_latency.observe(now - peer.transfer_started)
+                if self.delivered >= self.expected:
+                    self.done.set()
+        if released or outcome == reorder.DUPLICATE:
+            peer.sock.sendto(wire.make_packet("ack", peer.receiver.last_in_order, "", binary), server_address)
+
+
+if __name__ == "__main__":
+    def helper():
+        print("Replay")
+        print("-f FILE | --file=FILE A trace to replay, recorded with server.py -T FILE. Repeat for the traces of workers")
+        print("-x SPEED | --speed=SPEED 1 keeps the recorded timing, 0 sends as fast as possible, defaults to 1")
+        print("-p PORT | --port=PORT The port of the replay server, defaults to 15200")
+        print("-w WINDOW | --window=WINDOW The window size, defaults to 3")
+        print("-m MODE | --mode=MODE thread, async or workers, defaults to thread")
+        print("-W WORKERS | --workers=WORKERS Server processes in workers mode, defaults to the number of cores")
+        print("-o FILE | --output=FILE Also write the JSON results to FILE")
+        print("-h | --help Print this help")
+
+    try:
+        OPTS, ARGS = getopt.getopt(sys.argv[1:], "f:x:p:w:m:W:o:h",
+                                   ["file=", "speed=", "port=", "window=", "mode=", "workers=", "output=", "help"])
+    except getopt.GetoptError:
+        helper()
+        exit(1)
+
+    TRACE_FILES = []
+    OPTIONS = {}
+    OUTPUT = None
+    for o, a in OPTS:
+        if o in ("-f", "--file"):
+            TRACE_FILES.append(a)
+        elif o in ("-x", "--speed"):
+            OPTIONS["speed"] = float(a)
+        elif o in ("-p", "--port"):
+            OPTIONS["port"] = int(a)
+        elif o in ("-w", "--window"):
+            OPTIONS["window"] = int(a)
+        elif o in ("-m", "--mode"):
+            OPTIONS["mode"] = a
+        elif o in ("-W", "--workers"):
+            OPTIONS["workers"] = int(a)
+        elif o in ("-o", "--output"):
+            OUTPUT = a
+        elif o in ("-h", "--help"):
+            helper()
+            exit()
+
+    if not TRACE_FILES:
+        print("Missing trace file.")
+        helper()
+        exit(1)
+
+    logs.configure("warning")
+    RESULTS = Replay(TRACE_FILES, **OPTIONS).run()
+    print(json.dumps(RESULTS, indent=2))
+    if OUTPUT:
+        with open(OUTPUT, "w") as f:
+            json.dump(RESULTS, f, indent=2)
@@ -0,0 +1,101 @@
+'''
+This module keeps the chat rooms of the Server. A message to `#room` goes
+to every member of the room without the sender listing them, so the Server
+neither receives nor resolves the member names of every message.
+
+The members of a room are kept as a frozenset of client addresses that is
+replaced on every join and leave. Members change far less often than
+messages are sent, so forwarding a message takes the current set as it is,
+without a lock and without a copy.
+'''
+import threading
+
+PREFIX = "#"
+# Longest room name, the prefix included
+MAX_NAME = 64
+
+
+def is_room(name):
+    return name.startswith(PREFIX) and 1 < len(name) <= MAX_NAME
+
+
+class Rooms:
+    '''
+    Rooms and their members. members maps a room to the frozenset of the
+    addresses in it and memberships an address to the rooms it is in.
+    Passing shared mappings and lock lets several processes share the
+    rooms, see workers.py.
+    '''
+    def __init__(self, members=None, memberships=None, lock=None):
+        self.members = {} if members is None else members
+        self.memberships = {} if memberships is None else memberships
+        self.lock = lock or threading.Lock()
+        self.stats = {"created": 0, "joined": 0, "left": 0, "removed": 0}
+
+    def create(self, room, address):
+        '''
+        Creates room with address as its first member, returns False if
+        it exists already
+        '''
+        with self.lock:
+            if room in self.members:
+                return False
+            self.members[room] = frozenset((address,))
+            self.memberships[address] = self.memberships.get(address, frozenset()) | {room}
+            self.stats["created"] += 1
+        return True
+
+    def join(self, room, address):
+        # Returns False if there is no such room
+        with self.lock:
+            members = self.members.get(room)
+            if members is None:
+                return False
+            if address not in members:
+                self.members[room] = members | {address}
+                self.memberships[address] = self.memberships.get(address, frozenset()) | {room}
+                self.stats["joined"] += 1
+        return True
+
+    def leave(self, room, address):
+        # Returns False if address is not in room, the last member to
+        # leave removes the room
+        with self.lock:
+            members = self.members.get(room)
+            if members is None or address not in members:
+                return False
+            self.remove_member(room, members, address)
+            rooms = self.memberships.get(address, frozenset()) - {room}
+            if rooms:
+                self.memberships[address] = rooms
+            else:
+                self.memberships.pop(address, None)
+        return True
+
+    def leave_all(self, address):
+        # Called when the client disconnects
+        with self.lock:
+            for room in self.memberships.pop(address, frozenset()):
+                members = self.members.get(room)
+                if members is not None and address in members:
+                    self.remove_member(room, members, address)
+
+    def remove_member(self, room, members, address):
+        # Called with the lock held
+        members = members - {address}
+        if members:
+            self.members[room] = members
+        else:
+            del self.members[room]
+            self.stats["removed"] += 1
+        self.stats["left"] += 1
+
+    def get(self, room):
+        '''
+        Returns the frozenset of the addresses in room, empty if there is no
+        such room
+        '''
+        return self.members.get(room, frozenset())
+
+    def __len__(self):
+        return len(self.members)
@@ -0,0 +1,89 @@
+'''
+This module keeps the sorted list of connected users the Server answers
+`list` requests from. Every join and leave bumps the roster version, so a
+client that already knows the roster of some version only needs the changes
+made since, and the full answer is built once per version instead of once
+per request.
+'''
+import bisect
+import collections
+import threading
+
+# Changes remembered for delta answers, older versions get the full roster
+HISTORY = 1024
+FULL = "full"
+DELTA = "delta"
+# Longest "<version> <kind> " a response chunk starts with
+MAX_HEADER = f"{2**32} {DELTA} "
+
+
+def pack(items, room):
+    '''
+    Joins items with spaces into chunks of at most room bytes. Always
+    returns at least one, possibly empty, chunk.
+    '''
+    chunks = []
+    current = []
+    size = 0
+    for item in items:
+        length = len(item.encode())
+        if current and size + 1 + length > room:
+            chunks.append(' '.join(current))
+            current = []
+            size = 0
+        size += length + (1 if current else 0)
+        current.append(item)
+    chunks.append(' '.join(current))
+    return chunks
+
+
+class Roster:
+    '''
+    Sorted usernames with a version number. changes holds the last `history`
+    changes as (version, "+name") for joins and (version, "-name") for
+    leaves.
+    '''
+    def __init__(self, history=HISTORY):
+        self.lock = threading.Lock()
+        self.names = []
+        self.version = 0
+        self.changes = collections.deque(maxlen=history)
+        # room -> chunks of the full roster of the current version
+        self.cache = {}
+
+    def add(self, name):
+        with self.lock:
+            index = bisect.bisect_left(self.names, name)
+            if index < len(self.names) and self.names[index] == name:
+                return
+            self.names.insert(index, name)
+            self.changed("+" + name)
+
+    def remove(self, name):
+        with self.lock:
+            index = bisect.bisect_left(self.names, name)
+            if index == len(self.names) or self.names[index] != name:
+                return
+            del self.names[index]
+            self.changed("-" + name)
+
+    def changed(self, change):
+        self.version += 1
+        self.changes.append((self.version, change))
+        self.cache.clear()
+
+    def answer(self, since, room):
+        '''
+        Returns (version, kind, chunks) for a client that knows the roster
+        of version since (0 for none). kind is DELTA when chunks hold the
+        changes made after since and FULL when they hold every name, each
+        chunk at most room bytes.
+        '''
+        with self.lock:
+            if 0 < since <= self.version and (since == self.version or
+                                              (self.changes and self.changes[0][0] <= since + 1)):
+                changes = [change for version, change in self.changes if version > since]
+                return self.version, DELTA, pack(changes, room)
+            if room not in self.cache:
+                self.cache[room] = pack(self.names, room)
+            return self.version, FULL, self.cache[room]
@@ -0,0 +1,57 @@
+'''
+This module implements the retransmission timeout estimation (RFC 6298)
+shared by every sender of the Client and the Server.
+'''
+import util
+
+# Bounds of the retransmission timeout in seconds
+MIN_RTO = 0.05
+MAX_RTO = 8.0
+# Gains of the smoothed RTT and RTT variation
+ALPHA = 1 / 8
+BETA = 1 / 4
+K = 4
+
+
+class RttEstimator:
+    '''
+    Tracks the smoothed round trip time and its variation towards one peer.
+    Senders must follow Karn's algorithm: only packets that were never
+    retransmitted are sampled, and every timeout calls backoff().
+    '''
+    def __init__(self, initial_rto=util.TIME_OUT, min_rto=MIN_RTO, max_rto=MAX_RTO):
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.srtt = None
+        self.rttvar = None
+        self.rto = min(max(initial_rto, min_rto), max_rto)
+        self.samples = 0
+        self.backoffs = 0
+        # metrics.Histogram fed with every sample, if any
+        self.histogram = None
+
+    def sample(self, rtt):
+        '''
+        Feeds the round trip time of an unambiguous ACK
+        '''
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+        self.rto = min(max(self.srtt + K * self.rttvar, self.min_rto), self.max_rto)
+        self.samples += 1
+        if self.histogram is not None:
+            self.histogram.observe(rtt)
+
+    def backoff(self):
+        '''
+        Doubles the timeout after a retransmission
+        '''
+        self.rto = min(self.rto * 2, self.max_rto)
+        self.backoffs += 1
+
+    def as_dict(self):
+        return {"srtt": self.srtt, "rttvar": self.rttvar, "rto": self.rto,
+                "samples": self.samples, "backoffs": self.backoffs}
@@ -1,3 +1,4 @@
+import json
 import queue
 import random
 import sys
@@ -5,259 +6,762 @@ import getopt
 import socket
 import util
 import threading
+import time
+import window
+import fanout
+import outbox
+import wire
+import batchio
+import delack
+import codec
+import rtt
+import demux
+import reorder
+import roster
+import presence
+import rooms
+import reaper
+import offline
+import metrics
+import logs
+import capture
+from impairment import Impairment, ImpairedSocket
+
+LOG = logs.get_logger("server")
+
+# Reassembly limits for the message a client is sending
+MAX_MESSAGE_SIZE = 64 * 1024
+MAX_FRAGMENTS = 256
+
+
+def add_stats(totals, stats):
+    # Counters add up, queue depths are maxima
+    for name, value in stats.items():
+        if name in ("depth", "max_depth"):
+            totals[name] = max(totals.get(name, 0), value)
+        else:
+            totals[name] = totals.get(name, 0) + value
+
+
 class Server:
-    def __init__(self, dest, port, window):
+    def __init__(self, dest, port, window, reuse_port=False):
         self.server_addr = dest
         self.server_port = port
+        self.window = int(window)
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Several worker processes share the port, see workers.py
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.sock.settimeout(None)
         self.sock.bind((self.server_addr, self.server_port))
+        # stop() wakes the receive loop here, the socket may be closed by then
+        self.bound_address = self.sock.getsockname()
 
         self.username_to_address = {}
         self.address_to_username = {}
         self.connection_state = {} 
+        # Sorted usernames, list requests are answered from it
+        self.roster = roster.Roster()
+        # Clients pushed the roster changes instead of polling with list
+        self.presence = presence.Presence(self.roster, self.push_presence)
+        # Members of the rooms are kept as address sets, see rooms.py
+        self.rooms = rooms.Rooms()
+        # Encoded list responses of the current roster version, shared by
+        # the clients behind by the same changes
+        self.list_payloads = (0, {})
+        self.max_clients = util.MAX_NUM_CLIENTS
+        self.retransmissions = 0
+        # Bounds of the outbound queue of every client
+        self.outbox_high_watermark = outbox.HIGH_WATERMARK
+        self.outbox_low_watermark = None
+        self.overflow_policy = outbox.REJECT
+        self.mtu = wire.PATH_MTU
+        self.max_message_size = MAX_MESSAGE_SIZE
+        self.max_fragments = MAX_FRAGMENTS
+        self.impairment = None
         self.stop_event = threading.Event()
         self.ack_queue = queue.Queue()
+        # Sequence numbers of outgoing transfers come from one counter, so
+        # an ACK for one transfer can never be taken for another's
+        self.seq_lock = threading.Lock()
+        self.next_seq_num = random.randint(1, 1000)
+        # Held while a packet is handled. Other threads that change the
+        # user directory or queue transfers take it too, so the transfers
+        # of a client reach its outbox in the order they were numbered
+        self.dispatch_lock = threading.Lock()
+        self.receiver = None
+        self.receive_thread = None
+        self.ack_delay = delack.ACK_DELAY
+        self.delayed_acks = delack.DelayedAcks(self.send_ack, self.ack_delay)
+        # Counters of the outboxes, ACK dispatchers and reorder buffers of
+        # sessions that are gone, the stats add them to the live ones
+        self.stats_lock = threading.Lock()
+        self.departed_stats = {"outbox": {}, "acks": {}, "receiver": {}}
+        # Idle deadlines of the sessions, silent clients are reaped
+        self.session_timeout = reaper.SESSION_TIMEOUT
+        self.sessions = reaper.TimerWheel(self.session_timeout)
+        # Messages for users that are not connected, see offline.py
+        self.store = None
+        self.metrics = metrics.Metrics()
+        # Where the metrics are dumped every metrics.DUMP_INTERVAL seconds
+        self.metrics_file = None
+        # Every datagram received and sent is recorded here, see capture.py
+        self.trace = None
+        # Packets send() queued while a batch of datagrams is handled
+        self.send_batch = None
+        # Every transfer of the server goes out through it, see fanout.py
+        self.fanout = fanout.FanoutSender(self.sock, self.estimator, self.count_retransmissions, self.ack_dispatcher)
 
     def start(self):
-        while True:
-            data, client_address = self.sock.recvfrom(2048)
-            decoded_data = data.decode()
-            typeofP, seqno, info, checksum = util.parse_packet(decoded_data)
-            parts = info.split()
-            if typeofP == "start":
-                if util.validate_checksum(decoded_data):
-                    self.connection_state[client_address] = {"expected_seq_num": int(seqno) + 1, "message_chunks": [],"ack_queue": queue.Queue()}
-                    ack_packet = util.make_packet("ack", int(seqno), "")
-                    self.sock.sendto(ack_packet.encode(), client_address)
-            elif typeofP == "data":
-                try:
-                    msg_type = parts[0]
-                    msg_len = int(parts[1])
-                except IndexError:
-                    print("Index error part is", parts)
-                if util.validate_checksum(decoded_data):
-                    if msg_type == "join":
-                        username = parts[2]
-                        if len(self.username_to_address) >= util.MAX_NUM_CLIENTS:
-                            msg = util.make_message("ERR_SERVER_FULL", 1, username)
-                            packet = util.make_packet("ack", int(seqno), msg)
-                            self.sock.sendto(packet.encode(), client_address)
-                            print("Disconnected: server full")
-                        elif username in self.username_to_address:
-                            msg = util.make_message("ERR_USERNAME_UNAVAILABLE", 1, username)
-                            packet = util.make_packet("ack", int(seqno), msg)
-                            self.sock.sendto(packet.encode(), client_address)
-                            print("Disconnected: username not available")
-                        else:
-                            ack_packet = util.make_packet("ack", int(seqno), "")
-                            self.sock.sendto(ack_packet.encode(), client_address)
-                            self.username_to_address[username] = client_address
-                            self.address_to_username[client_address] = username
-                            # self.connection_state[client_address] = {"ack_queue": queue.Queue()}
-                            print(f"join: {username}")
-                    elif msg_type == "disconnect":
-                        ack_packet = util.make_packet("ack", int(seqno), "")
-                        self.sock.sendto(ack_packet.encode(), client_address)
-                        username = self.address_to_username.get(client_address, "Unknown")
-                        del self.address_to_username[client_address]
-                        del self.username_to_address[username]
-                        print(f"disconnected: {username}")
-                    elif msg_type == "request_users_list":
-                        usernames = ' '.join(sorted(self.username_to_address.keys()))
-                        msg = util.make_message("response_users_list", 3, usernames)
-                        client_thread = threading.Thread(target=self.handle_request_users_list, args=(client_address, msg , int(seqno)))  # Pass ack_queue
-                        client_thread.start()
-                        print(f"request_users_list: {self.address_to_username.get(client_address, 'Unknown')}")
-                        ack_packet = util.make_packet("ack", int(seqno), "")
-                        self.sock.sendto(ack_packet.encode(), client_address)
-                    elif msg_type == "send_message":
-                        sender_name = self.address_to_username[client_address]
-                        print(f"msg: {sender_name}")
-                        recipients_count = int(parts[3])
-                        recipients = parts[4:4 + recipients_count]
-                        message_content = ' '.join(parts[4 + recipients_count:])
-                        connection_state = self.connection_state.get(client_address)
-                        if connection_state:
-                            expected_seq_num = connection_state["expected_seq_num"]
-                            if int(seqno) == expected_seq_num:
-                                connection_state["message_chunks"].append((sender_name, message_content))
-                                connection_state["expected_seq_num"] += 1
-                                ack_packet = util.make_packet("ack", int(seqno), "")
-                                self.sock.sendto(ack_packet.encode(), client_address)
-                            continue
+        self.fanout.start()
+        # Receive batches into preallocated buffers, packets are parsed in
+        # place and the ACKs they trigger go out together after the batch
+        self.receiver = batchio.BatchReceiver(self.sock)
+        self.receive_thread = threading.current_thread()
+        self.delayed_acks.delay = self.ack_delay
+        self.start_reaper()
+        while not self.stop_event.is_set():
+            batch = self.receiver.receive()
+            if self.stop_event.is_set():
+                break
+            with self.dispatch_lock:
+                self.send_batch = []
+                for data, client_address in batch:
+                    self.handle_packet(data, client_address)
+                packets, self.send_batch = self.send_batch, None
+                batchio.send_batch(self.sock, packets)
+        self.fanout.stop()
+        self.sock.close()
+        if self.trace:
+            self.trace.close()
+
+    def impair(self, impairment):
+        # Route every outgoing packet through the network impairment simulator
+        self.impairment = impairment
+        self.sock = ImpairedSocket(self.sock, impairment)
+        self.fanout.sock = self.sock
+
+    def record_trace(self, path):
+        # Datagrams are recorded as sent by the Server, before any impairment
+        self.trace = capture.TraceWriter(path)
+        self.sock = capture.TracingSocket(self.sock, self.trace)
+        self.fanout.sock = self.sock
+
+    def stop(self):
+        self.stop_event.set()
+        # Wake up the receive loop blocked in receive()
+        wake_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        wake_sock.sendto(b"", self.bound_address)
+        wake_sock.close()
+        if self.trace:
+            # The trace is complete once stop() returns, later records are dropped
+            self.trace.close()
+
+    def handle_packet(self, data, client_address):
+        # Parsing, validation and dispatch are timed separately
+        metrics = self.metrics
+        started = time.perf_counter()
+        if self.trace:
+            self.trace.record(capture.RECEIVED, client_address, data)
+        if not len(data):
+            # An interrupted client sends an empty datagram on its way out
+            metrics.count("in.empty")
+            if client_address in self.connection_state:
+                self.drop_session(client_address, "closed")
+            return
+        typeofP, seqno, info, valid = wire.parse_packet(data)
+        parsed = time.perf_counter()
+        metrics.observe("stage.parse", parsed - started)
+        if not valid:
+            # Corrupted packets are dropped, the sender will retransmit
+            metrics.count("in.corrupt")
+            return
+        metrics.count("in." + str(typeofP))
+        if client_address in self.address_to_username:
+            # Any packet of a user, ACKs included, shows the client is alive.
+            # The state of a client that never joined is left to the reaper
+            self.sessions.touch(client_address, time.monotonic())
+        if typeofP == "ack":
+            self.handle_ack(client_address, seqno)
+            metrics.observe("stage.dispatch", time.perf_counter() - parsed)
+            return
+        parts = info.split()
+        connection_state = self.connection_state.get(client_address)
+        if connection_state and (typeofP == "data" or (typeofP == "end" and connection_state.get("session"))):
+            # Packets are processed in order, those ahead of a gap wait in the
+            # reorder buffer. Sessions carry their end packets in the same
+            # sequence space as the data
+            receiver = connection_state["receiver"]
+            outcome, released = receiver.accept(int(seqno), (typeofP, seqno, info, parts))
+            validated = time.perf_counter()
+            metrics.observe("stage.validate", validated - parsed)
+            metrics.count("in." + outcome)
+            if outcome == reorder.DUPLICATE:
+                # Our ACK was lost, ACKs are cumulative so re-ACK the last in-order packet
+                self.send_ack(client_address, receiver.last_in_order)
+            for seq_num, (typeofP, seqno, info, parts) in released:
+                self.dispatch_packet(typeofP, seqno, info, parts, valid, data, connection_state, client_address)
+        else:
+            validated = parsed
+            self.dispatch_packet(typeofP, seqno, info, parts, valid, data, connection_state, client_address)
+        metrics.observe("stage.dispatch", time.perf_counter() - validated)
+
+    def dispatch_packet(self, typeofP, seqno, info, parts, valid, data, connection_state, client_address):
+        if typeofP == "start":
+            if valid:
+                # Transfers towards this client may still be running, keep their state
+                connection_state = self.connection_state.setdefault(client_address, {})
+                # Accept every offer we know, binary clients keep using the
+                # binary format for every later start
+                accepted = [offer for offer in parts if offer in (wire.BINARY_OFFER, wire.SESSION_OFFER)]
+                binary = wire.is_binary(data) or wire.BINARY_OFFER in accepted
+                session = wire.SESSION_OFFER in accepted
+                compression = binary and wire.ZLIB_OFFER in parts
+                if compression:
+                    accepted.append(wire.ZLIB_OFFER)
+                connection_state.update({"message_chunks": [], "binary": binary, "session": session, "zlib": compression})
+                # A new start restarts the sequence space, the counts go on
+                connection_state.setdefault("receiver", reorder.ReorderBuffer()).reset(int(seqno) + 1)
+                self.sessions.touch(client_address, time.monotonic())
+                # The ACK goes out in the format of the start packet
+                self.delayed_acks.cancel(client_address)
+                ack_packet = wire.make_packet("ack", int(seqno), ' '.join(accepted), wire.is_binary(data))
+                self.send(ack_packet, client_address)
+        elif typeofP == "data":
+            try:
+                msg_type = parts[0]
+                msg_len = int(parts[1])
+                username = parts[2] if msg_type == "join" else None
+                room = parts[3] if msg_type == "send_message" and rooms.is_room(parts[3]) else None
+                recipients_count = int(parts[3]) if msg_type == "send_message" and not room else 0
+            except (IndexError, ValueError):
+                # The checksum matched but the request makes no sense. It is
+                # acknowledged so the sender moves on, and dropped.
+                self.metrics.count("in.malformed")
+                LOG.warning("Malformed request from %s dropped: %s", client_address, parts)
+                self.send_ack(client_address, int(seqno))
+                return
+            if valid:
+                if msg_type == "join":
+                    refusal = self.admit(username, client_address)
+                    if refusal:
+                        msg = util.make_message(refusal, 1, username)
+                        packet = self.make_packet(client_address, "ack", int(seqno), msg)
+                        self.send(packet, client_address)
+                        if refusal == "ERR_SERVER_FULL":
+                            LOG.info("Disconnected: server full")
                         else:
-                            print("Packet dropped: Checksum mismatch")
-            elif typeofP == "end":
-                if util.validate_checksum(decoded_data):
-                    if parts[0] == "send_message":
-                        ack_packet = util.make_packet("ack", int(seqno), "")
-                        self.sock.sendto(ack_packet.encode(), client_address)
-                        connection_state = self.connection_state.get(client_address)
-                        if connection_state:
-                            connection_state["end_packet_received"] = True
-                            if connection_state.get("message_chunks"):
-                                # Forward the message chunks
-                                sender_name = self.address_to_username[client_address]
-                                recipient_chunks = []
-                                for recipient in recipients:
-                                    recipient_address = self.username_to_address.get(recipient)
-                                    if recipient_address:
-                                        recipient_chunks.append((recipient, recipient_address))
-                                    else:
-                                        print(f"msg: {sender_name} to non-existent user {recipient}")
-
-                                # Spawn a thread for each recipient to forward the message chunks
-                                for recipient, recipient_address in recipient_chunks:
-                                    client_thread = threading.Thread(target=self.forward_message_chunks, args=(connection_state["message_chunks"], recipient_address))
-                                    client_thread.start()
+                            LOG.info("Disconnected: username not available")
+                    else:
+                        self.send_ack(client_address, int(seqno))
+                        self.add_user(username, client_address)
+                        # self.connection_state[client_address] = {"ack_queue": queue.Queue()}
+                        LOG.info("join: %s", username)
+                elif msg_type == "disconnect":
+                    self.send_ack(client_address, int(seqno))
+                    self.drop_session(client_address, "disconnect")
+                elif msg_type == "keepalive":
+                    # Sessions of users stay open as long as the client is
+                    # heard from, see handle_packet(). Others are only ACKed
+                    self.send_ack(client_address, int(seqno))
+                elif msg_type == "request_users_list":
+                    # Clients that know the roster of some version send it along
+                    since = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else 0
+                    self.enqueue([client_address], self.make_users_list_phases(since, self.is_binary(client_address)))
+                    LOG.debug("request_users_list: %s", self.address_to_username.get(client_address, "Unknown"))
+                    self.send_ack(client_address, int(seqno))
+                elif msg_type == "subscribe_presence":
+                    # The first push brings the client up to date from the version it knows
+                    since = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else 0
+                    self.send_ack(client_address, int(seqno))
+                    if client_address in self.address_to_username:
+                        self.presence.subscribe(client_address, since)
+                    LOG.debug("subscribe_presence: %s", self.address_to_username.get(client_address, "Unknown"))
+                elif msg_type == "unsubscribe_presence":
+                    self.send_ack(client_address, int(seqno))
+                    self.presence.unsubscribe(client_address)
+                elif msg_type in ("create_room", "join_room", "leave_room"):
+                    self.send_ack(client_address, int(seqno))
+                    if client_address in self.address_to_username and len(parts) > 2:
+                        self.change_room(client_address, msg_type, parts[2])
+                elif msg_type == "request_stats":
+                    self.send_ack(client_address, int(seqno))
+                    if self.is_local(client_address):
+                        self.enqueue([client_address], self.make_stats_phases(self.is_binary(client_address)))
                     else:
-                        error_packet = util.make_packet("ack", int(seqno), "")
-                        self.sock.sendto(error_packet.encode(), client_address)
-            elif typeofP == "ack":
-                self.handle_ack(client_address, int(seqno))
-    
-    def forward_message_chunks(self, message_chunks, recipient_address):
-        connection_state = self.connection_state[recipient_address]
-        ack_queue = connection_state.get("ack_queue")
-
-        if not ack_queue:
-            print(f"No ack_queue found for client {recipient_address}")
+                        LOG.warning("Stats request from %s refused: not local", client_address)
+                elif msg_type == "send_message":
+                    sender_name = self.address_to_username.get(client_address)
+                    if sender_name is None:
+                        # The session was reaped, the client has to join again
+                        return
+                    LOG.debug("msg: %s", sender_name)
+                    # The first chunk carries the recipients or a room, the text keeps its whitespace
+                    fields = info.split(" ", 4 + recipients_count)
+                    recipients = fields[4:4 + recipients_count]
+                    message_content = fields[4 + recipients_count] if len(fields) > 4 + recipients_count else ""
+                    if connection_state:
+                        # Several clients send at once, the recipients go with the transfer
+                        connection_state["recipients"] = recipients
+                        connection_state["room"] = room
+                        connection_state["message_chunks"] = []
+                        connection_state["message_size"] = 0
+                        connection_state["message_refused"] = False
+                        self.add_fragment(client_address, connection_state, message_content)
+                        # ACKs are cumulative, chunks are acknowledged in pairs
+                        self.delayed_acks.ack(client_address, int(seqno))
+                    else:
+                        LOG.warning("Packet dropped: no session for %s", client_address)
+                elif msg_type == "message_part":
+                    fields = info.split(" ", 2)
+                    if connection_state:
+                        self.add_fragment(client_address, connection_state, fields[2] if len(fields) > 2 else "")
+                        self.delayed_acks.ack(client_address, int(seqno))
+        elif typeofP == "end":
+            if valid:
+                if parts[:1] == ["send_message"]:
+                    self.send_ack(client_address, int(seqno))
+                    if connection_state:
+                        connection_state["end_packet_received"] = True
+                        if connection_state.get("message_refused"):
+                            connection_state["message_refused"] = False
+                            self.reply(client_address, util.make_message("ERR_MESSAGE_TOO_LARGE", 1, str(self.max_message_size)))
+                        elif connection_state.get("message_chunks"):
+                            # A compressed message only ever reaches the end of a zlib session
+                            compressed = parts[2:3] == [wire.ZLIB_OFFER] and connection_state.get("zlib", False)
+                            self.forward_message(client_address, connection_state, compressed)
+                        # The next message starts from scratch, a retransmitted end
+                        # must not forward this one again
+                        connection_state["message_chunks"] = []
+                else:
+                    self.send_ack(client_address, int(seqno))
+
+    def forward_message(self, client_address, connection_state, compressed):
+        # Queues the reassembled message of the client for every recipient
+        started = time.perf_counter()
+        sender_name = self.address_to_username.get(client_address, "Unknown")
+        message_content = ''.join(connection_state["message_chunks"])
+        if connection_state.get("room"):
+            self.forward_room_message(client_address, connection_state["room"], sender_name, message_content, compressed)
+            self.metrics.observe("stage.forward", time.perf_counter() - started)
             return
-        
-        # Send start packet
-        start_seq_num = random.randint(1, 1000)
-        start_packet = util.make_packet("start", start_seq_num, "")
-        self.sock.sendto(start_packet.encode(), recipient_address)
-
-        # Wait for acknowledgment for the start packet
-        ack_received = False
-        retries = 0
-        while not ack_received and retries < 3:
+        recipient_chunks = []
+        for recipient in connection_state.get("recipients", []):
+            recipient_address = self.lookup_user(recipient)
+            if recipient_address:
+                recipient_chunks.append((recipient, recipient_address))
+            elif self.store:
+                # Handed over when the user joins
+                self.store.append(recipient, sender_name, message_content, compressed)
+                LOG.debug("msg: %s to offline user %s", sender_name, recipient)
+            else:
+                LOG.info("msg: %s to non-existent user %s", sender_name, recipient)
+        if self.store and self.store.store_all and recipient_chunks:
+            self.store.archive([recipient for recipient, recipient_address in recipient_chunks],
+                               sender_name, message_content, compressed)
+        self.fan_out(client_address, [recipient_address for recipient, recipient_address in recipient_chunks],
+                     sender_name, message_content, compressed)
+        self.metrics.observe("stage.forward", time.perf_counter() - started)
+
+    def forward_room_message(self, client_address, room, sender_name, message_content, compressed):
+        # The members were resolved when they joined, only the sender's
+        # own membership is checked
+        members = self.rooms.get(room)
+        if client_address not in members:
+            self.reply(client_address, util.make_message("ERR_NOT_IN_ROOM", 1, room))
+            return
+        self.metrics.count("room.messages")
+        recipient_addresses = members - {client_address}
+        if self.store and self.store.store_all and recipient_addresses:
+            self.store.archive([self.address_to_username.get(address, "") for address in recipient_addresses],
+                               sender_name, message_content, compressed)
+        self.fan_out(client_address, recipient_addresses, sender_name, message_content, compressed)
+
+    def change_room(self, address, msg_type, room):
+        # Creates, joins or leaves room, failures are reported to the client
+        error = None
+        if not rooms.is_room(room):
+            error = "ERR_NO_SUCH_ROOM"
+        elif msg_type == "create_room":
+            if not self.rooms.create(room, address):
+                error = "ERR_ROOM_EXISTS"
+        elif msg_type == "join_room":
+            if not self.rooms.join(room, address):
+                error = "ERR_NO_SUCH_ROOM"
+        elif not self.rooms.leave(room, address):
+            error = "ERR_NOT_IN_ROOM"
+        LOG.debug("%s: %s %s", msg_type, self.address_to_username.get(address, "Unknown"), room)
+        if error:
+            self.reply(address, util.make_message(error, 1, room))
+
+    def admit(self, username, address):
+        # The error a join of username is refused with, None to let it in
+        if len(self.username_to_address) >= self.max_clients:
+            return "ERR_SERVER_FULL"
+        if username in self.username_to_address:
+            return "ERR_USERNAME_UNAVAILABLE"
+        return None
+
+    def lookup_user(self, username):
+        return self.username_to_address.get(username)
+
+    def add_fragment(self, client_address, connection_state, chunk):
+        # Reassembles the message within the limits, an oversized message is
+        # dropped as a whole and reported to its sender at its end packet
+        if connection_state.get("message_refused"):
+            return
+        connection_state["message_size"] = connection_state.get("message_size", 0) + len(chunk.encode("utf-8", "surrogateescape"))
+        connection_state["message_chunks"].append(chunk)
+        if (connection_state["message_size"] > self.max_message_size or
+                len(connection_state["message_chunks"]) > self.max_fragments):
+            LOG.warning("msg: %s exceeds the reassembly limits", self.address_to_username.get(client_address, "Unknown"))
+            connection_state["message_refused"] = True
+            connection_state["message_chunks"] = []
+
+    def add_user(self, username, address):
+        self.username_to_address[username] = address
+        self.address_to_username[address] = username
+        self.sessions.touch(address, time.monotonic())
+        self.roster.add(username)
+        self.presence.changed()
+        if self.store:
+            self.deliver_stored(username, address)
+
+    def deliver_stored(self, username, address):
+        # The messages kept while the user was away go out as one transfer
+        binary = self.is_binary(address)
+        compression = self.accepts_compression(address)
+        phases = []
+        for sender, message_content, compressed in self.store.take(username):
+            if compressed and not compression:
+                try:
+                    message_content = codec.decompress(message_content, self.max_message_size)
+                except ValueError as e:
+                    LOG.warning("msg: stored message from %s is broken: %s", sender, e)
+                    continue
+                compressed = False
+            phases.extend(self.make_forward_phases(sender, message_content, binary, compressed))
+        if phases:
+            LOG.info("msg: %d stored messages for %s", len(phases) // 2, username)
+            self.enqueue([address], phases)
+
+    def remove_user(self, username, address):
+        self.presence.unsubscribe(address)
+        self.rooms.leave_all(address)
+        self.address_to_username.pop(address, None)
+        if self.username_to_address.pop(username, None) is not None:
+            self.roster.remove(username)
+            self.presence.changed()
+
+    def fan_out(self, client_address, recipient_addresses, sender, message_content, compressed=False):
+        # Encode the message once per format and queue it for every recipient.
+        # A compressed message goes to zlib recipients as it is and is only
+        # decompressed, once, for the others
+        groups = {}
+        for address in recipient_addresses:
+            groups.setdefault((self.is_binary(address), self.accepts_compression(address)), []).append(address)
+        plain_content = None if compressed else message_content
+        for (binary, compression), addresses in groups.items():
+            if compressed and compression:
+                phases = self.make_forward_phases(sender, message_content, binary, True)
+            else:
+                if plain_content is None:
+                    try:
+                        plain_content = codec.decompress(message_content, self.max_message_size)
+                    except ValueError as e:
+                        LOG.warning("msg: %s sent a broken message: %s", sender, e)
+                        return
+                phases = self.make_forward_phases(sender, plain_content, binary)
+            self.enqueue(addresses, phases, client_address)
+
+    def drop_session(self, address, reason):
+        # Frees the username and everything kept for the client, transfers
+        # still queued or in flight towards it are cancelled
+        username = self.address_to_username.get(address)
+        if username is not None:
+            self.remove_user(username, address)
+        self.sessions.remove(address)
+        self.delayed_acks.cancel(address)
+        connection_state = self.connection_state.pop(address, None)
+        if connection_state:
+            if "outbox" in connection_state:
+                connection_state["outbox"].close()
+            if "acks" in connection_state:
+                connection_state["acks"].close()
+            with self.stats_lock:
+                for component, totals in self.departed_stats.items():
+                    if component in connection_state:
+                        add_stats(totals, connection_state[component].stats)
+        LOG.info("disconnected: %s (%s)", username or "Unknown", reason)
+
+    def start_reaper(self):
+        self.sessions = reaper.TimerWheel(self.session_timeout)
+        reaper_thread = threading.Thread(target=self.run_reaper)
+        reaper_thread.daemon = True
+        reaper_thread.start()
+
+    def run_reaper(self):
+        # Reaped sessions are dropped like a disconnect in the receive loop
+        while not self.stop_event.wait(self.sessions.tick):
+            with self.dispatch_lock:
+                self.reap()
+
+    def reap(self):
+        for address in self.sessions.expire(time.monotonic()):
+            self.drop_session(address, "timed out")
+        # A full disk or an unwritable metrics path must not stop the reaping
+        if self.store:
+            try:
+                self.store.maintain()
+            except OSError as e:
+                LOG.error("Offline store maintenance failed: %s", e)
+        if self.metrics_file and self.metrics.dump_due():
             try:
-                ack = ack_queue.get(timeout=util.TIME_OUT)
-                if ack == start_seq_num:
-                    ack_received = True
-            except queue.Empty:
-                # Handle timeout by retransmitting the packet
-                self.sock.sendto(start_packet.encode(), recipient_address)
-                retries += 1
-        if not ack_received:
-            print(f"Failed to receive ACK for start packet {start_seq_num}. Retries exhausted.")
+                self.metrics.dump(self.metrics_file, self.metrics_snapshot())
+            except OSError as e:
+                LOG.error("Metrics dump to %s failed: %s", self.metrics_file, e)
+
+    def send(self, packet, address):
+        self.metrics.count("out." + wire.packet_type(packet))
+        # Only the receive loop batches, the delayed ACK timer sends directly
+        if self.send_batch is not None and threading.current_thread() is self.receive_thread:
+            self.send_batch.append((packet, address))
+        else:
+            self.sock.sendto(packet, address)
+
+    def accepts_compression(self, address):
+        return self.connection_state.get(address, {}).get("zlib", False)
+
+    def send_ack(self, address, seq_num):
+        # A held back ACK is covered by this one
+        self.delayed_acks.cancel(address)
+        self.send(self.make_packet(address, "ack", seq_num, ""), address)
+
+    def is_binary(self, address):
+        return self.connection_state.get(address, {}).get("binary", False)
+
+    def make_packet(self, address, msg_type, seqno, msg=""):
+        # Encode in the format negotiated with the client
+        return wire.make_packet(msg_type, seqno, msg, self.is_binary(address))
+
+    def enqueue(self, recipient_addresses, phases, origin=None):
+        # Queued in the outbox of each recipient, behind its transfer in flight
+        transfer = (phases, origin)
+        copies = 0
+        for address in recipient_addresses:
+            client_outbox = self.client_outbox(address)
+            if client_outbox is None:
+                continue
+            start, refused = client_outbox.put(transfer)
+            if refused:
+                self.refuse(address, refused[1])
+            if refused is not transfer and not client_outbox.closed:
+                copies += 1
+            if start:
+                self.deliver(client_outbox)
+        self.count_transfer(phases, copies)
+
+    def count_transfer(self, phases, copies):
+        # Packets of a transfer by type, once for every recipient it was
+        # queued for. Retransmissions are counted apart
+        if self.metrics.enabled and copies:
+            for packets, window_size in phases:
+                for seq_num, packet in packets:
+                    self.metrics.count("out." + wire.packet_type(packet), copies)
+
+    def deliver(self, client_outbox):
+        # The fan-out sender drains the outbox, see fanout.py
+        self.fanout.deliver(client_outbox)
+
+    def refuse(self, address, origin):
+        # Tells the sender of a rejected or dropped message that it was lost
+        username = self.address_to_username.get(address, "Unknown")
+        LOG.warning("msg: outbound queue of %s is full", username)
+        if origin is None or origin == address:
+            return
+        self.reply(origin, util.make_message("ERR_RECIPIENT_BUSY", 1, username))
+
+    def reply(self, address, msg):
+        # Queues a data message from the server itself for the client
+        self.enqueue([address], self.make_reply_phases([msg], self.is_binary(address)))
+
+    def make_outbox(self, address):
+        return outbox.Outbox(address, self.outbox_high_watermark, self.outbox_low_watermark, self.overflow_policy)
+
+    def client_outbox(self, address):
+        connection_state = self.connection_state.get(address)
+        if connection_state is None:
+            return None
+        if "outbox" not in connection_state:
+            connection_state["outbox"] = self.make_outbox(address)
+        return connection_state["outbox"]
+
+    def outbox_stats(self):
+        # Outbound queue counters summed over every client, gone or not,
+        # depths are maxima
+        return self.session_stats("outbox")
+
+    def session_stats(self, component):
+        # Totals of the departed sessions plus the live ones
+        with self.stats_lock:
+            totals = dict(self.departed_stats[component])
+        for connection_state in list(self.connection_state.values()):
+            if component in connection_state:
+                add_stats(totals, connection_state[component].stats)
+        return totals
+
+    def allocate_seq_nums(self, count):
+        # Returns the first of count consecutive unused sequence numbers
+        with self.seq_lock:
+            start_seq_num = self.next_seq_num
+            self.next_seq_num = (self.next_seq_num + count) % 2**32
+            if self.next_seq_num < start_seq_num:
+                # Wrapped around, restart from the bottom
+                start_seq_num, self.next_seq_num = 1, count + 1
+        return start_seq_num
+
+    def make_forward_phases(self, sender, message_content, binary, compressed=False):
+        # All recipients share the sequence numbers so each packet is built once.
+        # The message is split again to fit the MTU in the recipients' format
+        room = wire.message_room(wire.payload_size(self.mtu, binary), "forward_message", sender + " ")
+        message_chunks = wire.split_utf8(message_content, room, room)
+        start_seq_num = self.allocate_seq_nums(len(message_chunks) + 2)
+        start_packet = wire.make_packet("start", start_seq_num, "", binary)
 
         seq_num = start_seq_num
-        # Iterate through each chunk and forward them
-        for sender, chunk in message_chunks:
+        data_packets = []
+        for chunk in message_chunks:
             seq_num = seq_num + 1
             msg = util.make_message("forward_message", 4, sender + " " + chunk)
-            packet = util.make_packet("data", seq_num, msg)
-            self.sock.sendto(packet.encode(), recipient_address)
+            data_packets.append((seq_num, wire.make_packet("data", seq_num, msg, binary)))
+        # The end packet tells whether the chunks are compressed
+        msg = util.make_message("forward_message", 4, sender + (" " + wire.ZLIB_OFFER if compressed else ""))
 
-            # Wait for ACK
-            ack_received = False
-            retries = 0
-            while not ack_received and retries < 3:
-                try:
-                    ack = ack_queue.get(timeout=util.TIME_OUT)
-                    if ack == seq_num:
-                        ack_received = True
-                except queue.Empty:
-                    # Handle timeout by retransmitting the packet
-                    self.sock.sendto(packet.encode(), recipient_address)
-                    retries += 1
-
-            if not ack_received:
-                print(f"Failed to receive ACK for packet {seq_num}. Retries exhausted.")
-
-        end_packet = util.make_packet("end", seq_num, msg)
-        self.sock.sendto(end_packet.encode(), recipient_address)
-
-        # Wait for acknowledgment for the start packet
-        ack_received = False
-        retries = 0
-        while not ack_received and retries < 3:
-            try:
-                ack = ack_queue.get(timeout=util.TIME_OUT)
-                if ack == seq_num:
-                    ack_received = True
-            except queue.Empty:
-                # Handle timeout by retransmitting the packet
-                self.sock.sendto(end_packet.encode(), recipient_address)
-                retries += 1
-        if not ack_received:
-            print(f"Failed to receive ACK for start packet {start_seq_num}. Retries exhausted.")
-
-    def handle_request_users_list(self, client_address, msg, seqno):
-        # Update connection state with ack_queue
-        if client_address not in self.connection_state:
-            print(f"No connection state found for client {client_address}")
-            return
+        # The end packet shares the window of the data, its ACK is cumulative
+        # and confirms the last chunks too, whose ACKs the client may hold back
+        data_packets.append((seq_num + 1, wire.make_packet("end", seq_num + 1, msg, binary)))
+        return [
+            ([(start_seq_num, start_packet)], 1),
+            (data_packets, self.window),
+        ]
 
-        # Update connection state with ack_queue
-        connection_state = self.connection_state[client_address]
-        ack_queue = connection_state.get("ack_queue")
+    def make_users_list_phases(self, since, binary):
+        # The roster goes out in as many chunks as it needs, the end packet
+        # carries the version the client knows from then on
+        room = wire.message_room(wire.payload_size(self.mtu, binary), "response_users_list", roster.MAX_HEADER)
+        version, kind, chunks = self.roster.answer(since, room)
+        cached_version, cache = self.list_payloads
+        key = (kind, since if kind == roster.DELTA else 0, binary)
+        payloads = cache.get(key) if cached_version == version else None
+        if payloads is None:
+            payloads = [wire.Payload(util.make_message("response_users_list", 3, f"{version} {kind} {chunk}"))
+                        for chunk in chunks]
+            payloads.append(wire.Payload(util.make_message("response_users_list", 3, f"{version} {kind}")))
+            # Version 0 is the empty roster, it is never cached
+            if version:
+                if cached_version != version:
+                    cache = {}
+                    self.list_payloads = (version, cache)
+                cache[key] = payloads
+        return self.make_reply_phases(payloads[:-1], binary, payloads[-1])
 
-        if not ack_queue:
-            print(f"No ack_queue found for client {client_address}")
-            return
-        
-        # Send start packet
-        start_seq_num = random.randint(1, 1000)
-        start_packet = util.make_packet("start", start_seq_num, "")
-        self.sock.sendto(start_packet.encode(), client_address)
+    def is_local(self, address):
+        return address[0] in ("localhost", "::1") or address[0].startswith("127.")
 
-        ack_received = False
-        while not ack_received:
-            try:
-                ack = ack_queue.get(timeout=util.TIME_OUT)  # Convert to seconds
-                if ack == start_seq_num:
-                    ack_received = True
-            except queue.Empty:
-                # Handle timeout by retransmitting the START packet
-                self.sock.sendto(start_packet.encode(), (self.server_addr, self.server_port))
-
-        seq_num = start_seq_num + 1
-        msg = util.make_message("response_users_list", 3, msg)
-        packet = util.make_packet("data", seq_num, msg)
-        self.sock.sendto(packet.encode(), client_address)
-
-        ack_received = False
-        retries = 0
-        while not ack_received and retries < 3:
-            try:
-                ack = ack_queue.get(timeout=util.TIME_OUT)
-                # print("Im waiting for ack for after sending the data for these tow", ack, seq_num)
-                if ack == seq_num:
-                    ack_received = True
-            except queue.Empty:
-                # Handle timeout by retransmitting the packet
-                self.sock.sendto(packet.encode(), client_address)
-                retries += 1
+    def make_stats_phases(self, binary):
+        # The JSON snapshot split into as many chunks as it needs
+        room = wire.message_room(wire.payload_size(self.mtu, binary), "response_stats")
+        snapshot = json.dumps(self.metrics_snapshot(), separators=(",", ":"))
+        messages = [util.make_message("response_stats", 3, chunk) for chunk in wire.split_utf8(snapshot, room, room)]
+        return self.make_reply_phases(messages, binary, util.make_message("response_stats", 3, str(len(messages))))
 
+    def metrics_snapshot(self):
+        # Counters and histograms together with the state of every component
+        gauges = {
+            "sessions": len(self.connection_state),
+            "users": len(self.username_to_address),
+            "threads": threading.active_count(),
+            "delayed_acks_pending": len(self.delayed_acks.pending),
+            "outbox": self.outbox_stats(),
+            "acks": self.ack_stats(),
+            "reorder": self.reorder_stats(),
+            "delayed_acks": dict(self.delayed_acks.stats),
+            "reaper": dict(self.sessions.stats),
+            "presence": dict(self.presence.stats),
+            "rooms": dict(self.rooms.stats, rooms=len(self.rooms)),
+            "io": dict(self.receiver.stats) if self.receiver else None,
+            "store": dict(self.store.stats) if self.store else None,
+            "trace": dict(self.trace.stats) if self.trace else None,
+        }
+        return self.metrics.snapshot(gauges)
 
-        end_packet = util.make_packet("end", seq_num+1, "")
-        self.sock.sendto(end_packet.encode(), client_address)
+    def push_presence(self, address, since):
+        # Called by the presence timer, transfers are only queued under the
+        # dispatch lock
+        with self.dispatch_lock:
+            self.enqueue([address], self.make_users_list_phases(since, self.is_binary(address)))
 
-        ack_received = False
-        while not ack_received:
-            try:
-                ack = ack_queue.get(timeout=util.TIME_OUT)  # Convert to seconds
-                if ack == seq_num+1:
-                    ack_received = True
-            except queue.Empty:
-                # Handle timeout by retransmitting the START packet
-                self.sock.sendto(end_packet.encode(), (self.server_addr, self.server_port))
+    def make_reply_phases(self, messages, binary, end_msg=""):
+        # Data packets from the server itself, a single one for most replies.
+        # The end shares their window like in make_forward_phases()
+        start_seq_num = self.allocate_seq_nums(len(messages) + 2)
+        packets = [(start_seq_num + index, wire.make_packet("data", start_seq_num + index, msg, binary))
+                   for index, msg in enumerate(messages, 1)]
+        end_seq_num = start_seq_num + len(messages) + 1
+        packets.append((end_seq_num, wire.make_packet("end", end_seq_num, end_msg, binary)))
+        return [
+            ([(start_seq_num, wire.make_packet("start", start_seq_num, "", binary))], 1),
+            (packets, self.window),
+        ]
 
-        if not ack_received:
-            print(f"Failed to receive ACK for packet {seq_num+1}. Retries exhausted.")
+    def estimator(self, address):
+        connection_state = self.connection_state.get(address)
+        if connection_state is None:
+            return self.make_estimator()
+        if "rtt" not in connection_state:
+            connection_state["rtt"] = self.make_estimator()
+        return connection_state["rtt"]
+
+    def make_estimator(self):
+        # Every RTT sample also lands in the ack_rtt histogram
+        estimator = rtt.RttEstimator()
+        if self.metrics.enabled:
+            estimator.histogram = self.metrics.histogram("ack_rtt")
+        return estimator
+
+    def rtt_estimates(self):
+        # Current RTT estimates of every client, keyed by username when known
+        return {self.address_to_username.get(address, address): connection_state["rtt"].as_dict()
+                for address, connection_state in list(self.connection_state.items())
+                if "rtt" in connection_state}
+
+    def ack_dispatcher(self, address):
+        connection_state = self.connection_state.get(address)
+        if connection_state is None:
+            return demux.AckDispatcher()
+        return connection_state.setdefault("acks", demux.AckDispatcher())
+
+    def ack_stats(self):
+        # Delivered, stale and duplicate ACKs over every connection, and
+        # transfers that overlapped with another one to the same client
+        return self.session_stats("acks")
+
+    def reorder_stats(self):
+        # Packets taken in order, held ahead of a gap or dropped as
+        # duplicates over every connection
+        return self.session_stats("receiver")
+
+    def count_retransmissions(self, address, count):
+        # Called by the fan-out sender for every retransmitted window
+        self.retransmissions += count
+        self.metrics.count("out.retransmitted", count)
 
     def handle_ack(self, sender_address, ack_seq_num):
-        sender_connection = self.connection_state.get(sender_address)
-        if sender_connection:
-            ack_queue = sender_connection.get("ack_queue")  # Retrieve ack_queue from connection_state
-            if ack_queue:
-                ack_queue.put(ack_seq_num)
+        if sender_address in self.connection_state:
+            # Wakes the transfer in flight towards the client, if the ACK is
+            # one of its sequence numbers
+            self.ack_dispatcher(sender_address).dispatch(ack_seq_num)
 
 
 
@@ -267,11 +771,27 @@ if __name__ == "__main__":
         print("-p PORT | --port=PORT The server port, defaults to 15000")
         print("-a ADDRESS | --address=ADDRESS The server ip or hostname, defaults to localhost")
         print("-w WINDOW | --window=WINDOW The window size, default is 3")
+        print("-m MODE | --mode=MODE thread, async or workers, defaults to thread")
+        print("-n WORKERS | --workers=WORKERS Worker processes in workers mode, defaults to the number of cores")
+        print("-i SPEC | --impair=SPEC Simulate an impaired network, e.g. loss=0.05,delay=0.02,seed=1")
+        print("-q HIGH[,LOW] | --queue=HIGH[,LOW] Outbound queue watermarks per client, defaults to 64,32")
+        print("-o POLICY | --overflow=POLICY reject or drop (the oldest) when a queue is full, defaults to reject")
+        print("-d SECONDS | --ack-delay=SECONDS Longest time an ACK is held back, 0 disables delayed ACKs, defaults to 0.01")
+        print("-t SECONDS | --timeout=SECONDS Idle time after which a client's session is reaped, defaults to 60")
+        print("-s DIRECTORY | --store=DIRECTORY Keep messages for offline users in DIRECTORY until they join, not in workers mode")
+        print("--store-all Keep every message in the store, not only those for offline users")
+        print("-l LEVEL | --log=LEVEL debug, info, warning, error or off, defaults to info")
+        print("-M FILE | --metrics=FILE Dump the metrics to FILE as JSON every 10 seconds")
+        print("--no-metrics Do not collect metrics")
+        print("-T FILE | --trace=FILE Record every datagram received and sent to FILE, see replay.py")
         print("-h | --help Print this help")
 
     try:
         OPTS, ARGS = getopt.getopt(sys.argv[1:],
-                                   "p:a:w", ["port=", "address=","window="])
+                                   "p:a:w:m:n:i:q:o:d:t:s:l:M:T:", ["port=", "address=","window=","mode=","workers=",
+                                                                      "impair=","queue=","overflow=","ack-delay=","timeout=",
+                                                                      "store=","store-all","log=","metrics=","no-metrics",
+                                                                      "trace="])
     except getopt.GetoptError:
         helper()
         exit()
@@ -279,16 +799,90 @@ if __name__ == "__main__":
     PORT = 15000
     DEST = "localhost"
     WINDOW = 3
+    MODE = "thread"
+    WORKERS = None
+    IMPAIRMENT = None
+    QUEUE = None
+    POLICY = outbox.REJECT
+    ACK_DELAY = delack.ACK_DELAY
+    TIMEOUT = reaper.SESSION_TIMEOUT
+    STORE = None
+    STORE_ALL = False
+    LOG_LEVEL = "info"
+    METRICS_FILE = None
+    METRICS = True
+    TRACE_FILE = None
 
     for o, a in OPTS:
         if o in ("-p", "--port="):
             PORT = int(a)
         elif o in ("-a", "--address="):
             DEST = a
-        elif o in ("-w", "--window="):
-            WINDOW = a
+        elif o in ("-w", "--window"):
+            WINDOW = int(a)
+        elif o in ("-m", "--mode"):
+            MODE = a
+        elif o in ("-n", "--workers"):
+            WORKERS = int(a)
+        elif o in ("-i", "--impair"):
+            IMPAIRMENT = Impairment.parse(a)
+        elif o in ("-q", "--queue"):
+            QUEUE = [int(mark) for mark in a.split(",")]
+        elif o in ("-o", "--overflow"):
+            if a not in outbox.POLICIES:
+                helper()
+                exit()
+            POLICY = a
+        elif o in ("-d", "--ack-delay"):
+            ACK_DELAY = float(a)
+        elif o in ("-t", "--timeout"):
+            TIMEOUT = float(a)
+        elif o in ("-s", "--store"):
+            STORE = a
+        elif o == "--store-all":
+            STORE_ALL = True
+        elif o in ("-l", "--log"):
+            if a not in logs.LEVELS:
+                helper()
+                exit()
+            LOG_LEVEL = a
+        elif o in ("-M", "--metrics"):
+            METRICS_FILE = a
+        elif o == "--no-metrics":
+            METRICS = False
+        elif o in ("-T", "--trace"):
+            TRACE_FILE = a
+
+    if STORE and MODE == "workers":
+        # The log is memory mapped by one process, workers cannot share it
+        print("The offline store is not available in workers mode")
+        helper()
+        exit(1)
+
+    logs.configure(LOG_LEVEL)
 
-    SERVER = Server(DEST, PORT,WINDOW)
+    if MODE == "async":
+        from async_server import AsyncServer
+        SERVER = AsyncServer(DEST, PORT, WINDOW)
+    elif MODE == "workers":
+        from workers import WorkerPool
+        SERVER = WorkerPool(DEST, PORT, WINDOW, WORKERS)
+    else:
+        SERVER = Server(DEST, PORT,WINDOW)
+    if IMPAIRMENT:
+        SERVER.impair(IMPAIRMENT)
+    if TRACE_FILE:
+        SERVER.record_trace(TRACE_FILE)
+    if QUEUE:
+        SERVER.outbox_high_watermark = QUEUE[0]
+        SERVER.outbox_low_watermark = QUEUE[1] if len(QUEUE) > 1 else None
+    SERVER.overflow_policy = POLICY
+    SERVER.ack_delay = ACK_DELAY
+    SERVER.session_timeout = TIMEOUT
+    SERVER.metrics_file = METRICS_FILE
+    SERVER.metrics.enabled = METRICS
+    if STORE:
+        SERVER.store = offline.OfflineStore(STORE, store_all=STORE_ALL)
     try:
         
         SERVER.start()
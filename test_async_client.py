@@ -0,0 +1,49 @@
+'''
+Tests of the asyncio client library against a running server
+'''
+import asyncio
+import threading
+import unittest
+from async_client import AsyncClient
+from server import Server
+
+
+class AsyncClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server("localhost", 0, 3)
+        server_thread = threading.Thread(target=self.server.start)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.stop)
+        self.port = self.server.bound_address[1]
+
+    def test_identities_share_one_loop(self):
+        async def run():
+            alice = AsyncClient("alice", "localhost", self.port)
+            bob = AsyncClient("bob", "localhost", self.port)
+            await asyncio.gather(alice.connect(), bob.connect())
+            usernames = await alice.list()
+            text = "see you tomorrow morning " * 20
+            delivered = await alice.send(["bob"], text)
+            received = await asyncio.wait_for(anext(aiter(bob)), 5)
+            await asyncio.gather(alice.close(), bob.close())
+            return usernames, delivered, received
+        usernames, delivered, received = asyncio.run(run())
+        self.assertEqual(usernames, ["alice", "bob"])
+        self.assertTrue(delivered)
+        self.assertEqual(received, ("alice", "see you tomorrow morning " * 20))
+
+    def test_a_refused_join_raises(self):
+        async def run():
+            first = AsyncClient("alice", "localhost", self.port)
+            await first.connect()
+            try:
+                with self.assertRaises(ConnectionError):
+                    await AsyncClient("alice", "localhost", self.port).connect()
+            finally:
+                await first.close()
+        asyncio.run(run())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+'''
+Tests of the batched datagram I/O, with recvmmsg()/sendmmsg() and with the
+portable fallback
+'''
+import socket
+import unittest
+import batchio
+
+
+class RecordingSocket:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append((bytes(data), address))
+
+
+class BatchIoTest(unittest.TestCase):
+    use_mmsg = batchio.LIBC is not None
+
+    def setUp(self):
+        self.receiving = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiving.bind(("127.0.0.1", 0))
+        # Blocking like the server's, the datagrams are queued before receive()
+        self.sending = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sending.bind(("127.0.0.1", 0))
+        self.addCleanup(self.receiving.close)
+        self.addCleanup(self.sending.close)
+        self.receiver = batchio.BatchReceiver(self.receiving, batch_size=4)
+        self.receiver.use_mmsg = self.use_mmsg
+
+    def send(self, packets):
+        if self.use_mmsg:
+            batchio.send_batch(self.sending, packets)
+        else:
+            batchio.send_batch(RecordingSocket(), packets)
+            for data, address in packets:
+                self.sending.sendto(data, address)
+
+    def receive(self, count):
+        received = []
+        while len(received) < count:
+            received += [(bytes(data), address) for data, address in self.receiver.receive()]
+        return received
+
+    def test_a_batch_is_received_in_one_wakeup(self):
+        address = self.receiving.getsockname()
+        self.send([(b"one", address), (b"two", address), (b"three", address)])
+        self.assertEqual(self.receive(3), [(data, self.sending.getsockname()) for data in (b"one", b"two", b"three")])
+        self.assertEqual(self.receiver.stats["datagrams"], 3)
+        self.assertLessEqual(self.receiver.stats["wakeups"], 3)
+
+    def test_a_batch_is_capped(self):
+        address = self.receiving.getsockname()
+        self.send([(bytes([number]), address) for number in range(6)])
+        received = self.receive(6)
+        self.assertEqual([data for data, sender in received], [bytes([number]) for number in range(6)])
+        self.assertGreaterEqual(self.receiver.stats["wakeups"], 2)
+
+    def test_empty_datagrams_are_received(self):
+        # The server is woken up with one
+        self.sending.sendto(b"", self.receiving.getsockname())
+        self.assertEqual(self.receive(1), [(b"", self.sending.getsockname())])
+
+
+class DrainBatchIoTest(BatchIoTest):
+    use_mmsg = False
+
+
+class SendBatchTest(unittest.TestCase):
+    def test_other_sockets_send_one_by_one(self):
+        # An ImpairedSocket, for one, must see every datagram
+        sock = RecordingSocket()
+        packets = [(b"a", ("127.0.0.1", 1)), (b"b", ("127.0.0.1", 2))]
+        batchio.send_batch(sock, packets)
+        self.assertEqual(sock.sent, packets)
+
+    def test_addresses(self):
+        raw = batchio.pack_address(("10.1.2.3", 4567))
+        self.assertEqual(batchio.unpack_address(raw), ("10.1.2.3", 4567))
+        self.assertIsNone(batchio.pack_address(("localhost", 4567)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+'''
+Tests of the trace files and of replaying them
+'''
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import unittest
+import capture
+import replay
+from client import Client
+from server import Server
+
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "trace.bin")
+
+    def test_round_trip(self):
+        writer = capture.TraceWriter(self.path)
+        writer.record(capture.RECEIVED, ("127.0.0.1", 5000), b"start|1|")
+        writer.record(capture.SENT, ("::1", 5001, 0, 0), b"ack|1|")
+        writer.record(capture.SENT, ("fe80::1%lo", 5002, 0, 1), b"")
+        writer.close()
+        # Closed traces drop what comes late
+        writer.record(capture.SENT, ("127.0.0.1", 5000), b"late")
+        started, records = capture.read_trace(self.path)
+        self.assertGreater(started, 0)
+        self.assertEqual([record[1:] for record in records], [
+            (capture.RECEIVED, ("127.0.0.1", 5000), b"start|1|"),
+            (capture.SENT, ("::1", 5001), b"ack|1|"),
+            (capture.SENT, ("fe80::1", 5002), b""),
+        ])
+        self.assertEqual((writer.stats["received"], writer.stats["sent"]), (1, 2))
+
+    def test_a_truncated_record_is_left_out(self):
+        writer = capture.TraceWriter(self.path)
+        writer.record(capture.RECEIVED, ("127.0.0.1", 5000), b"start|1|")
+        writer.record(capture.RECEIVED, ("127.0.0.1", 5000), b"data|2|join alice")
+        writer.close()
+        with open(self.path, "r+b") as trace_file:
+            trace_file.truncate(os.path.getsize(self.path) - 3)
+        self.assertEqual(len(capture.read_trace(self.path)[1]), 1)
+
+    def test_other_files_are_refused(self):
+        with open(self.path, "wb") as trace_file:
+            trace_file.write(b"not a trace")
+        with self.assertRaises(ValueError):
+            capture.read_trace(self.path)
+
+
+class RecordingClient(Client):
+    def __init__(self, username, port):
+        super().__init__(username, "localhost", port, 3)
+        self.messages = queue.Queue()
+
+    def handle_message(self, sender, message):
+        self.messages.put((sender, message))
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "trace.bin")
+
+    def connect(self, username, port):
+        client = RecordingClient(username, port)
+        receive_thread = threading.Thread(target=client.receive_handler)
+        receive_thread.daemon = True
+        receive_thread.start()
+        self.assertTrue(client.join())
+        return client
+
+    def test_a_recorded_session_is_delivered_again(self):
+        server = Server("localhost", 0, 3)
+        server.record_trace(self.path)
+        server_thread = threading.Thread(target=server.start)
+        server_thread.daemon = True
+        server_thread.start()
+        port = server.bound_address[1]
+        alice, bob = self.connect("alice", port), self.connect("bob", port)
+        for number in range(3):
+            alice.send_message(f"msg 1 bob hello {number}")
+        for number in range(3):
+            bob.messages.get(timeout=5)
+        alice.quit()
+        bob.quit()
+        server.stop()
+        server_thread.join(5)
+
+        results = replay.Replay([self.path], speed=0, port=0).run()
+        self.assertEqual(results["clients"], 2)
+        self.assertEqual((results["expected"], results["delivered"]), (3, 3))
+        self.assertEqual(results["mismatched"], {})
+
+
+if __name__ == "__main__":
+    unittest.main()
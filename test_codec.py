@@ -0,0 +1,81 @@
+'''
+Tests of message compression, alone and negotiated between clients and
+the server
+'''
+import queue
+import threading
+import unittest
+import codec
+import wire
+from client import Client
+from server import Server
+
+
+class CodecTest(unittest.TestCase):
+    def test_round_trip(self):
+        text = "hello, see you tomorrow 😀 " * 10
+        self.assertEqual(codec.decompress(codec.compress(text)), text)
+
+    def test_compressed_payload_survives_a_packet(self):
+        payload = codec.compress("thanks, see you later " * 10)
+        packet = wire.make_packet("data", 1, payload, True)
+        self.assertEqual(wire.parse_packet(packet)[2], payload)
+
+    def test_the_dictionary_shrinks_short_lines(self):
+        text = "hey, what are you doing tonight? see you later"
+        self.assertLess(len(codec.compress(text).encode("utf-8", codec.ENCODING_ERRORS)), len(text) * 3 // 4)
+
+    def test_corrupt_data(self):
+        with self.assertRaises(ValueError):
+            codec.decompress("\udcff\udcfe\udcfd garbage")
+
+    def test_decompression_is_bounded(self):
+        payload = codec.compress("a" * 10000)
+        with self.assertRaises(ValueError):
+            codec.decompress(payload, 1000)
+
+    def test_threshold(self):
+        self.assertFalse(codec.should_compress("short"))
+        self.assertTrue(codec.should_compress("x" * codec.COMPRESSION_THRESHOLD))
+
+
+class RecordingClient(Client):
+    def __init__(self, username, port, binary, compression):
+        super().__init__(username, "localhost", port, 3, binary=binary, compression=compression)
+        self.messages = queue.Queue()
+
+    def handle_message(self, sender, message):
+        self.messages.put((sender, message))
+
+
+class NegotiationTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server("localhost", 0, 3)
+        server_thread = threading.Thread(target=self.server.start)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.stop)
+
+    def connect(self, username, binary=True, compression=True):
+        client = RecordingClient(username, self.server.bound_address[1], binary, compression)
+        receive_thread = threading.Thread(target=client.receive_handler)
+        receive_thread.daemon = True
+        receive_thread.start()
+        self.addCleanup(client.quit)
+        client.join()
+        return client
+
+    def test_every_format_gets_the_text(self):
+        sender = self.connect("sender")
+        recipients = [self.connect("zlib"), self.connect("plain", compression=False),
+                      self.connect("text", binary=False)]
+        self.assertTrue(sender.compression)
+        self.assertFalse(recipients[2].compression)
+        text = "see you tomorrow morning, thanks again for the help " * 20
+        sender.send_message(f"msg 3 zlib plain text {text}")
+        for recipient in recipients:
+            self.assertEqual(recipient.messages.get(timeout=5), ("sender", text))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+'''
+Tests of the delayed, coalesced ACKs
+'''
+import queue
+import time
+import unittest
+import delack
+
+
+class DelayedAcksTest(unittest.TestCase):
+    def setUp(self):
+        self.sent = queue.Queue()
+        self.acks = delack.DelayedAcks(lambda address, seq: self.sent.put((address, seq)), delay=0.05)
+
+    def test_every_second_packet_is_acknowledged_at_once(self):
+        self.acks.ack("a", 10)
+        self.assertTrue(self.sent.empty())
+        self.acks.ack("a", 11)
+        self.assertEqual(self.sent.get_nowait(), ("a", 11))
+        self.assertEqual(self.acks.stats, {"sent": 1, "saved": 1})
+
+    def test_a_leftover_packet_is_acknowledged_after_the_delay(self):
+        started = time.monotonic()
+        self.acks.ack("a", 10)
+        self.assertEqual(self.sent.get(timeout=2), ("a", 10))
+        self.assertGreaterEqual(time.monotonic() - started, 0.04)
+        # A pair completed before the deadline leaves nothing for the timer
+        self.acks.ack("a", 11)
+        self.acks.ack("a", 12)
+        self.assertEqual(self.sent.get_nowait(), ("a", 12))
+        time.sleep(0.1)
+        self.assertTrue(self.sent.empty())
+
+    def test_peers_are_held_apart(self):
+        self.acks.ack("a", 10)
+        self.acks.ack("b", 20)
+        self.acks.ack("b", 21)
+        self.assertEqual(self.sent.get_nowait(), ("b", 21))
+        self.assertEqual(self.sent.get(timeout=2), ("a", 10))
+
+    def test_cancelled_acks_are_not_sent(self):
+        # An immediate ACK for a later packet went out and covers this one
+        self.acks.ack("a", 10)
+        self.acks.cancel("a")
+        time.sleep(0.1)
+        self.assertTrue(self.sent.empty())
+        self.assertEqual(self.acks.stats["saved"], 1)
+
+    def test_no_delay_sends_every_ack(self):
+        self.acks.delay = 0
+        self.acks.ack("a", 10)
+        self.acks.ack("a", 11)
+        self.assertEqual([self.sent.get_nowait(), self.sent.get_nowait()], [("a", 10), ("a", 11)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+'''
+Tests of the per-connection ACK dispatcher
+'''
+import unittest
+import demux
+
+
+class AckDispatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.acks = demux.AckDispatcher()
+        self.delivered = []
+
+    def register(self, seqs, name="transfer"):
+        return self.acks.register(seqs, lambda seq: self.delivered.append((name, seq)))
+
+    def test_ack_reaches_its_transfer(self):
+        self.register([10, 11, 12])
+        self.assertTrue(self.acks.dispatch(11))
+        self.assertEqual(self.delivered, [("transfer", 11)])
+        self.assertEqual(self.acks.stats["delivered"], 1)
+
+    def test_unknown_ack_is_stale(self):
+        self.register([10, 11])
+        self.assertFalse(self.acks.dispatch(500))
+        self.assertEqual(self.delivered, [])
+        self.assertEqual(self.acks.stats["stale"], 1)
+
+    def test_cumulative_duplicates_are_dropped(self):
+        self.register([10, 11, 12])
+        self.acks.dispatch(11)
+        self.assertFalse(self.acks.dispatch(11))
+        self.assertFalse(self.acks.dispatch(10))
+        self.assertTrue(self.acks.dispatch(12))
+        self.assertEqual(self.delivered, [("transfer", 11), ("transfer", 12)])
+        self.assertEqual(self.acks.stats["duplicate"], 2)
+
+    def test_unregistered_transfer_gets_nothing(self):
+        waiter = self.register([10, 11])
+        self.acks.unregister(waiter)
+        self.assertFalse(self.acks.dispatch(10))
+        self.assertEqual(self.acks.waiters, {})
+        self.assertEqual(self.acks.stats["stale"], 1)
+
+    def test_transfers_taking_turns_do_not_overlap(self):
+        self.acks.unregister(self.register([10, 11], "first"))
+        self.register([12, 13], "second")
+        self.acks.dispatch(13)
+        self.assertEqual(self.delivered, [("second", 13)])
+        self.assertEqual(self.acks.stats["overlapping"], 0)
+
+    def test_overlapping_transfers_are_counted(self):
+        self.register([10, 11], "first")
+        self.register([12, 13], "second")
+        self.acks.dispatch(11)
+        self.acks.dispatch(12)
+        self.assertEqual(self.delivered, [("first", 11), ("second", 12)])
+        self.assertEqual(self.acks.stats["overlapping"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
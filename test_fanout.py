@@ -0,0 +1,171 @@
+'''
+Tests of the fan-out sender: shared packets, one transfer at a time per
+recipient and recipients that stop answering
+'''
+import threading
+import time
+import unittest
+import demux
+import fanout
+import outbox
+import rtt
+import window
+
+
+class FakeNetwork:
+    '''
+    Socket of the FanoutSender. Live recipients take packets in order and
+    acknowledge them cumulatively, the others never answer
+    '''
+    def __init__(self, live):
+        self.live = set(live)
+        # Called with every ACK, the sender's ack() unless routed elsewhere
+        self.ack = None
+        self.lock = threading.Lock()
+        self.sent = {}
+        self.received = {}
+        self.last = {}
+        self.lost = set()
+
+    def sendto(self, data, address):
+        seq = int(data.split(b"|")[1])
+        with self.lock:
+            self.sent.setdefault(address, []).append(seq)
+            if address not in self.live:
+                return
+            if (address, seq) in self.lost:
+                self.lost.discard((address, seq))
+                return
+            # A start packet opens a transfer, data has to follow in order
+            if data.startswith(b"start") or seq == self.last.get(address, -2) + 1:
+                self.received.setdefault(address, []).append(seq)
+                self.last[address] = seq
+            last = self.last.get(address)
+        if last is not None:
+            self.ack(address, last)
+
+
+def make_phases(first_seq, count, window_size=4):
+    packets = [(seq, f"data|{seq}|".encode()) for seq in range(first_seq + 1, first_seq + count + 1)]
+    return [([(first_seq, f"start|{first_seq}|".encode())], 1), (packets, window_size)]
+
+
+class FanoutSenderTest(unittest.TestCase):
+    def start(self, live, dispatcher=None):
+        network = FakeNetwork(live)
+        self.estimators = {}
+        sender = fanout.FanoutSender(network, self.estimator, dispatcher=dispatcher)
+        network.ack = sender.ack
+        self.outboxes = {}
+        sender.start()
+        self.addCleanup(sender.stop)
+        return network, sender
+
+    def send(self, sender, addresses, phases):
+        # What Server.enqueue() does
+        for address in addresses:
+            client_outbox = self.outboxes.setdefault(address, outbox.Outbox(address))
+            start, refused = client_outbox.put((phases, None))
+            if start:
+                sender.deliver(client_outbox)
+
+    def estimator(self, address):
+        return self.estimators.setdefault(address, rtt.RttEstimator(initial_rto=0.02, min_rto=0.01, max_rto=0.05))
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            time.sleep(0.005)
+
+    def test_every_recipient_gets_the_same_packets(self):
+        network, sender = self.start(["a", "b", "c"])
+        self.send(sender, ["a", "b", "c"], make_phases(100, 10))
+        self.wait_for(lambda: all(len(network.received.get(address, [])) == 11 for address in "abc"))
+        for address in "abc":
+            self.assertEqual(network.received[address], list(range(100, 111)))
+
+    def test_transfers_to_a_recipient_take_turns(self):
+        network, sender = self.start(["a"])
+        self.send(sender, ["a"], make_phases(100, 6))
+        self.send(sender, ["a"], make_phases(500, 6))
+        self.wait_for(lambda: len(network.received.get("a", [])) == 14)
+        # The second transfer started once the first was acknowledged
+        self.assertEqual(network.sent["a"], list(range(100, 107)) + list(range(500, 507)))
+
+    def test_lost_packet_is_resent_with_the_rest_of_the_window(self):
+        network, sender = self.start(["a"])
+        network.lost.add(("a", 103))
+        self.send(sender, ["a"], make_phases(100, 6))
+        self.wait_for(lambda: len(network.received.get("a", [])) == 7)
+        self.assertEqual(network.received["a"], list(range(100, 107)))
+        self.assertEqual(network.sent["a"].count(103), 2)
+        self.assertEqual(sender.retransmissions, len(network.sent["a"]) - 7)
+
+    def test_dead_recipients_do_not_hold_up_the_live_ones(self):
+        dead = [f"dead{number}" for number in range(40)]
+        network, sender = self.start(["live"])
+        for number in range(5):
+            self.send(sender, dead + ["live"], make_phases(100 * number, 4))
+        started = time.monotonic()
+        self.wait_for(lambda: len(network.received.get("live", [])) == 25)
+        # Well before the first dead recipient runs out of retries
+        self.assertLess(time.monotonic() - started, 0.02 * 2**window.MAX_RETRIES)
+        self.assertIn("dead0", sender.states)
+
+    def test_recipient_out_of_retries_moves_on(self):
+        network, sender = self.start([])
+        self.send(sender, ["a"], make_phases(100, 2))
+        self.send(sender, ["a"], make_phases(500, 2))
+        self.wait_for(lambda: len(network.sent.get("a", [])) == 2 * (window.MAX_RETRIES + 1))
+        time.sleep(0.1)
+        # Only the start packets went out, each one retried
+        self.assertEqual(network.sent["a"], [100] * (window.MAX_RETRIES + 1) + [500] * (window.MAX_RETRIES + 1))
+        self.assertEqual(sender.states, {})
+        self.assertEqual(self.outboxes["a"].stats["failed"], 2)
+
+    def test_empty_phases_are_skipped(self):
+        network, sender = self.start(["a"])
+        self.send(sender, ["a"], [([], 1)] + make_phases(100, 1) + [([], 4)])
+        self.wait_for(lambda: len(network.received.get("a", [])) == 2)
+        time.sleep(0.05)
+        self.assertEqual(network.received["a"], [100, 101])
+        self.assertEqual(sender.states, {})
+        self.assertEqual(self.outboxes["a"].stats["delivered"], 1)
+
+    def test_idle_recipient_is_restarted_by_the_next_put(self):
+        network, sender = self.start(["a"])
+        self.send(sender, ["a"], make_phases(100, 2))
+        self.wait_for(lambda: len(network.received.get("a", [])) == 3)
+        time.sleep(0.05)
+        self.assertFalse(self.outboxes["a"].busy)
+        self.send(sender, ["a"], make_phases(500, 2))
+        self.wait_for(lambda: len(network.received.get("a", [])) == 6)
+
+    def test_new_outbox_of_a_recipient_waits_for_the_old_one(self):
+        network, sender = self.start(["a"])
+        self.send(sender, ["a"], make_phases(100, 6))
+        # The client reconnected, its new connection got an outbox of its own
+        new_outbox = outbox.Outbox("a")
+        new_outbox.put((make_phases(500, 2), None))
+        sender.deliver(new_outbox)
+        self.wait_for(lambda: len(network.received.get("a", [])) == 10)
+        self.assertEqual(network.sent["a"], list(range(100, 107)) + list(range(500, 503)))
+
+    def test_acks_are_routed_to_the_transfer_in_flight(self):
+        dispatchers = {"a": demux.AckDispatcher()}
+        network, sender = self.start(["a"], dispatchers.get)
+        network.ack = lambda address, seq: dispatchers[address].dispatch(seq)
+        self.send(sender, ["a"], make_phases(100, 6))
+        self.send(sender, ["a"], make_phases(500, 6))
+        self.wait_for(lambda: len(network.received.get("a", [])) == 14)
+        time.sleep(0.05)
+        # An ACK of the finished transfer no longer reaches the sender
+        self.assertFalse(dispatchers["a"].dispatch(103))
+        self.assertEqual(dispatchers["a"].waiters, {})
+        self.assertEqual(dispatchers["a"].stats["overlapping"], 0)
+        self.assertEqual(dispatchers["a"].stats["delivered"], 14)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+'''
+Tests of the network impairment simulator and of a server fed with the
+damaged and malformed packets it produces
+'''
+import queue
+import socket
+import threading
+import unittest
+import wire
+from client import Client
+from impairment import Impairment, ImpairedSocket
+from server import Server
+
+
+class RecordingSocket:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append(data)
+
+    def close(self):
+        pass
+
+
+def impaired(**options):
+    sock = RecordingSocket()
+    return sock, ImpairedSocket(sock, Impairment(seed=1, **options))
+
+
+class ImpairmentTest(unittest.TestCase):
+    def test_parse(self):
+        impairment = Impairment.parse("loss=0.05, delay=0.02,truncate=0.1,seed=3")
+        self.assertEqual((impairment.loss, impairment.delay, impairment.truncate, impairment.seed),
+                         (0.05, 0.02, 0.1, 3))
+
+    def test_parse_rejects_unknown_names(self):
+        with self.assertRaises(ValueError):
+            Impairment.parse("lossy=1")
+
+    def test_with_seed_copies_the_parameters(self):
+        impairment = Impairment(loss=0.5, corrupt=0.1, seed=1).with_seed(2)
+        self.assertEqual((impairment.loss, impairment.corrupt, impairment.seed), (0.5, 0.1, 2))
+
+
+class ImpairedSocketTest(unittest.TestCase):
+    def test_same_seed_same_damage(self):
+        runs = []
+        for _ in range(2):
+            sock, impaired_sock = impaired(loss=0.3, corrupt=0.3, truncate=0.3)
+            for number in range(50):
+                impaired_sock.sendto(b"packet %d" % number, None)
+            runs.append(sock.sent)
+        self.assertEqual(runs[0], runs[1])
+
+    def test_loss(self):
+        sock, impaired_sock = impaired(loss=1.0)
+        impaired_sock.sendto(b"packet", None)
+        self.assertEqual(sock.sent, [])
+        self.assertEqual(impaired_sock.stats["dropped"], 1)
+
+    def test_corrupt_flips_one_bit(self):
+        sock, impaired_sock = impaired(corrupt=1.0)
+        impaired_sock.sendto(b"packet", None)
+        flipped = [a ^ b for a, b in zip(sock.sent[0], b"packet") if a != b]
+        self.assertEqual(len(flipped), 1)
+        self.assertEqual(bin(flipped[0]).count("1"), 1)
+
+    def test_truncate_cuts_the_tail(self):
+        sock, impaired_sock = impaired(truncate=1.0)
+        for _ in range(20):
+            impaired_sock.sendto(b"packet", None)
+        for packet in sock.sent:
+            self.assertLess(len(packet), 6)
+            self.assertTrue(b"packet".startswith(packet))
+        self.assertEqual(impaired_sock.stats["truncated"], 20)
+
+    def test_damaged_packets_are_invalid(self):
+        packets = [wire.make_packet("data", 7, "send_message 4 1 bob hello", binary) for binary in (False, True)]
+        sock, impaired_sock = impaired(corrupt=0.5, truncate=0.5)
+        for _ in range(50):
+            for packet in packets:
+                impaired_sock.sendto(packet, None)
+        for packet in sock.sent:
+            if packet not in packets:
+                self.assertFalse(wire.parse_packet(packet)[3])
+
+
+class ListClient(Client):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.lists = queue.Queue()
+
+    def handle_users_list(self, usernames):
+        self.lists.put(usernames)
+
+
+class MalformedPayloadTest(unittest.TestCase):
+    '''
+    Whatever reaches it, the server goes on serving the next client
+    '''
+    def setUp(self):
+        self.server = Server("localhost", 0, 3)
+        self.address = self.server.bound_address
+        server_thread = threading.Thread(target=self.server.start)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.stop)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(2)
+        self.addCleanup(self.sock.close)
+
+    def assert_server_still_serves(self):
+        client = ListClient("alice", "localhost", self.address[1], 3)
+        receive_thread = threading.Thread(target=client.receive_handler)
+        receive_thread.daemon = True
+        receive_thread.start()
+        self.addCleanup(client.quit)
+        client.join()
+        client.list_users()
+        self.assertEqual(client.lists.get(timeout=5), ["alice"])
+
+    def test_malformed_requests_are_acknowledged_and_dropped(self):
+        requests = ["", "join", "send_message", "send_message x", "send_message 4",
+                    "send_message 4 many bob hi", "join two", "disconnect 1", "\x00\xff garbage"]
+        for binary in (False, True):
+            for number, request in enumerate(requests):
+                self.sock.sendto(wire.make_packet("data", 100 + number, request, binary), self.address)
+                typeofP, seqno, info, valid = wire.parse_packet(self.sock.recv(wire.BUFFER_SIZE))
+                self.assertEqual((typeofP, seqno), ("ack", 100 + number))
+        self.assert_server_still_serves()
+
+    def test_damaged_packets_through_the_impaired_path(self):
+        impaired_sock = ImpairedSocket(self.sock, Impairment(corrupt=0.5, truncate=0.5, seed=7))
+        for number in range(100):
+            binary = number % 2 == 1
+            impaired_sock.sendto(wire.make_packet("start", number, "", binary), self.address)
+            impaired_sock.sendto(wire.make_packet("data", number + 1, "send_message 4 1 bob hi", binary), self.address)
+            impaired_sock.sendto(wire.make_packet("end", number + 2, "send_message 4 1 bob hi", binary), self.address)
+        self.assertGreater(impaired_sock.stats["corrupted"] + impaired_sock.stats["truncated"], 100)
+        self.assert_server_still_serves()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+'''
+Tests of the server metrics, the stats query and the rate limited log
+'''
+import logging
+import os
+import queue
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import logs
+import metrics
+import wire
+from async_server import AsyncServer
+from client import Client
+from server import Server
+
+
+class HistogramTest(unittest.TestCase):
+    def test_percentiles_are_bucket_bounds(self):
+        histogram = metrics.Histogram()
+        for microseconds in (3, 3, 3, 100):
+            histogram.observe(microseconds / 1e6)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot["count"], 4)
+        # 3 us falls in the bucket below 4 us
+        self.assertEqual(snapshot["p50_ms"], 0.004)
+        self.assertAlmostEqual(snapshot["p99_ms"], 0.1)
+        self.assertAlmostEqual(snapshot["max_ms"], 0.1)
+
+    def test_empty(self):
+        self.assertIsNone(metrics.Histogram().snapshot()["p50_ms"])
+
+
+class MetricsTest(unittest.TestCase):
+    def test_disabled_metrics_ignore_updates(self):
+        collected = metrics.Metrics(enabled=False)
+        collected.count("in.data")
+        collected.observe("stage.parse", 0.001)
+        snapshot = collected.snapshot()
+        self.assertEqual((snapshot["counters"], snapshot["histograms"]), ({}, {}))
+
+    def test_dump(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        collected = metrics.Metrics()
+        collected.count("in.data", 2)
+        path = os.path.join(directory, "metrics.json")
+        collected.dump(path, collected.snapshot())
+        with open(path) as dump_file:
+            self.assertIn('"in.data": 2', dump_file.read())
+        self.assertFalse(collected.dump_due())
+
+    def test_failed_dump_waits_for_the_interval(self):
+        collected = metrics.Metrics()
+        with self.assertRaises(OSError):
+            collected.dump("/nonexistent/metrics.json", collected.snapshot())
+        self.assertFalse(collected.dump_due())
+
+
+class RateLimitTest(unittest.TestCase):
+    def record(self, msg):
+        return logging.LogRecord("chat.test", logging.INFO, __file__, 1, msg, None, None)
+
+    def test_a_template_is_suppressed_past_the_rate(self):
+        limit = logs.RateLimit(rate=3)
+        passed = [limit.filter(self.record("join: %s")) for _ in range(5)]
+        self.assertEqual(passed, [True, True, True, False, False])
+        self.assertTrue(limit.filter(self.record("disconnected: %s")))
+        self.assertEqual(limit.suppressed, 2)
+
+    def test_the_next_second_tells_what_was_lost(self):
+        limit = logs.RateLimit(rate=1)
+        limit.filter(self.record("join: %s"))
+        limit.filter(self.record("join: %s"))
+        second = int(time.monotonic())
+        while int(time.monotonic()) == second:
+            time.sleep(0.05)
+        record = self.record("join: %s")
+        self.assertTrue(limit.filter(record))
+        self.assertEqual(record.msg, "join: %s (1 similar records suppressed)")
+
+
+class StatsClient(Client):
+    def __init__(self, username, port):
+        super().__init__(username, "localhost", port, 3)
+        self.stats = queue.Queue()
+
+    def handle_stats(self, stats):
+        self.stats.put(stats)
+
+
+class ServerMetricsTest(unittest.TestCase):
+    server_class = Server
+
+    def setUp(self):
+        self.server = self.server_class("localhost", 0, 3)
+        # Only part of the snapshot fits one packet
+        self.server.mtu = 200
+        self.address = self.server.bound_address
+        server_thread = threading.Thread(target=self.server.start)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.stop)
+
+    def connect(self, username):
+        client = StatsClient(username, self.address[1])
+        receive_thread = threading.Thread(target=client.receive_handler)
+        receive_thread.daemon = True
+        receive_thread.start()
+        self.addCleanup(client.quit)
+        self.assertTrue(client.join())
+        return client
+
+    def test_stats_query(self):
+        client = self.connect("alice")
+        client.list_users()
+        client.request_stats()
+        stats = client.stats.get(timeout=5)
+        self.assertEqual(stats["gauges"]["users"], 1)
+        self.assertGreater(stats["counters"]["in.data"], 0)
+        self.assertGreater(stats["counters"]["out.ack"], 0)
+        self.assertIn("stage.dispatch", stats["histograms"])
+
+    def test_garbage_payloads_are_counted_and_dropped(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(2)
+        self.addCleanup(sock.close)
+        sock.sendto(wire.make_packet("start", 1, "", False), self.address)
+        sock.recv(wire.BUFFER_SIZE)
+        # Checksums match, the requests make no sense
+        garbage = ["", "join", "join many", "send_message 4", "send_message 4 x y", "keepalive two"]
+        for seq_num, payload in enumerate(garbage, 2):
+            sock.sendto(wire.make_packet("data", seq_num, payload, False), self.address)
+            self.assertEqual(wire.parse_packet(sock.recv(wire.BUFFER_SIZE))[:2], ("ack", seq_num))
+        sock.sendto(b"\xff\x00garbage", self.address)
+        sock.sendto(b"data|x|y", self.address)
+        # The server still serves everyone else
+        client = self.connect("alice")
+        client.request_stats()
+        counters = client.stats.get(timeout=5)["counters"]
+        self.assertEqual(counters["in.malformed"], len(garbage))
+        self.assertEqual(counters["in.corrupt"], 2)
+
+    def test_reaping_survives_a_failed_dump(self):
+        self.connect("alice")
+        self.server.metrics_file = "/nonexistent/metrics.json"
+        self.server.metrics.last_dump = 0
+        self.server.reap()
+        self.assertFalse(self.server.metrics.dump_due())
+
+
+class AsyncServerMetricsTest(ServerMetricsTest):
+    server_class = AsyncServer
+
+
+if __name__ == "__main__":
+    unittest.main()
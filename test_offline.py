@@ -0,0 +1,201 @@
+'''
+Tests of the offline message log: recovery, expiry and compaction, and the
+hand-over of stored messages on join
+'''
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import offline
+from async_server import AsyncServer
+from client import Client
+from server import Server
+
+
+class OfflineStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        shutil.rmtree(self.directory)
+
+    def open(self, **options):
+        store = offline.OfflineStore(self.directory, **options)
+        self.stores.append(store)
+        return store
+
+    def reopen(self, store, **options):
+        store.close()
+        self.stores.remove(store)
+        return self.open(**options)
+
+    def segment_path(self, segment_id=0):
+        return os.path.join(self.directory, f"{segment_id:08d}.log")
+
+    def test_take_returns_oldest_first(self):
+        store = self.open()
+        store.append("alice", "bob", "one")
+        store.append("alice", "carol", "two", compressed=True)
+        store.append("dave", "bob", "three")
+        self.assertEqual(store.pending("alice"), 2)
+        self.assertEqual(store.take("alice"), [("bob", "one", False), ("carol", "two", True)])
+        self.assertEqual(store.take("alice"), [])
+        self.assertEqual(store.pending("dave"), 1)
+
+    def test_restart_recovers_pending_messages(self):
+        store = self.open()
+        store.append("alice", "bob", "one")
+        store.append("dave", "bob", "two")
+        store.take("dave")
+        store = self.reopen(store)
+        self.assertEqual(store.stats["recovered"], 1)
+        self.assertEqual(store.take("alice"), [("bob", "one", False)])
+        self.assertEqual(store.take("dave"), [])
+
+    def test_torn_record_is_overwritten(self):
+        store = self.open()
+        store.append("alice", "bob", "one")
+        store.append("alice", "bob", "two")
+        end = store.active.offset
+        store.close()
+        self.stores.remove(store)
+        # A crash after the header of a third record, before its body
+        with open(self.segment_path(), "r+b") as f:
+            f.seek(end)
+            f.write(offline.HEADER.pack(40, 12345, time.time(), offline.PENDING, 0))
+        store = self.open()
+        self.assertEqual(store.stats["recovered"], 2)
+        self.assertEqual(store.active.offset, end)
+        store.append("alice", "bob", "three")
+        store = self.reopen(store)
+        self.assertEqual([message for sender, message, compressed in store.take("alice")],
+                         ["one", "two", "three"])
+
+    def test_truncated_segment(self):
+        store = self.open(segment_size=4096)
+        store.append("alice", "bob", "one")
+        second = store.active.offset
+        store.append("alice", "bob", "two")
+        store.close()
+        self.stores.remove(store)
+        # The file ends in the middle of the second record
+        with open(self.segment_path(), "r+b") as f:
+            f.truncate(second + offline.HEADER.size + 3)
+        store = self.open(segment_size=4096)
+        self.assertEqual(store.stats["recovered"], 1)
+        # The short segment is full, the next record starts a new one
+        store.append("alice", "bob", "three " + "x" * 100)
+        self.assertEqual(store.stats["segments"], 2)
+        self.assertEqual([message[:5] for sender, message, compressed in store.take("alice")],
+                         ["one", "three"])
+
+    def test_empty_segment_is_recreated(self):
+        # A crash between creating a segment file and sizing it
+        open(self.segment_path(), "wb").close()
+        store = self.open(segment_size=4096)
+        self.assertEqual(os.path.getsize(self.segment_path()), 4096)
+        store.append("alice", "bob", "one")
+        store = self.reopen(store, segment_size=4096)
+        self.assertEqual(store.take("alice"), [("bob", "one", False)])
+
+    def test_expiry_on_maintain(self):
+        store = self.open(retention=0.05)
+        store.append("alice", "bob", "old")
+        time.sleep(0.1)
+        store.append("alice", "bob", "new")
+        store.maintain(force=True)
+        self.assertEqual(store.stats["expired"], 1)
+        self.assertEqual(store.take("alice"), [("bob", "new", False)])
+        # The expired record stays expired after a restart
+        store = self.reopen(store, retention=0.05)
+        self.assertEqual(store.stats["recovered"], 0)
+
+    def test_expiry_on_take(self):
+        store = self.open(retention=0.05)
+        store.append("alice", "bob", "old")
+        time.sleep(0.1)
+        self.assertEqual(store.take("alice"), [])
+        self.assertEqual(store.stats["expired"], 1)
+
+    def test_compaction(self):
+        store = self.open(segment_size=512)
+        for number in range(20):
+            store.append("alice", "bob", f"message {number:02d}")
+            if number % 5 == 4:
+                store.append("carol", "bob", f"keep {number:02d}")
+        self.assertEqual(store.stats["segments"], 2)
+        self.assertEqual(len(store.take("alice")), 20)
+        store.maintain(force=True)
+        # The few messages left in the first segment moved to the active one
+        self.assertEqual(store.stats["compacted"], 2)
+        self.assertEqual(store.stats["segments"], 1)
+        self.assertFalse(os.path.exists(self.segment_path(0)))
+        store = self.reopen(store, segment_size=512)
+        self.assertEqual([message for sender, message, compressed in store.take("carol")],
+                         ["keep 04", "keep 09", "keep 14", "keep 19"])
+
+    def test_maintain_waits_for_the_interval(self):
+        store = self.open(retention=0.05)
+        store.append("alice", "bob", "old")
+        time.sleep(0.1)
+        store.maintain()
+        self.assertEqual(store.stats["expired"], 0)
+
+
+class RecordingClient(Client):
+    def __init__(self, username, port):
+        super().__init__(username, "localhost", port, 3)
+        self.messages = queue.Queue()
+
+    def handle_message(self, sender, message):
+        self.messages.put((sender, message))
+
+
+class HandOverTest(unittest.TestCase):
+    server_class = Server
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.server = self.server_class("localhost", 0, 3)
+        self.server.store = offline.OfflineStore(self.directory)
+        self.addCleanup(self.server.store.close)
+        server_thread = threading.Thread(target=self.server.start)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.stop)
+
+    def connect(self, username):
+        client = RecordingClient(username, self.server.bound_address[1])
+        receive_thread = threading.Thread(target=client.receive_handler)
+        receive_thread.daemon = True
+        receive_thread.start()
+        self.addCleanup(client.quit)
+        client.join()
+        return client
+
+    def test_messages_wait_for_the_join(self):
+        sender = self.connect("sender")
+        sender.send_message("msg 1 away first")
+        sender.send_message("msg 1 away " + "second " * 400)
+        deadline = time.monotonic() + 5
+        while self.server.store.pending("away") < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        away = self.connect("away")
+        self.assertEqual(away.messages.get(timeout=5), ("sender", "first"))
+        self.assertEqual(away.messages.get(timeout=5), ("sender", "second " * 400))
+        self.assertEqual(self.server.store.pending("away"), 0)
+
+
+class AsyncHandOverTest(HandOverTest):
+    server_class = AsyncServer
+
+
+if __name__ == "__main__":
+    unittest.main()
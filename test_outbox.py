@@ -0,0 +1,139 @@
+'''
+Tests of the per-client outbound queue, and of a server whose dead clients
+must not hold up the live ones
+'''
+import queue
+import socket
+import threading
+import time
+import unittest
+import outbox
+import util
+import wire
+from async_server import AsyncServer
+from client import Client
+from server import Server
+
+
+class OutboxTest(unittest.TestCase):
+    def test_first_put_starts_delivery(self):
+        client_outbox = outbox.Outbox("a")
+        self.assertEqual(client_outbox.put(("t1", None)), (True, None))
+        self.assertEqual(client_outbox.put(("t2", None)), (False, None))
+        self.assertEqual(client_outbox.get(), ("t1", None))
+        self.assertEqual(client_outbox.get(), ("t2", None))
+        # Drained, the next put has to start delivery again
+        self.assertIsNone(client_outbox.get())
+        self.assertEqual(client_outbox.put(("t3", None)), (True, None))
+
+    def test_full_until_drained_to_the_low_watermark(self):
+        client_outbox = outbox.Outbox("a", high_watermark=4, low_watermark=1)
+        for number in range(4):
+            client_outbox.put((number, None))
+        self.assertTrue(client_outbox.full)
+        client_outbox.get()
+        client_outbox.get()
+        self.assertTrue(client_outbox.full)
+        client_outbox.get()
+        self.assertFalse(client_outbox.full)
+        self.assertEqual(client_outbox.stats["full"], 1)
+        self.assertEqual(client_outbox.stats["max_depth"], 4)
+
+    def test_reject_refuses_the_new_transfer(self):
+        client_outbox = outbox.Outbox("a", high_watermark=2)
+        client_outbox.put(("t1", None))
+        client_outbox.put(("t2", None))
+        self.assertEqual(client_outbox.put(("t3", "origin")), (False, ("t3", "origin")))
+        self.assertEqual(list(client_outbox.transfers), [("t1", None), ("t2", None)])
+        self.assertEqual(client_outbox.stats["rejected"], 1)
+
+    def test_drop_refuses_the_oldest_transfer(self):
+        client_outbox = outbox.Outbox("a", high_watermark=2, policy=outbox.DROP)
+        client_outbox.put(("t1", "origin"))
+        client_outbox.put(("t2", None))
+        self.assertEqual(client_outbox.put(("t3", None)), (False, ("t1", "origin")))
+        self.assertEqual(list(client_outbox.transfers), [("t2", None), ("t3", None)])
+        self.assertEqual(client_outbox.stats["dropped"], 1)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            outbox.Outbox("a", policy="block")
+
+
+class RecordingClient(Client):
+    def __init__(self, username, port):
+        super().__init__(username, "localhost", port, 3)
+        self.messages = queue.Queue()
+        self.errors = queue.Queue()
+
+    def handle_message(self, sender, message):
+        self.messages.put((sender, message))
+
+    def handle_error(self, error, args):
+        self.errors.put((error, args))
+
+
+class DeadClientsTest(unittest.TestCase):
+    '''
+    Clients that joined and then stopped answering
+    '''
+    server_class = Server
+
+    def setUp(self):
+        self.server = self.server_class("localhost", 0, 3)
+        self.server.max_clients = 100
+        self.address = self.server.bound_address
+        server_thread = threading.Thread(target=self.server.start)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.stop)
+
+    def join_dead_client(self, username):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(2)
+        self.addCleanup(sock.close)
+        sock.sendto(wire.make_packet("start", 1, "", False), self.address)
+        sock.recv(wire.BUFFER_SIZE)
+        sock.sendto(wire.make_packet("data", 2, util.make_message("join", 1, username), False), self.address)
+        sock.recv(wire.BUFFER_SIZE)
+        # Never read again, nothing sent to it is acknowledged
+
+    def connect(self, username):
+        client = RecordingClient(username, self.address[1])
+        receive_thread = threading.Thread(target=client.receive_handler)
+        receive_thread.daemon = True
+        receive_thread.start()
+        self.addCleanup(client.quit)
+        client.join()
+        return client
+
+    def test_live_client_is_not_held_up(self):
+        dead = [f"dead{number}" for number in range(40)]
+        for username in dead:
+            self.join_dead_client(username)
+        live = self.connect("live")
+        sender = self.connect("sender")
+        started = time.monotonic()
+        for number in range(5):
+            sender.send_message(f"msg {len(dead) + 1} {' '.join(dead)} live hello {number}")
+        for number in range(5):
+            self.assertEqual(live.messages.get(timeout=5), ("sender", f"hello {number}"))
+        # The first dead client is still far from running out of retries
+        self.assertLess(time.monotonic() - started, 5)
+
+    def test_full_outbox_refuses_and_tells_the_sender(self):
+        self.server.outbox_high_watermark = 2
+        self.join_dead_client("dead")
+        sender = self.connect("sender")
+        for number in range(6):
+            sender.send_message(f"msg 1 dead hello {number}")
+        self.assertEqual(sender.errors.get(timeout=5), ("ERR_RECIPIENT_BUSY", ["dead"]))
+        self.assertGreater(self.server.outbox_stats()["rejected"], 0)
+
+
+class AsyncDeadClientsTest(DeadClientsTest):
+    server_class = AsyncServer
+
+
+if __name__ == "__main__":
+    unittest.main()
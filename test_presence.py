@@ -0,0 +1,109 @@
+'''
+Tests of the batched presence pushes
+'''
+import queue
+import threading
+import time
+import unittest
+import presence
+import roster
+from async_server import AsyncServer
+from client import Client
+from server import Server
+
+
+class PresenceTest(unittest.TestCase):
+    def setUp(self):
+        self.roster = roster.Roster()
+        self.pushes = queue.Queue()
+        self.presence = presence.Presence(self.roster, lambda address, since: self.pushes.put((address, since)),
+                                          interval=0.02)
+
+    def change(self, name):
+        self.roster.add(name)
+        self.presence.changed()
+
+    def test_a_burst_of_changes_is_one_push(self):
+        self.presence.subscribe("a", 0)
+        for number in range(20):
+            self.change(f"user{number}")
+        self.assertEqual(self.pushes.get(timeout=2), ("a", 0))
+        time.sleep(0.1)
+        self.assertTrue(self.pushes.empty())
+        self.assertEqual(self.presence.subscribers, {"a": 20})
+        self.assertEqual(self.presence.stats["pushes"], 1)
+
+    def test_only_subscribers_behind_are_pushed(self):
+        self.change("alice")
+        self.presence.subscribe("a", 1)
+        self.presence.subscribe("b", 0)
+        self.assertEqual(self.pushes.get(timeout=2), ("b", 0))
+        time.sleep(0.1)
+        self.assertTrue(self.pushes.empty())
+
+    def test_unsubscribed_clients_are_left_alone(self):
+        self.change("alice")
+        self.presence.subscribe("a", 0)
+        self.pushes.get(timeout=2)
+        self.presence.unsubscribe("a")
+        self.change("bob")
+        time.sleep(0.1)
+        self.assertTrue(self.pushes.empty())
+
+
+class RecordingClient(Client):
+    def __init__(self, username, port):
+        super().__init__(username, "localhost", port, 3)
+        self.lists = queue.Queue()
+
+    def handle_users_list(self, usernames):
+        self.lists.put(usernames)
+
+
+class SubscriberTest(unittest.TestCase):
+    server_class = Server
+
+    def setUp(self):
+        self.server = self.server_class("localhost", 0, 3)
+        self.server.max_clients = 20
+        server_thread = threading.Thread(target=self.server.start)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.stop)
+
+    def connect(self, username):
+        client = RecordingClient(username, self.server.bound_address[1])
+        receive_thread = threading.Thread(target=client.receive_handler)
+        receive_thread.daemon = True
+        receive_thread.start()
+        self.addCleanup(client.quit)
+        client.join()
+        return client
+
+    def wait_for(self, client, usernames):
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            try:
+                if client.lists.get(timeout=0.5) == usernames:
+                    return
+            except queue.Empty:
+                pass
+        self.fail(f"{client.name} never saw {usernames}")
+
+    def test_joins_are_pushed(self):
+        subscriber = self.connect("subscriber")
+        subscriber.subscribe_presence()
+        self.wait_for(subscriber, ["subscriber"])
+        names = [f"user{number:02}" for number in range(10)]
+        for name in names:
+            self.connect(name)
+        self.wait_for(subscriber, ["subscriber"] + names)
+        self.assertLess(self.server.presence.stats["pushes"], 10)
+
+
+class AsyncSubscriberTest(SubscriberTest):
+    server_class = AsyncServer
+
+
+if __name__ == "__main__":
+    unittest.main()
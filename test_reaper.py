@@ -0,0 +1,141 @@
+'''
+Tests of the timing wheel the Server reaps idle sessions with, and of the
+sessions it reaps
+'''
+import socket
+import threading
+import time
+import unittest
+import reaper
+import util
+import wire
+from async_server import AsyncServer
+from client import Client
+from server import Server
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        # Four slots of one second
+        self.wheel = reaper.TimerWheel(timeout=3, tick=1)
+
+    def test_expires_after_the_timeout(self):
+        self.wheel.touch("a", 0)
+        self.assertEqual(self.wheel.expire(3.5), [])
+        self.assertEqual(self.wheel.expire(4), ["a"])
+        self.assertEqual(self.wheel.expire(10), [])
+        self.assertEqual(self.wheel.stats, {"sessions": 0, "expired": 1})
+
+    def test_touch_pushes_the_deadline(self):
+        self.wheel.touch("a", 0)
+        self.wheel.touch("a", 2)
+        self.assertEqual(self.wheel.expire(4), [])
+        self.assertEqual(self.wheel.expire(6), ["a"])
+
+    def test_remove_cancels_the_deadline(self):
+        self.wheel.touch("a", 0)
+        self.wheel.touch("b", 0)
+        self.wheel.remove("a")
+        self.wheel.remove("unknown")
+        self.assertEqual(self.wheel.expire(4), ["b"])
+        self.assertEqual(self.wheel.stats["sessions"], 0)
+
+    def test_removed_key_can_come_back(self):
+        self.wheel.touch("a", 0)
+        self.wheel.remove("a")
+        self.wheel.touch("a", 5)
+        self.assertEqual(self.wheel.expire(8), [])
+        self.assertEqual(self.wheel.expire(9), ["a"])
+
+    def test_slot_shared_across_turns(self):
+        # The wheel has one level and no cascade: b lands in the slot of a
+        # one turn later and has to stay there when the slot is reaped for a
+        self.wheel.touch("a", 0)
+        self.wheel.touch("b", 4)
+        self.assertEqual(self.wheel.expire(4), ["a"])
+        self.assertEqual(self.wheel.expire(7.5), [])
+        self.assertEqual(self.wheel.expire(8), ["b"])
+
+    def test_long_pause(self):
+        for key in range(10):
+            self.wheel.touch(key, key * 0.3)
+        self.assertEqual(sorted(self.wheel.expire(1000)), list(range(10)))
+        # The clock jumped ahead, later deadlines are still kept
+        self.wheel.touch("a", 1000)
+        self.assertEqual(self.wheel.expire(1003), [])
+        self.assertEqual(self.wheel.expire(1004), ["a"])
+
+    def test_nothing_touched(self):
+        self.assertEqual(self.wheel.expire(100), [])
+
+
+class ReapTest(unittest.TestCase):
+    server_class = Server
+
+    def setUp(self):
+        self.server = self.server_class("localhost", 0, 3)
+        self.server.session_timeout = 1
+        self.address = self.server.bound_address
+        server_thread = threading.Thread(target=self.server.start)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.stop)
+
+    def join_silent_client(self, username):
+        # Joins and is never heard from again, nothing it is sent is ACKed
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(2)
+        self.addCleanup(sock.close)
+        sock.sendto(wire.make_packet("start", 1, "", False), self.address)
+        sock.recv(wire.BUFFER_SIZE)
+        sock.sendto(wire.make_packet("data", 2, util.make_message("join", 1, username), False), self.address)
+        sock.recv(wire.BUFFER_SIZE)
+
+    def transfers_running(self):
+        return self.server.fanout.states
+
+    def wait_until(self, condition):
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            if condition():
+                return
+            time.sleep(0.05)
+        self.fail("condition never met")
+
+    def test_silent_client_is_reaped_and_its_transfers_dropped(self):
+        self.join_silent_client("silent")
+        sender = Client("sender", "localhost", self.address[1], 3)
+        receive_thread = threading.Thread(target=sender.receive_handler)
+        receive_thread.daemon = True
+        receive_thread.start()
+        self.addCleanup(sender.quit)
+        self.assertTrue(sender.join())
+        sender.send_message("msg 1 silent hello")
+        self.wait_until(lambda: self.server.lookup_user("silent") is None)
+        self.assertNotIn("silent", self.server.roster.names)
+        # The transfer towards it is given up without running out of retries
+        self.wait_until(lambda: not self.transfers_running())
+        self.assertEqual(self.server.outbox_stats()["cancelled"], 1)
+        self.assertEqual(self.server.outbox_stats()["failed"], 0)
+
+    def test_refused_join_is_not_kept_alive(self):
+        self.join_silent_client("taken")
+        client = Client("taken", "localhost", self.address[1], 3)
+        receive_thread = threading.Thread(target=client.receive_handler)
+        receive_thread.daemon = True
+        receive_thread.start()
+        self.addCleanup(client.quit)
+        self.assertFalse(client.join())
+        self.assertEqual(client.join_error, "ERR_USERNAME_UNAVAILABLE")
+        self.wait_until(lambda: not self.server.connection_state)
+
+
+class AsyncReapTest(ReapTest):
+    server_class = AsyncServer
+
+    def transfers_running(self):
+        return self.server.transfers
+
+
+if __name__ == "__main__":
+    unittest.main()
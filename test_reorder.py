@@ -0,0 +1,139 @@
+'''
+Tests of the reorder buffer: gaps, duplicates and the edges of its window
+'''
+import queue
+import threading
+import unittest
+import reorder
+from client import Client
+from server import Server
+
+
+class ReorderBufferTest(unittest.TestCase):
+    def test_in_order(self):
+        buffer = reorder.ReorderBuffer(10)
+        self.assertEqual(buffer.accept(10, "a"), (reorder.IN_ORDER, [(10, "a")]))
+        self.assertEqual(buffer.accept(11, "b"), (reorder.IN_ORDER, [(11, "b")]))
+        self.assertEqual(buffer.last_in_order, 11)
+
+    def test_gap_is_held_until_filled(self):
+        buffer = reorder.ReorderBuffer(0)
+        self.assertEqual(buffer.accept(2, "c"), (reorder.BUFFERED, []))
+        self.assertEqual(buffer.accept(1, "b"), (reorder.BUFFERED, []))
+        self.assertEqual(buffer.last_in_order, -1)
+        outcome, released = buffer.accept(0, "a")
+        self.assertEqual(outcome, reorder.IN_ORDER)
+        self.assertEqual(released, [(0, "a"), (1, "b"), (2, "c")])
+        self.assertEqual(buffer.last_in_order, 2)
+        self.assertEqual(buffer.stats["released"], 2)
+
+    def test_second_gap_stops_the_release(self):
+        buffer = reorder.ReorderBuffer(0)
+        buffer.accept(1, "b")
+        buffer.accept(3, "d")
+        self.assertEqual(buffer.accept(0, "a")[1], [(0, "a"), (1, "b")])
+        self.assertEqual(buffer.accept(2, "c")[1], [(2, "c"), (3, "d")])
+        self.assertEqual(buffer.held, {})
+
+    def test_duplicates(self):
+        buffer = reorder.ReorderBuffer(0)
+        buffer.accept(0, "a")
+        # Below the next expected sequence number
+        self.assertEqual(buffer.accept(0, "a"), (reorder.DUPLICATE, []))
+        # Already held ahead of the gap, the first copy is kept
+        buffer.accept(2, "c")
+        self.assertEqual(buffer.accept(2, "other"), (reorder.DUPLICATE, []))
+        self.assertEqual(buffer.accept(1, "b")[1], [(1, "b"), (2, "c")])
+        self.assertEqual(buffer.stats[reorder.DUPLICATE], 2)
+
+    def test_window_edges(self):
+        buffer = reorder.ReorderBuffer(0, window=4)
+        # The last sequence number the window holds
+        self.assertEqual(buffer.accept(4, "e"), (reorder.BUFFERED, []))
+        # One past it is refused and not held
+        self.assertEqual(buffer.accept(5, "f"), (reorder.BEYOND, []))
+        self.assertNotIn(5, buffer.held)
+        self.assertEqual(buffer.stats[reorder.BEYOND], 1)
+
+    def test_bitmap_slides_with_the_window(self):
+        buffer = reorder.ReorderBuffer(0, window=4)
+        buffer.accept(0, 0)
+        buffer.accept(2, 2)
+        # The window ends at 5 until 1 is in
+        self.assertEqual(buffer.accept(6, 6), (reorder.BEYOND, []))
+        self.assertEqual(buffer.accept(1, 1)[1], [(1, 1), (2, 2)])
+        self.assertEqual(buffer.accept(6, 6), (reorder.BUFFERED, []))
+        self.assertEqual(buffer.accept(7, 7), (reorder.BUFFERED, []))
+        self.assertEqual(buffer.accept(8, 8), (reorder.BEYOND, []))
+        self.assertEqual(buffer.accept(3, 3)[1], [(3, 3)])
+        self.assertEqual(buffer.accept(5, 5), (reorder.BUFFERED, []))
+        self.assertEqual(buffer.accept(4, 4)[1], [(4, 4), (5, 5), (6, 6), (7, 7)])
+        self.assertEqual(buffer.bitmap, 0)
+
+    def test_reset_forgets_held_packets(self):
+        buffer = reorder.ReorderBuffer(0)
+        buffer.accept(3, "d")
+        buffer.reset(100)
+        self.assertEqual(buffer.held, {})
+        self.assertEqual(buffer.accept(100, "x"), (reorder.IN_ORDER, [(100, "x")]))
+        self.assertEqual(buffer.accept(3, "d"), (reorder.DUPLICATE, []))
+
+
+class IsAfterTest(unittest.TestCase):
+    def test_order(self):
+        self.assertTrue(reorder.is_after(11, 10))
+        self.assertFalse(reorder.is_after(10, 11))
+        self.assertFalse(reorder.is_after(10, 10))
+
+    def test_wrap_around(self):
+        self.assertTrue(reorder.is_after(1, reorder.SEQ_SPACE - 1))
+        self.assertFalse(reorder.is_after(reorder.SEQ_SPACE - 1, 1))
+
+    def test_half_the_space_apart(self):
+        half = reorder.SEQ_SPACE // 2
+        self.assertTrue(reorder.is_after(half - 1, 0))
+        self.assertFalse(reorder.is_after(half, 0))
+
+
+class RecordingClient(Client):
+    def __init__(self, username, port):
+        # Every command opens its own transfer, the new server knows the client
+        super().__init__(username, "localhost", port, 3, session=False)
+        self.lists = queue.Queue()
+
+    def handle_users_list(self, usernames):
+        self.lists.put(usernames)
+
+
+class RestartTest(unittest.TestCase):
+    def start_server(self, port=0):
+        server = Server("localhost", port, 3)
+        server_thread = threading.Thread(target=server.start)
+        server_thread.daemon = True
+        server_thread.start()
+        return server
+
+    def test_transfers_of_a_restarted_server_are_taken(self):
+        server = self.start_server()
+        port = server.bound_address[1]
+        # Far ahead of the numbers the next server starts from
+        server.next_seq_num = 2**30
+        client = RecordingClient("alice", port)
+        receive_thread = threading.Thread(target=client.receive_handler)
+        receive_thread.daemon = True
+        receive_thread.start()
+        self.assertTrue(client.join())
+        client.list_users()
+        self.assertEqual(client.lists.get(timeout=5), ["alice"])
+        server.stop()
+
+        server = self.start_server(port)
+        self.addCleanup(server.stop)
+        self.assertTrue(client.join())
+        client.list_users()
+        self.assertEqual(client.lists.get(timeout=5), ["alice"])
+        client.quit()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+'''
+Tests of the chat rooms and of messages sent to them
+'''
+import queue
+import threading
+import unittest
+import rooms
+from async_server import AsyncServer
+from client import Client
+from server import Server
+
+
+class RoomsTest(unittest.TestCase):
+    def setUp(self):
+        self.rooms = rooms.Rooms()
+
+    def test_names(self):
+        self.assertTrue(rooms.is_room("#team"))
+        self.assertFalse(rooms.is_room("#"))
+        self.assertFalse(rooms.is_room("team"))
+        self.assertFalse(rooms.is_room("#" + "x" * rooms.MAX_NAME))
+
+    def test_members_are_replaced_not_changed(self):
+        self.assertTrue(self.rooms.create("#team", "a"))
+        self.assertFalse(self.rooms.create("#team", "b"))
+        members = self.rooms.get("#team")
+        self.assertTrue(self.rooms.join("#team", "b"))
+        self.assertEqual(members, {"a"})
+        self.assertEqual(self.rooms.get("#team"), {"a", "b"})
+        self.assertFalse(self.rooms.join("#other", "b"))
+
+    def test_the_last_member_removes_the_room(self):
+        self.rooms.create("#team", "a")
+        self.rooms.join("#team", "b")
+        self.assertFalse(self.rooms.leave("#team", "c"))
+        self.assertTrue(self.rooms.leave("#team", "a"))
+        self.assertTrue(self.rooms.leave("#team", "b"))
+        self.assertEqual(len(self.rooms), 0)
+        self.assertEqual(self.rooms.get("#team"), frozenset())
+        self.assertEqual(self.rooms.memberships, {})
+        self.assertEqual(self.rooms.stats["removed"], 1)
+
+    def test_a_disconnect_leaves_every_room(self):
+        self.rooms.create("#team", "a")
+        self.rooms.create("#solo", "a")
+        self.rooms.join("#team", "b")
+        self.rooms.leave_all("a")
+        self.assertEqual(self.rooms.get("#team"), {"b"})
+        self.assertNotIn("#solo", self.rooms.members)
+        self.assertNotIn("a", self.rooms.memberships)
+
+
+class RecordingClient(Client):
+    def __init__(self, username, port):
+        super().__init__(username, "localhost", port, 3)
+        self.messages = queue.Queue()
+        self.errors = queue.Queue()
+
+    def handle_message(self, sender, message):
+        self.messages.put((sender, message))
+
+    def handle_error(self, error, args):
+        self.errors.put((error, args))
+
+
+class RoomMessageTest(unittest.TestCase):
+    server_class = Server
+
+    def setUp(self):
+        self.server = self.server_class("localhost", 0, 3)
+        server_thread = threading.Thread(target=self.server.start)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.stop)
+
+    def connect(self, username, leaves=False):
+        client = RecordingClient(username, self.server.bound_address[1])
+        receive_thread = threading.Thread(target=client.receive_handler)
+        receive_thread.daemon = True
+        receive_thread.start()
+        if not leaves:
+            self.addCleanup(client.quit)
+        self.assertTrue(client.join())
+        return client
+
+    def test_members_but_the_sender_get_the_message(self):
+        alice, bob, carol = self.connect("alice"), self.connect("bob"), self.connect("carol")
+        alice.create_room("#team")
+        bob.join_room("#team")
+        alice.send_message("msg #team see you  at noon")
+        self.assertEqual(bob.messages.get(timeout=5), ("alice", "see you  at noon"))
+        self.assertTrue(alice.messages.empty())
+        self.assertTrue(carol.messages.empty())
+        self.assertEqual(self.server.metrics_snapshot()["gauges"]["rooms"]["rooms"], 1)
+
+    def test_errors_are_reported(self):
+        alice, bob = self.connect("alice"), self.connect("bob")
+        alice.create_room("#team")
+        bob.create_room("#team")
+        self.assertEqual(bob.errors.get(timeout=5), ("ERR_ROOM_EXISTS", ["#team"]))
+        bob.join_room("#nowhere")
+        self.assertEqual(bob.errors.get(timeout=5), ("ERR_NO_SUCH_ROOM", ["#nowhere"]))
+        bob.send_message("msg #team hello")
+        self.assertEqual(bob.errors.get(timeout=5), ("ERR_NOT_IN_ROOM", ["#team"]))
+        self.assertTrue(alice.messages.empty())
+
+    def test_leaving_users_leave_their_rooms(self):
+        alice, bob = self.connect("alice"), self.connect("bob", leaves=True)
+        alice.create_room("#team")
+        bob.join_room("#team")
+        self.assertEqual(len(self.server.rooms.get("#team")), 2)
+        bob.quit()
+        self.assertEqual(len(self.server.rooms.get("#team")), 1)
+        self.assertEqual(list(self.server.rooms.memberships.values()), [frozenset(["#team"])])
+
+
+class AsyncRoomMessageTest(RoomMessageTest):
+    server_class = AsyncServer
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+'''
+Tests of the versioned roster and of list requests answered from it
+'''
+import queue
+import threading
+import unittest
+import roster
+from client import Client
+from server import Server
+
+
+class RosterTest(unittest.TestCase):
+    def setUp(self):
+        self.roster = roster.Roster(history=4)
+
+    def test_names_stay_sorted_and_every_change_bumps_the_version(self):
+        for name in ("carol", "alice", "bob"):
+            self.roster.add(name)
+        self.roster.add("alice")
+        self.assertEqual(self.roster.names, ["alice", "bob", "carol"])
+        self.assertEqual(self.roster.version, 3)
+        self.roster.remove("bob")
+        self.roster.remove("nobody")
+        self.assertEqual(self.roster.version, 4)
+
+    def test_a_known_version_gets_the_changes_since(self):
+        self.roster.add("alice")
+        self.roster.add("bob")
+        self.roster.remove("alice")
+        self.assertEqual(self.roster.answer(1, 100), (3, roster.DELTA, ["+bob -alice"]))
+        self.assertEqual(self.roster.answer(3, 100), (3, roster.DELTA, [""]))
+
+    def test_versions_beyond_the_history_get_everything(self):
+        for number in range(6):
+            self.roster.add(f"user{number}")
+        self.assertEqual(self.roster.answer(0, 100)[1], roster.FULL)
+        self.assertEqual(self.roster.answer(1, 100)[1], roster.FULL)
+        self.assertEqual(self.roster.answer(2, 100), (6, roster.DELTA, ["+user2 +user3 +user4 +user5"]))
+        # A version from before a restart of the server
+        self.assertEqual(self.roster.answer(50, 100)[1], roster.FULL)
+
+    def test_the_full_answer_is_built_once_per_version(self):
+        self.roster.add("alice")
+        chunks = self.roster.answer(0, 100)[2]
+        self.assertIs(self.roster.answer(0, 100)[2], chunks)
+        self.roster.add("bob")
+        self.assertEqual(self.roster.answer(0, 100)[2], ["alice bob"])
+
+    def test_pack(self):
+        self.assertEqual(roster.pack(["aa", "bb", "cc"], 5), ["aa bb", "cc"])
+        self.assertEqual(roster.pack([], 5), [""])
+
+
+class RecordingClient(Client):
+    def __init__(self, username, port):
+        super().__init__(username, "localhost", port, 3)
+        self.lists = queue.Queue()
+
+    def handle_users_list(self, usernames):
+        self.lists.put(usernames)
+
+
+class UsersListTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server("localhost", 0, 3)
+        # Only a few names fit one packet
+        self.server.mtu = 120
+        self.server.max_clients = 20
+        server_thread = threading.Thread(target=self.server.start)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.stop)
+
+    def connect(self, username, leaves=False):
+        client = RecordingClient(username, self.server.bound_address[1])
+        receive_thread = threading.Thread(target=client.receive_handler)
+        receive_thread.daemon = True
+        receive_thread.start()
+        if not leaves:
+            self.addCleanup(client.quit)
+        client.join()
+        return client
+
+    def record_answers(self):
+        kinds = []
+        answer = self.server.roster.answer
+
+        def recording_answer(since, room):
+            version, kind, chunks = answer(since, room)
+            kinds.append(kind)
+            return version, kind, chunks
+        self.server.roster.answer = recording_answer
+        return kinds
+
+    def test_lists_span_packets_and_later_ones_are_deltas(self):
+        kinds = self.record_answers()
+        names = [f"user{number:02}" for number in range(12)]
+        lister = self.connect(names[0])
+        leaving = self.connect(names[1], leaves=True)
+        for name in names[2:]:
+            self.connect(name)
+        lister.list_users()
+        self.assertEqual(lister.lists.get(timeout=5), names)
+
+        leaving.quit()
+        self.connect("late")
+        lister.list_users()
+        self.assertEqual(lister.lists.get(timeout=5), sorted(names[:1] + names[2:] + ["late"]))
+        self.assertEqual(kinds, [roster.FULL, roster.DELTA])
+        self.assertEqual(lister.roster_version, self.server.roster.version)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+'''
+Tests of the retransmission timeout estimation (RFC 6298)
+'''
+import queue
+import unittest
+import rtt
+import window
+
+
+class RttEstimatorTest(unittest.TestCase):
+    def test_first_sample(self):
+        estimator = rtt.RttEstimator()
+        estimator.sample(0.2)
+        self.assertEqual(estimator.srtt, 0.2)
+        self.assertEqual(estimator.rttvar, 0.1)
+        # RTO = SRTT + K * RTTVAR
+        self.assertAlmostEqual(estimator.rto, 0.6)
+
+    def test_later_samples_are_smoothed(self):
+        estimator = rtt.RttEstimator()
+        estimator.sample(0.2)
+        estimator.sample(0.4)
+        # RTTVAR is updated with the SRTT from before the sample
+        self.assertAlmostEqual(estimator.rttvar, 0.75 * 0.1 + 0.25 * 0.2)
+        self.assertAlmostEqual(estimator.srtt, 0.875 * 0.2 + 0.125 * 0.4)
+        self.assertAlmostEqual(estimator.rto, estimator.srtt + 4 * estimator.rttvar)
+        self.assertEqual(estimator.samples, 2)
+
+    def test_rto_is_clamped(self):
+        estimator = rtt.RttEstimator()
+        estimator.sample(0.0001)
+        self.assertEqual(estimator.rto, rtt.MIN_RTO)
+        estimator.sample(100)
+        self.assertEqual(estimator.rto, rtt.MAX_RTO)
+
+    def test_initial_rto(self):
+        self.assertEqual(rtt.RttEstimator(initial_rto=1.5).rto, 1.5)
+        self.assertEqual(rtt.RttEstimator(initial_rto=100).rto, rtt.MAX_RTO)
+
+    def test_backoff_doubles_up_to_the_maximum(self):
+        estimator = rtt.RttEstimator(initial_rto=1.0)
+        estimator.backoff()
+        self.assertEqual(estimator.rto, 2.0)
+        for _ in range(10):
+            estimator.backoff()
+        self.assertEqual(estimator.rto, rtt.MAX_RTO)
+        self.assertEqual(estimator.as_dict()["backoffs"], 11)
+
+    def test_sample_after_backoff_restarts_from_the_estimate(self):
+        estimator = rtt.RttEstimator()
+        estimator.sample(0.2)
+        estimator.backoff()
+        estimator.sample(0.2)
+        self.assertLess(estimator.rto, 1.0)
+
+
+class KarnTest(unittest.TestCase):
+    '''
+    The window sender only samples packets that went out once
+    '''
+    class Socket:
+        def __init__(self, acks):
+            self.acks = acks
+            self.sent = 0
+
+        def sendto(self, data, address):
+            self.sent += 1
+            # The first copy is lost, the retransmission is acknowledged
+            if self.sent > 1:
+                self.acks.put(int(data.split(b"|")[1]))
+
+    def test_retransmitted_packet_is_not_sampled(self):
+        acks = queue.Queue()
+        estimator = rtt.RttEstimator(initial_rto=0.02, min_rto=0.01)
+        sender = window.WindowSender(self.Socket(acks), ("127.0.0.1", 1), acks, 1, estimator)
+        self.assertTrue(sender.send([(1, b"data|1|x|0"), (2, b"data|2|y|0")]))
+        self.assertEqual(sender.retransmissions, 1)
+        self.assertEqual(estimator.backoffs, 1)
+        # Only the second packet, sent once, gave a sample
+        self.assertEqual(estimator.samples, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+'''
+Tests of the Go-Back-N window sender
+'''
+import asyncio
+import queue
+import unittest
+import rtt
+import window
+
+
+class FakeSocket:
+    '''
+    Records the packets sent and hands them to on_send, which plays the
+    receiver
+    '''
+    def __init__(self, on_send=None):
+        self.sent = []
+        self.on_send = on_send
+
+    def sendto(self, data, address):
+        self.sent.append(data.decode())
+        if self.on_send:
+            self.on_send(data.decode())
+
+
+def make_packets(first_seq, count):
+    return [(seq, f"data|{seq}|chunk {seq}|0".encode()) for seq in range(first_seq, first_seq + count)]
+
+
+def seq_of(packet):
+    return int(packet.split("|")[1])
+
+
+def fast_estimator():
+    return rtt.RttEstimator(initial_rto=0.02, min_rto=0.01)
+
+
+class WindowSenderTest(unittest.TestCase):
+    def setUp(self):
+        self.acks = queue.Queue()
+
+    def test_every_packet_is_sent_once_without_loss(self):
+        sock = FakeSocket(lambda packet: self.acks.put(seq_of(packet)))
+        sender = window.WindowSender(sock, ("127.0.0.1", 1), self.acks, 4, fast_estimator())
+        packets = make_packets(10, 9)
+        self.assertTrue(sender.send(packets))
+        self.assertEqual([seq_of(packet) for packet in sock.sent], list(range(10, 19)))
+
+    def test_window_limits_the_packets_in_flight(self):
+        sock = FakeSocket()
+        sender = window.WindowSender(sock, ("127.0.0.1", 1), self.acks, 3, fast_estimator())
+        self.assertFalse(sender.send(make_packets(0, 5)))
+        # Nothing was acknowledged, only the first window ever went out
+        self.assertEqual({seq_of(packet) for packet in sock.sent}, {0, 1, 2})
+        self.assertEqual(len(sock.sent), 3 * (window.MAX_RETRIES + 1))
+
+    def test_ack_is_cumulative(self):
+        sent = []
+
+        def receiver(packet):
+            sent.append(seq_of(packet))
+            # Only the last packet of every window is acknowledged
+            if seq_of(packet) % 4 == 3 or seq_of(packet) == 9:
+                self.acks.put(seq_of(packet))
+        sender = window.WindowSender(FakeSocket(receiver), ("127.0.0.1", 1), self.acks, 4, fast_estimator())
+        self.assertTrue(sender.send(make_packets(0, 10)))
+        self.assertEqual(sent, list(range(10)))
+
+    def test_go_back_n_after_a_loss(self):
+        lost = {2}
+        delivered = []
+
+        def receiver(packet):
+            seq = seq_of(packet)
+            if seq in lost:
+                lost.discard(seq)
+                return
+            # In order only, a gap makes the receiver re-ACK its last packet
+            if seq == len(delivered):
+                delivered.append(seq)
+            if delivered:
+                self.acks.put(delivered[-1])
+        sock = FakeSocket(receiver)
+        sender = window.WindowSender(sock, ("127.0.0.1", 1), self.acks, 4, fast_estimator())
+        self.assertTrue(sender.send(make_packets(0, 6)))
+        self.assertEqual(delivered, list(range(6)))
+        # The whole window from the lost packet on went out again
+        self.assertEqual([seq_of(packet) for packet in sock.sent], [0, 1, 2, 3, 4, 5, 2, 3, 4, 5])
+
+    def test_stale_acks_are_ignored(self):
+        def receiver(packet):
+            self.acks.put(1000)
+            self.acks.put(seq_of(packet))
+        sender = window.WindowSender(FakeSocket(receiver), ("127.0.0.1", 1), self.acks, 2, fast_estimator())
+        self.assertTrue(sender.send(make_packets(0, 4)))
+
+    def test_nothing_to_send(self):
+        sock = FakeSocket()
+        self.assertTrue(window.WindowSender(sock, ("127.0.0.1", 1), self.acks, 4, fast_estimator()).send([]))
+        self.assertEqual(sock.sent, [])
+
+
+class AsyncWindowSenderTest(unittest.TestCase):
+    def send(self, packets, window_size, on_send):
+        async def run():
+            acks = asyncio.Queue()
+            transport = FakeSocket(lambda packet: on_send(packet, acks))
+            sender = window.AsyncWindowSender(transport, ("127.0.0.1", 1), acks, window_size, fast_estimator())
+            return await sender.send(packets), transport.sent
+        return asyncio.run(run())
+
+    def test_every_packet_is_acknowledged(self):
+        done, sent = self.send(make_packets(5, 7), 3, lambda packet, acks: acks.put_nowait(seq_of(packet)))
+        self.assertTrue(done)
+        self.assertEqual([seq_of(packet) for packet in sent], list(range(5, 12)))
+
+    def test_retransmits_on_the_loop_timer(self):
+        lost = {1}
+        delivered = []
+
+        def receiver(packet, acks):
+            seq = seq_of(packet)
+            if seq in lost:
+                lost.discard(seq)
+                return
+            if seq == len(delivered):
+                delivered.append(seq)
+            acks.put_nowait(delivered[-1])
+        done, sent = self.send(make_packets(0, 3), 3, receiver)
+        self.assertTrue(done)
+        self.assertEqual([seq_of(packet) for packet in sent], [0, 1, 2, 1, 2])
+
+    def test_gives_up_after_the_retries(self):
+        done, sent = self.send(make_packets(0, 2), 2, lambda packet, acks: None)
+        self.assertFalse(done)
+        self.assertEqual(len(sent), 2 * (window.MAX_RETRIES + 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
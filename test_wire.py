@@ -0,0 +1,160 @@
+'''
+Tests of the binary packet format, its text fallback and the sizing of
+message chunks
+'''
+import queue
+import struct
+import threading
+import unittest
+import util
+import wire
+from client import Client
+from server import Server
+
+
+class BinaryFormatTest(unittest.TestCase):
+    def test_header_layout(self):
+        packet = wire.make_packet("data", 7, "hello", True)
+        self.assertEqual(len(packet), wire.HEADER.size + 5)
+        magic, type_code, seqno, length, checksum = wire.HEADER.unpack_from(packet)
+        self.assertEqual((magic, type_code, seqno, length), (wire.MAGIC, wire.TYPE_CODES["data"], 7, 5))
+        self.assertEqual(packet[wire.HEADER.size:], b"hello")
+
+    def test_round_trip(self):
+        for msg_type in wire.TYPE_CODES:
+            packet = wire.make_packet(msg_type, 2**32 - 1, "payload é", True)
+            self.assertTrue(wire.is_binary(packet))
+            self.assertEqual(wire.parse_packet(packet), (msg_type, 2**32 - 1, "payload é", True))
+
+    def test_parses_in_place_from_a_memoryview(self):
+        buffer = bytearray(wire.BUFFER_SIZE)
+        packet = wire.make_packet("ack", 42, "", True)
+        buffer[:len(packet)] = packet
+        self.assertEqual(wire.parse_packet(memoryview(buffer)[:len(packet)]), ("ack", 42, "", True))
+
+    def test_crc_covers_header_and_payload(self):
+        packet = bytearray(wire.make_packet("data", 7, "hello", True))
+        corrupt_payload = bytearray(packet)
+        corrupt_payload[-1] ^= 1
+        self.assertFalse(wire.parse_packet(bytes(corrupt_payload))[3])
+        # The sequence number is part of the checked header
+        corrupt_seqno = bytearray(packet)
+        corrupt_seqno[5] ^= 1
+        self.assertFalse(wire.parse_packet(bytes(corrupt_seqno))[3])
+
+    def test_a_shared_payload_frames_like_its_text(self):
+        payload = wire.Payload("forward_message 4 alice héllo")
+        for binary in (True, False):
+            self.assertEqual(wire.make_packet("data", 7, payload, binary),
+                             wire.make_packet("data", 7, payload.text, binary))
+
+    def test_truncated_payload_is_invalid(self):
+        packet = wire.make_packet("data", 7, "hello", True)
+        self.assertFalse(wire.parse_packet(packet[:-2])[3])
+
+    def test_unknown_type_is_invalid(self):
+        header = struct.pack("!BBIH", wire.MAGIC, 9, 1, 0)
+        packet = header + struct.pack("!I", 0)
+        typeofP, seqno, info, valid = wire.parse_packet(packet)
+        self.assertIsNone(typeofP)
+        self.assertFalse(valid)
+
+
+class TextFormatTest(unittest.TestCase):
+    def test_round_trip(self):
+        packet = wire.make_packet("data", 12, "send_message 5 hello", False)
+        self.assertFalse(wire.is_binary(packet))
+        self.assertEqual(wire.parse_packet(packet), ("data", 12, "send_message 5 hello", True))
+
+    def test_bad_checksum(self):
+        packet = wire.make_packet("data", 12, "hello", False).replace(b"hello", b"hallo")
+        self.assertFalse(wire.parse_packet(packet)[3])
+
+    def test_raw_bytes_check_agrees_with_util(self):
+        packet = wire.make_packet("data", 12, "send_message 5 héllo|x", False)
+        corrupt = packet.replace(b"x", b"y")
+        for data in (packet, corrupt, b"data|12|no checksum", b"garbage"):
+            self.assertEqual(wire.validate_text_checksum(data), util.validate_checksum(data.decode()))
+        self.assertTrue(wire.validate_text_checksum(memoryview(packet)))
+
+    def test_short_datagram_is_text(self):
+        self.assertFalse(wire.is_binary(bytes([wire.MAGIC]) + b"ack"))
+
+
+
+class ChunkingTest(unittest.TestCase):
+    def test_chunks_are_sized_in_bytes(self):
+        text = "héllo wörld " * 50
+        chunks = wire.split_utf8(text, 10, 20)
+        self.assertEqual("".join(chunks), text)
+        self.assertLessEqual(len(chunks[0].encode()), 10)
+        for chunk in chunks[1:]:
+            self.assertLessEqual(len(chunk.encode()), 20)
+
+    def test_characters_are_not_cut(self):
+        # Three bytes each, a chunk of 4 bytes only takes one
+        self.assertEqual(wire.split_utf8("€€€", 4, 4), ["€", "€", "€"])
+        # A character larger than the room still goes out whole
+        self.assertEqual(wire.split_utf8("a€", 1, 1), ["a", "€"])
+
+    def test_whitespace_is_kept(self):
+        self.assertEqual("".join(wire.split_utf8("  two  spaces ", 3, 3)), "  two  spaces ")
+        self.assertEqual(wire.split_utf8("", 10, 10), [""])
+
+    def test_packets_fit_the_mtu(self):
+        for binary in (False, True):
+            size = wire.payload_size(wire.PATH_MTU, binary)
+            room = wire.message_room(size, "message_part")
+            msg = util.make_message("message_part", 4, "x" * room)
+            packet = wire.make_packet("data", 4294967295, msg, binary)
+            self.assertLessEqual(len(packet) + wire.IP_UDP_OVERHEAD, wire.PATH_MTU)
+
+
+
+class RecordingClient(Client):
+    def __init__(self, username, port, compression=True):
+        super().__init__(username, "localhost", port, 3, compression=compression)
+        self.received = queue.Queue()
+
+    def handle_message(self, sender, message):
+        self.received.put((sender, message))
+
+    def handle_error(self, error, args):
+        self.received.put((error, args))
+
+
+class ReassemblyTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server("localhost", 0, 3)
+        self.server.max_message_size = 2900
+        server_thread = threading.Thread(target=self.server.start)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.stop)
+        # Uncompressed, the limit is on the bytes the server reassembles
+        self.sender = self.connect("sender", compression=False)
+        self.recipient = self.connect("recipient")
+
+    def connect(self, username, compression=True):
+        client = RecordingClient(username, self.server.bound_address[1], compression)
+        receive_thread = threading.Thread(target=client.receive_handler)
+        receive_thread.daemon = True
+        receive_thread.start()
+        self.addCleanup(client.quit)
+        client.join()
+        return client
+
+    def test_a_long_message_arrives_as_typed(self):
+        text = "ab  é€ " * 280
+        self.sender.send_message("msg 1 recipient " + text)
+        self.assertEqual(self.recipient.received.get(timeout=5), ("sender", text))
+
+    def test_an_oversized_message_is_refused(self):
+        self.sender.send_message("msg 1 recipient " + "ab  é€ " * 300)
+        self.assertEqual(self.sender.received.get(timeout=5), ("ERR_MESSAGE_TOO_LARGE", ["2900"]))
+        self.sender.send_message("msg 1 recipient next")
+        self.assertEqual(self.recipient.received.get(timeout=5), ("sender", "next"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+'''
+Tests of the multi-process server: the directory shared by the workers,
+the handoffs between them and a pool serving real clients
+'''
+import queue
+import socket
+import threading
+import time
+import unittest
+from client import Client
+from workers import WorkerServer, WorkerPool
+
+
+class WorkerDirectoryTest(unittest.TestCase):
+    '''
+    Two workers in one process, the Manager replaced by a dict and a lock
+    '''
+    def setUp(self):
+        self.users = {}
+        directory = (self.users, threading.Lock())
+        self.inboxes = [queue.Queue(), queue.Queue()]
+        self.workers = [WorkerServer("localhost", 0, 3, worker_id, directory, self.inboxes) for worker_id in range(2)]
+        for worker in self.workers:
+            self.addCleanup(worker.sock.close)
+
+    def deliver_handoffs(self, worker_id):
+        while not self.inboxes[worker_id].empty():
+            self.workers[worker_id].apply_handoff(self.inboxes[worker_id].get())
+
+    def test_a_username_is_admitted_once(self):
+        first, second = self.workers
+        self.assertIsNone(first.admit("alice", ("127.0.0.1", 1)))
+        self.assertEqual(second.admit("alice", ("127.0.0.1", 2)), "ERR_USERNAME_UNAVAILABLE")
+        self.assertEqual(self.users, {"alice": (("127.0.0.1", 1), 0)})
+
+    def test_the_limit_counts_every_worker(self):
+        first, second = self.workers
+        first.max_clients = second.max_clients = 1
+        first.admit("alice", ("127.0.0.1", 1))
+        self.assertEqual(second.admit("bob", ("127.0.0.1", 2)), "ERR_SERVER_FULL")
+
+    def test_joins_and_leaves_are_announced(self):
+        first, second = self.workers
+        first.admit("alice", ("127.0.0.1", 1))
+        first.add_user("alice", ("127.0.0.1", 1))
+        self.deliver_handoffs(1)
+        self.assertEqual(second.username_to_address, {"alice": ("127.0.0.1", 1)})
+        self.assertEqual(second.owners, {("127.0.0.1", 1): 0})
+        # Each worker numbers the versions of its own roster
+        self.assertEqual((second.roster.names, second.roster.version), (["alice"], 1))
+
+        first.remove_user("alice", ("127.0.0.1", 1))
+        self.assertEqual(self.users, {})
+        self.deliver_handoffs(1)
+        self.assertEqual(second.username_to_address, {})
+        self.assertEqual(second.owners, {})
+        self.assertEqual((second.roster.names, second.roster.version), ([], 2))
+
+    def test_subscribers_hear_of_joins_on_other_workers(self):
+        first, second = self.workers
+        pushes = queue.Queue()
+        second.presence.push = lambda address, since: pushes.put((address, since))
+        second.presence.interval = 0.01
+        second.presence.subscribe(("127.0.0.1", 5), 0)
+        first.admit("alice", ("127.0.0.1", 1))
+        first.add_user("alice", ("127.0.0.1", 1))
+        self.deliver_handoffs(1)
+        self.assertEqual(pushes.get(timeout=2), (("127.0.0.1", 5), 0))
+
+    def test_a_late_leave_keeps_the_new_owner_of_the_name(self):
+        second = self.workers[1]
+        second.apply_join("alice", ("127.0.0.1", 2), 1)
+        second.apply_leave("alice", ("127.0.0.1", 1))
+        self.assertEqual(second.username_to_address, {"alice": ("127.0.0.1", 2)})
+        self.assertEqual(second.roster.names, ["alice"])
+
+    def test_lookup_falls_back_to_the_shared_names(self):
+        first, second = self.workers
+        first.admit("alice", ("127.0.0.1", 1))
+        # The announcement has not reached the second worker yet
+        self.assertEqual(second.lookup_user("alice"), ("127.0.0.1", 1))
+        self.assertEqual(second.owners, {("127.0.0.1", 1): 0})
+
+    def test_remote_recipients_are_handed_to_their_owner_once(self):
+        first, second = self.workers
+        local = ("127.0.0.1", 1)
+        first.connection_state[local] = {}
+        remote = [("127.0.0.1", 2), ("127.0.0.1", 3)]
+        for address in remote:
+            first.owners[address] = 1
+        first.fan_out(("127.0.0.1", 9), [local] + remote, "sender", "hello")
+        self.assertEqual(self.inboxes[1].get_nowait(), ("forward", ("127.0.0.1", 9), remote, "sender", "hello", False))
+        self.assertTrue(self.inboxes[1].empty())
+        self.assertEqual(len(first.client_outbox(local).transfers), 1)
+
+    def test_handoffs_wait_for_the_dispatch_lock(self):
+        second = self.workers[1]
+        handoff_thread = threading.Thread(target=second.receive_handoffs)
+        handoff_thread.daemon = True
+        with second.dispatch_lock:
+            handoff_thread.start()
+            self.inboxes[1].put(("join", "alice", ("127.0.0.1", 1), 0))
+            time.sleep(0.05)
+            self.assertEqual(second.username_to_address, {})
+        deadline = time.monotonic() + 2
+        while not second.username_to_address and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(second.username_to_address, {"alice": ("127.0.0.1", 1)})
+
+
+class RecordingClient(Client):
+    def __init__(self, username, port):
+        super().__init__(username, "localhost", port, 3)
+        self.messages = queue.Queue()
+
+    def handle_message(self, sender, message):
+        self.messages.put((sender, message))
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def test_every_client_hears_from_every_other(self):
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(("localhost", 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        pool = WorkerPool("localhost", port, 3, workers=2)
+        pool_thread = threading.Thread(target=pool.start)
+        pool_thread.daemon = True
+        pool_thread.start()
+        self.addCleanup(pool.stop)
+        # The workers bind their sockets once started
+        time.sleep(0.5)
+
+        usernames = [f"user{number}" for number in range(4)]
+        clients = []
+        for username in usernames:
+            client = RecordingClient(username, port)
+            receive_thread = threading.Thread(target=client.receive_handler)
+            receive_thread.daemon = True
+            receive_thread.start()
+            client.join()
+            self.addCleanup(client.quit)
+            clients.append(client)
+        for client in clients:
+            others = [username for username in usernames if username != client.name]
+            client.send_message(f"msg {len(others)} {' '.join(others)} from {client.name}")
+        for client in clients:
+            received = sorted(client.messages.get(timeout=5) for _ in range(3))
+            self.assertEqual(received, [(username, f"from {username}") for username in usernames if username != client.name])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,161 @@
+'''
+This module implements the sliding window sender used by both the Client
+and the Server to push the data packets of a transfer.
+'''
+import asyncio
+import queue
+import time
+import rtt
+import batchio
+import logs
+
+LOG = logs.get_logger("window")
+
+MAX_RETRIES = 3
+
+
+class WindowSender:
+    '''
+    Go-Back-N sender. Up to `window` data packets are kept in flight towards
+    one peer. Receivers only acknowledge packets that arrive in order, so an
+    ACK for seq n is cumulative and confirms every packet up to n.
+
+    The retransmission timer comes from the RttEstimator of the peer. Only
+    packets that were sent once are sampled (Karn's algorithm) and every
+    timeout backs the estimator off. max_retries of None retries forever.
+    '''
+    def __init__(self, sock, address, ack_queue, window, estimator=None, max_retries=MAX_RETRIES):
+        self.sock = sock
+        self.address = address
+        self.ack_queue = ack_queue
+        self.window = max(1, int(window))
+        self.estimator = estimator or rtt.RttEstimator()
+        self.max_retries = max_retries
+        self.retransmissions = 0
+
+    def send(self, packets):
+        '''
+        packets is a list of (seq_num, encoded packet) tuples with
+        consecutive sequence numbers. Returns True once every packet is
+        acknowledged and False when the oldest unacknowledged packet ran
+        out of retries.
+        '''
+        if not packets:
+            return True
+        first_seq = packets[0][0]
+        sent_at = [None] * len(packets)
+        retransmitted = [False] * len(packets)
+        base = 0
+        next_index = 0
+        retries = 0
+        deadline = None
+        while base < len(packets):
+            # Fill the window, with one system call where possible
+            batch = []
+            while next_index < len(packets) and next_index < base + self.window:
+                batch.append((packets[next_index][1], self.address))
+                sent_at[next_index] = time.monotonic()
+                if deadline is None:
+                    deadline = sent_at[next_index] + self.estimator.rto
+                next_index += 1
+            if batch:
+                batchio.send_batch(self.sock, batch)
+
+            try:
+                ack = self.ack_queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                # Timeout: go back and resend everything still in flight
+                retries += 1
+                if self.max_retries is not None and retries > self.max_retries:
+                    LOG.warning("Failed to receive ACK for packet %d. Retries exhausted.", first_seq + base)
+                    return False
+                self.estimator.backoff()
+                batchio.send_batch(self.sock, [(packets[index][1], self.address) for index in range(base, next_index)])
+                for index in range(base, next_index):
+                    retransmitted[index] = True
+                    self.retransmissions += 1
+                deadline = time.monotonic() + self.estimator.rto
+                continue
+
+            if ack is None:
+                # The transfer was cancelled, see AckDispatcher.close()
+                return False
+            # Stale or duplicate ACKs fall outside the window and are ignored
+            acked_index = ack - first_seq
+            if base <= acked_index < next_index:
+                now = time.monotonic()
+                if not retransmitted[acked_index]:
+                    self.estimator.sample(now - sent_at[acked_index])
+                base = acked_index + 1
+                retries = 0
+                deadline = now + self.estimator.rto if base < next_index else None
+        return True
+
+
+class AsyncWindowSender:
+    '''
+    asyncio flavour of WindowSender. The ack_queue is an asyncio.Queue and
+    retransmissions are driven by event loop timers instead of a blocked
+    thread, so many transfers can share one loop.
+    '''
+    def __init__(self, transport, address, ack_queue, window, estimator=None, max_retries=MAX_RETRIES):
+        self.transport = transport
+        self.address = address
+        self.ack_queue = ack_queue
+        self.window = max(1, int(window))
+        self.estimator = estimator or rtt.RttEstimator()
+        self.max_retries = max_retries
+        self.retransmissions = 0
+
+    async def send(self, packets):
+        '''
+        Same contract as WindowSender.send().
+        '''
+        if not packets:
+            return True
+        loop = asyncio.get_running_loop()
+        first_seq = packets[0][0]
+        sent_at = [None] * len(packets)
+        retransmitted = [False] * len(packets)
+        base = 0
+        next_index = 0
+        retries = 0
+        deadline = None
+        while base < len(packets):
+            # Fill the window
+            while next_index < len(packets) and next_index < base + self.window:
+                self.transport.sendto(packets[next_index][1], self.address)
+                sent_at[next_index] = loop.time()
+                if deadline is None:
+                    deadline = sent_at[next_index] + self.estimator.rto
+                next_index += 1
+
+            try:
+                ack = await asyncio.wait_for(self.ack_queue.get(), max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                # Timeout: go back and resend everything still in flight
+                retries += 1
+                if self.max_retries is not None and retries > self.max_retries:
+                    LOG.warning("Failed to receive ACK for packet %d. Retries exhausted.", first_seq + base)
+                    return False
+                self.estimator.backoff()
+                for index in range(base, next_index):
+                    self.transport.sendto(packets[index][1], self.address)
+                    retransmitted[index] = True
+                    self.retransmissions += 1
+                deadline = loop.time() + self.estimator.rto
+                continue
+
+            if ack is None:
+                # The transfer was cancelled, see AckDispatcher.close()
+                return False
+            # Stale or duplicate ACKs fall outside the window and are ignored
+            acked_index = ack - first_seq
+            if base <= acked_index < next_index:
+                now = loop.time()
+                if not retransmitted[acked_index]:
+                    self.estimator.sample(now - sent_at[acked_index])
+                base = acked_index + 1
+                retries = 0
+                deadline = now + self.estimator.rto if base < next_index else None
+        return True
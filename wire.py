@@ -0,0 +1,176 @@
+'''
+This module defines the binary packet format and the helpers that let the
+Client and the Server speak either it or the text format of util.py.
+
+A binary packet is a fixed 12 byte header followed by the raw payload:
+
+    magic (1) | type (1) | seqno (4) | payload length (2) | crc32 (4)
+
+The crc32 covers the first 8 header bytes followed by the CRC-32 of the
+payload. The payload is checksummed on its own, so a payload sent to many
+peers is checksummed once (see Payload) and every packet framing it only
+adds 12 bytes of CRC. MAGIC is not printable ASCII, so it can never start a
+text packet.
+'''
+import struct
+import zlib
+import util
+
+MAGIC = 0xC5
+HEADER = struct.Struct("!BBIHI")
+CHECKED_HEADER = struct.Struct("!BBIH")
+CHECKSUM = struct.Struct("!I")
+# Size of the header part covered by the checksum
+CHECKED_HEADER_SIZE = 8
+# Offers a client can list in the payload of its start packet, the server
+# echoes the ones it accepts in the ACK
+BINARY_OFFER = "binary"
+SESSION_OFFER = "session"
+# Compressed messages, see codec.py. Only accepted with the binary format
+ZLIB_OFFER = "zlib"
+# Size of the preallocated receive buffers
+BUFFER_SIZE = 2048
+# Path MTU packets are sized for, the IPv4 and UDP headers take 28 bytes of it
+PATH_MTU = 1400
+IP_UDP_OVERHEAD = 28
+# Longest "type|seqno|" and "|checksum" a text packet wraps its payload in
+TEXT_OVERHEAD = len("start|4294967295||4294967295")
+
+TYPE_CODES = {"start": 0, "data": 1, "end": 2, "ack": 3}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+
+def is_binary(data):
+    '''
+    Returns True if the received datagram uses the binary format
+    '''
+    return len(data) >= HEADER.size and data[0] == MAGIC
+
+
+def packet_type(packet):
+    '''
+    Type of an encoded packet, read without parsing or checking it
+    '''
+    if is_binary(packet):
+        return TYPE_NAMES.get(packet[1], "unknown")
+    return bytes(packet[:packet.find(b"|")]).decode("ascii", "replace")
+
+
+def payload_size(mtu, binary):
+    '''
+    Bytes of payload that fit a packet of the given format into the MTU.
+    Datagrams never outgrow the receive buffers.
+    '''
+    overhead = IP_UDP_OVERHEAD + (HEADER.size if binary else TEXT_OVERHEAD)
+    return min(mtu, BUFFER_SIZE) - overhead
+
+
+def message_room(size, msg_type, prefix=""):
+    '''
+    Bytes left for the text of a util.make_message() of msg_type, starting
+    with prefix, in a payload of size bytes
+    '''
+    return size - len(util.make_message(msg_type, 4, prefix + " " * size).encode()) + size
+
+
+def split_utf8(text, first_size, size):
+    '''
+    Splits text into chunks of at most size UTF-8 bytes, first_size for the
+    first one, without cutting a character in two. Returns at least one
+    chunk, possibly empty.
+    '''
+    data = text.encode("utf-8", "surrogateescape")
+    chunks = []
+    start = 0
+    limit = max(0, first_size)
+    while True:
+        end = min(len(data), start + limit)
+        # Back off to the start of a character, continuation bytes are 10xxxxxx
+        while start < end < len(data) and data[end] & 0xC0 == 0x80:
+            end -= 1
+        if end == start and end < len(data) and chunks:
+            # A character that fits no chunk at all, take it whole
+            end = start + 1
+            while end < len(data) and data[end] & 0xC0 == 0x80:
+                end += 1
+        chunks.append(data[start:end].decode("utf-8", "surrogateescape"))
+        start = end
+        if start >= len(data):
+            return chunks
+        limit = max(1, size)
+
+
+class Payload:
+    '''
+    A payload encoded and checksummed once, to be framed into the packets
+    of many transfers. make_packet() takes it wherever it takes a str.
+    '''
+    __slots__ = ("text", "data", "checksum")
+
+    def __init__(self, text):
+        self.text = text
+        self.data = text.encode("utf-8", "surrogateescape")
+        self.checksum = zlib.crc32(self.data)
+
+
+def header_checksum(header, payload_checksum):
+    # header is the part of the header covered by the checksum
+    return zlib.crc32(CHECKSUM.pack(payload_checksum), zlib.crc32(header))
+
+
+def make_binary_packet(msg_type, seqno, msg):
+    if isinstance(msg, Payload):
+        payload, payload_checksum = msg.data, msg.checksum
+    else:
+        payload = msg.encode("utf-8", "surrogateescape") if isinstance(msg, str) else bytes(msg)
+        payload_checksum = zlib.crc32(payload)
+    header = CHECKED_HEADER.pack(MAGIC, TYPE_CODES[msg_type], seqno, len(payload))
+    return header + CHECKSUM.pack(header_checksum(header, payload_checksum)) + payload
+
+
+def make_packet(msg_type, seqno, msg, binary):
+    '''
+    Returns the encoded packet in the binary format or in the text format,
+    msg is a str or a Payload
+    '''
+    if binary:
+        return make_binary_packet(msg_type, seqno, msg)
+    if isinstance(msg, Payload):
+        msg = msg.text
+    return util.make_packet(msg_type, seqno, msg).encode()
+
+
+def validate_text_checksum(data):
+    '''
+    util.validate_checksum() on the raw bytes of a text packet, which
+    spares decoding and encoding it again
+    '''
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    end = data.rfind(b"|")
+    return end >= 0 and data[end + 1:] == b"%d" % zlib.crc32(data[:end + 1])
+
+
+def parse_packet(data):
+    '''
+    Splits a received datagram (bytes or memoryview) into type, seqno, data
+    and a flag telling whether the checksum is valid. Binary packets are
+    parsed in place; ACKs, which carry no payload, are never decoded.
+    '''
+    if is_binary(data):
+        magic, type_code, seqno, length, checksum = HEADER.unpack_from(data)
+        payload = data[HEADER.size:HEADER.size + length]
+        valid = (len(payload) == length and type_code in TYPE_NAMES and
+                 header_checksum(data[:CHECKED_HEADER_SIZE], zlib.crc32(payload)) == checksum)
+        # surrogateescape keeps compressed payloads intact, see codec.py
+        info = str(payload, "utf-8", "surrogateescape") if length else ""
+        return TYPE_NAMES.get(type_code), seqno, info, valid
+
+    decoded_data = str(data, "utf-8", "replace")
+    try:
+        typeofP, seqno, info, checksum = util.parse_packet(decoded_data)
+        seqno = int(seqno)
+    except ValueError:
+        # Truncated or corrupted beyond recognition
+        return None, 0, "", False
+    return typeofP, seqno, info, validate_text_checksum(data)
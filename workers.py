@@ -0,0 +1,265 @@
+'''
+This module runs the Server as several worker processes so that parsing,
+checksums and dispatch scale with the number of cores.
+
+Every worker binds its own socket to the same port with SO_REUSEPORT. The
+kernel picks the socket of a datagram by hashing its source address, so
+every packet of a client, and with it its whole session, lands on the same
+worker. The usernames taken are kept in a multiprocessing Manager shared by
+all workers, a join takes its username there under a lock so that two
+workers cannot admit the same name. Every worker keeps its own copy of the
+user directory and of the worker owning each client: the joins and leaves
+of a worker are announced to the others through their inbox queues, and a
+lookup missing a user who just joined elsewhere falls back to the shared
+names. The roster follows the directory, presence pushes included, but
+every worker numbers the roster versions on its own: a client only ever
+talks to one worker, so the version it sends with a list request is always
+one of that worker. The members of the rooms live in the Manager too. A
+message for clients of another worker is handed to that worker through its
+inbox, once for all of them, and the owner builds and delivers the
+transfers: the ACKs of a client only reach its owner, and the transfers of
+a client are numbered from one counter, that of its owner.
+'''
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import delack
+import metrics
+import outbox
+import reaper
+import rooms
+import util
+import wire
+from server import Server, MAX_MESSAGE_SIZE, MAX_FRAGMENTS
+
+
+class WorkerServer(Server):
+    '''
+    One worker of a WorkerPool. directory is the shared (users, lock) pair,
+    users maps every username taken to its (address, worker id).
+    owners maps a client address to the id of the worker it talks to.
+
+    Handoffs from the other workers are applied under the dispatch lock,
+    like the packets of the receive loop, so the directory and the outboxes
+    only ever change under it.
+    '''
+    def __init__(self, dest, port, window, worker_id, directory, inboxes):
+        super().__init__(dest, port, window, reuse_port=True)
+        self.worker_id = worker_id
+        self.users, self.directory_lock = directory
+        self.owners = {}
+        self.inboxes = inboxes
+
+    def start(self):
+        handoff_thread = threading.Thread(target=self.receive_handoffs)
+        handoff_thread.daemon = True
+        handoff_thread.start()
+        super().start()
+
+    def receive_handoffs(self):
+        inbox = self.inboxes[self.worker_id]
+        while True:
+            handoff = inbox.get()
+            with self.dispatch_lock:
+                self.apply_handoff(handoff)
+
+    def apply_handoff(self, handoff):
+        # Messages and errors other workers handed over for our clients, and
+        # the joins and leaves of theirs
+        if handoff[0] == "forward":
+            origin, addresses, sender, message_content, compressed = handoff[1:]
+            super().fan_out(origin, addresses, sender, message_content, compressed)
+        elif handoff[0] == "reply":
+            address, msg = handoff[1:]
+            super().reply(address, msg)
+        elif handoff[0] == "join":
+            self.apply_join(*handoff[1:])
+        else:
+            self.apply_leave(*handoff[1:])
+
+    def announce(self, event):
+        for worker_id, inbox in enumerate(self.inboxes):
+            if worker_id != self.worker_id:
+                inbox.put(event)
+
+    def admit(self, username, address):
+        # Checking and taking the username is one step for all workers
+        with self.directory_lock:
+            if len(self.users) >= self.max_clients:
+                return "ERR_SERVER_FULL"
+            if username in self.users:
+                return "ERR_USERNAME_UNAVAILABLE"
+            self.users[username] = (address, self.worker_id)
+        return None
+
+    def lookup_user(self, username):
+        address = self.username_to_address.get(username)
+        if address is None:
+            # Joined on another worker, its announcement is still on the way.
+            # Only its owner is noted, the announcement fills in the rest
+            entry = self.users.get(username)
+            if entry is not None:
+                address, owner = entry
+                self.owners[address] = owner
+        return address
+
+    def apply_join(self, username, address, owner):
+        self.owners[address] = owner
+        self.username_to_address[username] = address
+        self.address_to_username[address] = username
+        self.roster.add(username)
+        self.presence.changed()
+
+    def apply_leave(self, username, address):
+        # The username may have been taken again since, by another client
+        if self.username_to_address.get(username) == address:
+            self.username_to_address.pop(username, None)
+            self.roster.remove(username)
+            self.presence.changed()
+        if self.address_to_username.get(address) == username:
+            self.address_to_username.pop(address, None)
+        self.owners.pop(address, None)
+
+    def add_user(self, username, address):
+        self.owners[address] = self.worker_id
+        super().add_user(username, address)
+        self.announce(("join", username, address, self.worker_id))
+
+    def remove_user(self, username, address):
+        super().remove_user(username, address)
+        self.owners.pop(address, None)
+        with self.directory_lock:
+            entry = self.users.get(username)
+            if entry is not None and entry[0] == address:
+                del self.users[username]
+        self.announce(("leave", username, address))
+
+    def fan_out(self, client_address, recipient_addresses, sender, message_content, compressed=False):
+        # Recipients of other workers are handed to their owner, one handoff
+        # per worker, which encodes the message once per format like here.
+        # Only the owner knows whether its clients accept compression
+        local = []
+        remote = {}
+        for recipient_address in recipient_addresses:
+            if recipient_address in self.connection_state:
+                local.append(recipient_address)
+                continue
+            owner = self.owners.get(recipient_address)
+            if owner is not None and owner != self.worker_id:
+                remote.setdefault(owner, []).append(recipient_address)
+        for owner, addresses in remote.items():
+            self.inboxes[owner].put(("forward", client_address, addresses, sender, message_content, compressed))
+        super().fan_out(client_address, local, sender, message_content, compressed)
+
+    def reply(self, address, msg):
+        # Errors for the sender of a message may be due to a client of another worker
+        owner = self.owners.get(address) if address not in self.connection_state else None
+        if owner is not None and owner != self.worker_id:
+            self.inboxes[owner].put(("reply", address, msg))
+            return
+        super().reply(address, msg)
+
+
+def run_worker(worker_id, dest, port, window, directory, inboxes, options):
+    server = WorkerServer(dest, port, window, worker_id, directory, inboxes)
+    server.max_clients = options["max_clients"]
+    server.outbox_high_watermark = options["outbox_high_watermark"]
+    server.outbox_low_watermark = options["outbox_low_watermark"]
+    server.overflow_policy = options["overflow_policy"]
+    server.ack_delay = options["ack_delay"]
+    server.session_timeout = options["session_timeout"]
+    server.metrics.enabled = options["metrics"]
+    server.metrics_file = options["metrics_file"]
+    server.mtu = options["mtu"]
+    server.max_message_size = options["max_message_size"]
+    server.max_fragments = options["max_fragments"]
+    server.rooms = rooms.Rooms(*options["rooms"])
+    if options["impairment"]:
+        server.impair(options["impairment"])
+    if options["trace_file"]:
+        server.record_trace(options["trace_file"])
+        # stop() terminates the workers, the trace is written out on the way
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server.trace:
+            server.trace.close()
+
+
+class WorkerPool:
+    '''
+    Starts `workers` WorkerServer processes on one port. It is configured
+    like a Server and start() likewise blocks until stop() is called.
+    '''
+    def __init__(self, dest, port, window, workers=None):
+        self.server_addr = dest
+        self.server_port = port
+        self.window = int(window)
+        self.workers = workers or os.cpu_count()
+        self.max_clients = util.MAX_NUM_CLIENTS
+        self.outbox_high_watermark = outbox.HIGH_WATERMARK
+        self.outbox_low_watermark = None
+        self.overflow_policy = outbox.REJECT
+        self.ack_delay = delack.ACK_DELAY
+        self.session_timeout = reaper.SESSION_TIMEOUT
+        # Only configures the metrics, every worker collects its own
+        self.metrics = metrics.Metrics()
+        self.metrics_file = None
+        self.mtu = wire.PATH_MTU
+        self.max_message_size = MAX_MESSAGE_SIZE
+        self.max_fragments = MAX_FRAGMENTS
+        self.impairment = None
+        self.trace_file = None
+        self.manager = None
+        self.processes = []
+
+    def impair(self, impairment):
+        # Every worker impairs its own socket, each with its own seed
+        self.impairment = impairment
+
+    def record_trace(self, path):
+        # Every worker records its own datagrams, to path.<worker id>
+        self.trace_file = path
+
+    def start(self):
+        self.manager = multiprocessing.Manager()
+        directory = (self.manager.dict(), self.manager.Lock())
+        inboxes = [multiprocessing.Queue() for _ in range(self.workers)]
+        shared_rooms = (self.manager.dict(), self.manager.dict(), self.manager.Lock())
+        for worker_id in range(self.workers):
+            impairment = self.impairment
+            if impairment and impairment.seed is not None:
+                impairment = impairment.with_seed(impairment.seed + worker_id)
+            options = {"max_clients": self.max_clients, "impairment": impairment,
+                       "outbox_high_watermark": self.outbox_high_watermark,
+                       "outbox_low_watermark": self.outbox_low_watermark,
+                       "overflow_policy": self.overflow_policy, "ack_delay": self.ack_delay,
+                       "session_timeout": self.session_timeout,
+                       "metrics": self.metrics.enabled,
+                       "metrics_file": f"{self.metrics_file}.{worker_id}" if self.metrics_file else None,
+                       "mtu": self.mtu, "max_message_size": self.max_message_size,
+                       "max_fragments": self.max_fragments, "rooms": shared_rooms,
+                       "trace_file": f"{self.trace_file}.{worker_id}" if self.trace_file else None}
+            process = multiprocessing.Process(target=run_worker, args=(
+                worker_id, self.server_addr, self.server_port, self.window, directory, inboxes, options))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        for process in self.processes:
+            process.join()
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join(1)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        if self.manager:
+            self.manager.shutdown()